@@ -23,9 +23,10 @@
 
 import threading
 import asyncio
+import bisect
 import itertools
 from collections import defaultdict
-from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
 
 from . import bitcoin
 from .bitcoin import COINBASE_MATURITY, TYPE_ADDRESS, TYPE_PUBKEY
@@ -55,10 +56,241 @@ class UnrelatedTransactionException(AddTransactionException):
         return _("Transaction is unrelated to this wallet.")
 
 
+class UTXOIndex:
+    """Outputs received by the wallet, keyed by (txid, n) outpoint.
+
+    Unspent outputs are grouped by address and by the mining status of
+    the transaction that created them, and coinbase outputs are kept
+    apart, so that queries take time proportional to the number of coins
+    returned. The index is not thread-safe: the wallet only accesses it
+    with transaction_lock held.
+    """
+
+    CONFIRMED = 'confirmed'
+    UNCONFIRMED = 'unconfirmed'
+    LOCAL = 'local'
+
+    def __init__(self):
+        self._outputs = {}  # type: Dict[Tuple[str, int], Tuple[str, int, bool]]  # outpoint -> (address, value, is_coinbase)
+        self._spent = set()  # type: Set[Tuple[str, int]]  # outpoints spent by wallet txs
+        self._by_txid = defaultdict(set)  # type: Dict[str, Set[Tuple[str, int]]]  # all outputs
+        self._tx_height = {}  # type: Dict[str, int]
+        # the following only contain unspent outputs
+        self._by_address = defaultdict(set)  # type: Dict[str, Set[Tuple[str, int]]]
+        self._by_status = {status: set() for status in (self.CONFIRMED, self.UNCONFIRMED, self.LOCAL)}
+        self._coinbase = set()  # type: Set[Tuple[str, int]]
+
+    @classmethod
+    def status_from_height(cls, height: int) -> str:
+        if height > 0:
+            return cls.CONFIRMED
+        if height == TX_HEIGHT_LOCAL:
+            return cls.LOCAL
+        return cls.UNCONFIRMED
+
+    def _link(self, outpoint):
+        address, value, is_cb = self._outputs[outpoint]
+        self._by_address[address].add(outpoint)
+        self._by_status[self.status_from_height(self._tx_height[outpoint[0]])].add(outpoint)
+        if is_cb:
+            self._coinbase.add(outpoint)
+
+    def _unlink(self, outpoint):
+        address, value, is_cb = self._outputs[outpoint]
+        coins = self._by_address[address]
+        coins.discard(outpoint)
+        if not coins:
+            del self._by_address[address]
+        self._by_status[self.status_from_height(self._tx_height[outpoint[0]])].discard(outpoint)
+        self._coinbase.discard(outpoint)
+
+    def add_output(self, outpoint, address, value, is_coinbase, height):
+        if outpoint in self._outputs:
+            return
+        txid = outpoint[0]
+        self._tx_height.setdefault(txid, height)
+        self._by_txid[txid].add(outpoint)
+        self._outputs[outpoint] = (address, value, is_coinbase)
+        if outpoint not in self._spent:
+            self._link(outpoint)
+
+    def remove_tx_outputs(self, txid):
+        for outpoint in self._by_txid.pop(txid, ()):
+            if outpoint not in self._spent:
+                self._unlink(outpoint)
+            del self._outputs[outpoint]
+        self._tx_height.pop(txid, None)
+
+    def add_spend(self, outpoint):
+        if outpoint in self._spent:
+            return
+        if outpoint in self._outputs:
+            self._unlink(outpoint)
+        self._spent.add(outpoint)
+
+    def remove_spend(self, outpoint):
+        if outpoint not in self._spent:
+            return
+        self._spent.discard(outpoint)
+        if outpoint in self._outputs:
+            self._link(outpoint)
+
+    def set_tx_height(self, txid, height):
+        old_height = self._tx_height.get(txid)
+        if old_height is None or old_height == height:
+            return
+        old_status = self.status_from_height(old_height)
+        status = self.status_from_height(height)
+        if old_status != status:
+            unspent = self._by_txid[txid] - self._spent
+            self._by_status[old_status] -= unspent
+            self._by_status[status] |= unspent
+        self._tx_height[txid] = height
+
+    def get(self, outpoint) -> Optional[Tuple[str, int, bool]]:
+        """Returns (address, value, is_coinbase) of a received output,
+        whether it is spent or not."""
+        return self._outputs.get(outpoint)
+
+    def get_height(self, txid) -> Optional[int]:
+        return self._tx_height.get(txid)
+
+    def get_unspent(self, addresses: Optional[Set[str]] = None,
+                    statuses: Iterable[str] = (CONFIRMED, UNCONFIRMED, LOCAL)) -> List[Tuple[str, int]]:
+        """Returns the unspent outpoints of the given addresses (of all
+        addresses if None), created by txs with one of the given statuses.
+        """
+        statuses = set(statuses)
+        if addresses is None or len(addresses) > len(self._by_address):
+            return [outpoint
+                    for status in statuses
+                    for outpoint in self._by_status[status]
+                    if addresses is None or self._outputs[outpoint][0] in addresses]
+        return [outpoint
+                for address in addresses
+                for outpoint in self._by_address.get(address, ())
+                if self.status_from_height(self._tx_height[outpoint[0]]) in statuses]
+
+    def get_coinbase_coins(self) -> Set[Tuple[str, int]]:
+        return self._coinbase
+
+
+class TxHistory:
+    """Wallet txs in history order, with their deltas on the wallet balance.
+
+    Sort keys are kept in sorted blocks of at most 2 * BLOCK_SIZE entries,
+    each with the sum of the deltas in it, so that a tx can be inserted or
+    moved with a bisection, and the balance before any position is the
+    sum of a few block totals. Not thread-safe: the wallet only accesses
+    it with transaction_lock held.
+    """
+
+    BLOCK_SIZE = 500
+
+    def __init__(self):
+        self._blocks = []  # type: List[List[tuple]]
+        self._maxes = []  # type: List[tuple]  # last key of each block
+        self._block_deltas = []  # type: List[int]
+        self._keys = {}  # type: Dict[str, tuple]  # txid -> sort key
+        self._deltas = {}  # type: Dict[str, int]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, txid):
+        return txid in self._keys
+
+    def get_delta(self, txid) -> Optional[int]:
+        return self._deltas.get(txid)
+
+    def get_sort_key(self, txid) -> Optional[tuple]:
+        return self._keys.get(txid)
+
+    def add(self, txid: str, txpos: tuple, delta: int) -> None:
+        """Adds txid at position txpos, or moves it there."""
+        key = txpos + (txid,)
+        if self._keys.get(txid) == key:
+            i = self._find_block(key)
+            self._block_deltas[i] += delta - self._deltas[txid]
+            self._deltas[txid] = delta
+            return
+        self.remove(txid)
+        self._keys[txid] = key
+        self._deltas[txid] = delta
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            self._block_deltas.append(delta)
+            return
+        i = min(bisect.bisect_left(self._maxes, key), len(self._blocks) - 1)
+        block = self._blocks[i]
+        bisect.insort(block, key)
+        self._maxes[i] = block[-1]
+        self._block_deltas[i] += delta
+        if len(block) > 2 * self.BLOCK_SIZE:
+            head, tail = block[:self.BLOCK_SIZE], block[self.BLOCK_SIZE:]
+            self._blocks[i:i+1] = [head, tail]
+            self._maxes[i:i+1] = [head[-1], tail[-1]]
+            tail_delta = sum(self._deltas[k[-1]] for k in tail)
+            self._block_deltas[i:i+1] = [self._block_deltas[i] - tail_delta, tail_delta]
+
+    def remove(self, txid: str) -> None:
+        key = self._keys.pop(txid, None)
+        if key is None:
+            return
+        delta = self._deltas.pop(txid)
+        i = self._find_block(key)
+        block = self._blocks[i]
+        del block[bisect.bisect_left(block, key)]
+        if block:
+            self._maxes[i] = block[-1]
+            self._block_deltas[i] -= delta
+        else:
+            del self._blocks[i]
+            del self._maxes[i]
+            del self._block_deltas[i]
+
+    def _find_block(self, key) -> int:
+        return bisect.bisect_left(self._maxes, key)
+
+    def get_range(self, start: int = 0, stop: Optional[int] = None) -> List[Tuple[str, int, int]]:
+        """Returns (txid, delta, balance) for the txs at positions
+        start to stop, balance being the wallet balance after the tx.
+        """
+        if stop is None or stop > len(self):
+            stop = len(self)
+        out = []
+        balance = 0
+        pos = 0
+        for block, block_delta in zip(self._blocks, self._block_deltas):
+            if pos >= stop:
+                break
+            if pos + len(block) <= start:
+                balance += block_delta
+                pos += len(block)
+                continue
+            for key in block:
+                if pos >= stop:
+                    break
+                txid = key[-1]
+                delta = self._deltas[txid]
+                balance += delta
+                if pos >= start:
+                    out.append((txid, delta, balance))
+                pos += 1
+        return out
+
+    def get_balance(self) -> int:
+        return sum(self._block_deltas)
+
+
 class AddressSynchronizer(Logger):
     """
     inherited by wallet
     """
+    # number of addresses that the synchronizer looks up at once beyond the
+    # end of each address chain while restoring; 0 if addresses are not derived
+    restore_window = 0
 
     def __init__(self, storage: 'WalletStorage'):
         self.storage = storage
@@ -78,7 +310,20 @@ class AddressSynchronizer(Logger):
         # thread local storage for caching stuff
         self.threadlocal_cache = threading.local()
 
-        self._get_addr_balance_cache = {}
+        # balances; access with self.transaction_lock.
+        self._get_addr_balance_cache = {}  # type: Dict[str, Tuple[int, int, int]]
+        # address -> (min, max) local height for which the cached balance
+        # is valid, for addresses with coinbase outputs
+        self._addr_balance_valid_heights = {}  # type: Dict[str, Tuple[int, int]]
+        # sum of the balances of all addresses, built on first use; the
+        # balances of _dirty_balance_addrs have to be updated in it
+        self._wallet_balance = None  # type: Optional[List[int]]
+        self._wallet_balance_addrs = {}  # type: Dict[str, Tuple[int, int, int]]
+        self._dirty_balance_addrs = set()  # type: Set[str]
+        # unspent outputs and wallet history; built on first use.
+        # Access with self.transaction_lock.
+        self._utxo_index = None  # type: Optional[UTXOIndex]
+        self._tx_history = None  # type: Optional[TxHistory]
 
         self.load_and_cleanup()
 
@@ -148,12 +393,19 @@ class AddressSynchronizer(Logger):
     def start_network(self, network):
         self.network = network
         if self.network is not None:
+            self.db.share_transactions(self.network.tx_store)
             self.synchronizer = Synchronizer(self)
             self.verifier = SPV(self.network, self)
             self.network.register_callback(self.on_blockchain_updated, ['blockchain_updated'])
 
     def on_blockchain_updated(self, event, *args):
-        self._get_addr_balance_cache = {}  # invalidate cache
+        # only the balance of addresses with coinbase outputs depends on the
+        # height of the chain; heights of txs are taken care of elsewhere
+        local_height = self.get_local_height()
+        with self.lock, self.transaction_lock:
+            for addr, (min_height, max_height) in list(self._addr_balance_valid_heights.items()):
+                if not min_height <= local_height < max_height:
+                    self._invalidate_addr_balance(addr)
 
     def stop_threads(self, write_to_disk=True):
         if self.network:
@@ -261,7 +513,7 @@ class AddressSynchronizer(Logger):
                         if n == prevout_n:
                             if addr and self.is_mine(addr):
                                 self.db.add_txi_addr(tx_hash, addr, ser, v)
-                                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                                self._invalidate_addr_balance(addr)
                             return
             for txi in tx.inputs():
                 if txi['type'] == 'coinbase':
@@ -278,14 +530,16 @@ class AddressSynchronizer(Logger):
                 addr = self.get_txout_address(txo)
                 if addr and self.is_mine(addr):
                     self.db.add_txo_addr(tx_hash, addr, n, v, is_coinbase)
-                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                    self._invalidate_addr_balance(addr)
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
                         self.db.add_txi_addr(next_tx, addr, ser, v)
                         self._add_tx_to_local_history(next_tx)
+                        self._on_tx_changed(next_tx)
             # add to local history
             self._add_tx_to_local_history(tx_hash)
+            self._on_tx_changed(tx_hash)
             # save
             self.db.add_transaction(tx_hash, tx)
             return True
@@ -313,8 +567,11 @@ class AddressSynchronizer(Logger):
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
+            self._remove_tx_from_utxo_index(tx_hash)
+            if self._tx_history is not None:
+                self._tx_history.remove(tx_hash)
             for addr in itertools.chain(self.db.get_txi(tx_hash), self.db.get_txo(tx_hash)):
-                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                self._invalidate_addr_balance(addr)
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
 
@@ -340,6 +597,7 @@ class AddressSynchronizer(Logger):
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.db.remove_verified_tx(tx_hash)
+                    self._on_tx_height_changed(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.db.set_addr_history(addr, hist)
@@ -394,6 +652,7 @@ class AddressSynchronizer(Logger):
         with self.lock:
             with self.transaction_lock:
                 self.db.clear_history()
+                self._reset_tx_indexes()
                 self.storage.write()
 
     def get_txpos(self, tx_hash):
@@ -421,46 +680,36 @@ class AddressSynchronizer(Logger):
         return f
 
     @with_local_height_cached
-    def get_history(self, domain=None):
-        # get domain
-        if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
-        # 1. Get the history of each address in the domain, maintain the
-        #    delta of a tx as the sum of its deltas on domain addresses
-        tx_deltas = defaultdict(int)
-        for addr in domain:
-            h = self.get_address_history(addr)
-            for tx_hash, height in h:
-                delta = self.get_tx_delta(tx_hash, addr)
-                if delta is None or tx_deltas[tx_hash] is None:
-                    tx_deltas[tx_hash] = None
-                else:
-                    tx_deltas[tx_hash] += delta
-        # 2. create sorted history
-        history = []
-        for tx_hash in tx_deltas:
-            delta = tx_deltas[tx_hash]
-            tx_mined_status = self.get_tx_height(tx_hash)
-            history.append((tx_hash, tx_mined_status, delta))
-        history.sort(key = lambda x: self.get_txpos(x[0]), reverse=True)
-        # 3. add balance
-        c, u, x = self.get_balance(domain)
-        balance = c + u + x
-        h2 = []
-        for tx_hash, tx_mined_status, delta in history:
-            h2.append((tx_hash, tx_mined_status, delta, balance))
-            if balance is None or delta is None:
-                balance = None
+    def get_history(self, domain=None, *, start=0, stop=None):
+        """Returns (tx_hash, tx_mined_status, delta, balance) tuples for the
+        txs of domain, oldest first. start and stop select a range of the
+        history, as in a slice.
+        """
+        with self.lock, self.transaction_lock:
+            tx_history = self._get_tx_history()
+            if domain is None:
+                history = tx_history.get_range(start, stop)
+                total = tx_history.get_balance()
             else:
-                balance -= delta
-        h2.reverse()
-        # fixme: this may happen if history is incomplete
-        if balance not in [None, 0]:
-            self.logger.info("Error: history not synchronized")
-            return []
-
-        return h2
+                # the delta of a tx is the sum of its deltas on domain addresses
+                domain = set(domain)
+                tx_deltas = defaultdict(int)
+                for addr in domain:
+                    for tx_hash in self._history_local.get(addr, ()):
+                        tx_deltas[tx_hash] += self.get_tx_delta(tx_hash, addr)
+                history = []
+                total = 0
+                for tx_hash in sorted(tx_deltas, key=tx_history.get_sort_key):
+                    total += tx_deltas[tx_hash]
+                    history.append((tx_hash, tx_deltas[tx_hash], total))
+                history = history[start:stop]
+            c, u, x = self.get_balance(domain)
+            # fixme: this may happen if history is incomplete
+            if total != c + u + x:
+                self.logger.info("Error: history not synchronized")
+                return []
+            return [(tx_hash, self.get_tx_height(tx_hash), delta, balance)
+                    for tx_hash, delta, balance in history]
 
     def _add_tx_to_local_history(self, txid):
         with self.transaction_lock:
@@ -481,6 +730,109 @@ class AddressSynchronizer(Logger):
                 else:
                     self._history_local[addr] = cur_hist
 
+    @staticmethod
+    def _outpoint_from_ser(ser: str) -> Tuple[str, int]:
+        prevout_hash, prevout_n = ser.split(':')
+        return prevout_hash, int(prevout_n)
+
+    def _get_utxo_index(self) -> UTXOIndex:
+        with self.lock, self.transaction_lock:
+            if self._utxo_index is None:
+                self._utxo_index = UTXOIndex()
+                for txid in self.db.list_txo():
+                    self._add_tx_to_utxo_index(txid)
+                for txid in self.db.list_txi():
+                    self._add_tx_to_utxo_index(txid)
+            return self._utxo_index
+
+    def _add_tx_to_utxo_index(self, txid):
+        index = self._utxo_index
+        if index is None:
+            return
+        with self.lock, self.transaction_lock:
+            height = self.get_tx_height(txid).height
+            for addr in self.db.get_txo(txid):
+                # txo entries of addresses deleted from the wallet are kept
+                if not self.is_mine(addr):
+                    continue
+                for n, v, is_cb in self.db.get_txo_addr(txid, addr):
+                    index.add_output((txid, n), addr, v, is_cb, height)
+            for addr in self.db.get_txi(txid):
+                for ser, v in self.db.get_txi_addr(txid, addr):
+                    index.add_spend(self._outpoint_from_ser(ser))
+
+    def _remove_tx_from_utxo_index(self, txid):
+        index = self._utxo_index
+        if index is None:
+            return
+        with self.transaction_lock:
+            index.remove_tx_outputs(txid)
+            for addr in self.db.get_txi(txid):
+                for ser, v in self.db.get_txi_addr(txid, addr):
+                    index.remove_spend(self._outpoint_from_ser(ser))
+
+    def _get_tx_history(self) -> TxHistory:
+        with self.lock, self.transaction_lock:
+            if self._tx_history is None:
+                self._tx_history = TxHistory()
+                for txid in set(itertools.chain(self.db.list_txi(), self.db.list_txo())):
+                    self._tx_history.add(txid, self.get_txpos(txid), self._get_wallet_delta_of_tx(txid))
+            return self._tx_history
+
+    def _get_wallet_delta_of_tx(self, txid) -> int:
+        # like get_tx_value, but txi and txo entries of addresses
+        # deleted from the wallet are kept, and must be skipped
+        addrs = set(itertools.chain(self.db.get_txi(txid), self.db.get_txo(txid)))
+        return sum(self.get_tx_delta(txid, addr) for addr in addrs if self.is_mine(addr))
+
+    def _on_tx_changed(self, txid):
+        """Must be called when the txi or txo of txid have changed."""
+        with self.lock, self.transaction_lock:
+            self._add_tx_to_utxo_index(txid)
+            if self._tx_history is not None:
+                self._tx_history.add(txid, self.get_txpos(txid), self._get_wallet_delta_of_tx(txid))
+
+    def _on_tx_height_changed(self, txid):
+        """Must be called when the height or txpos of txid might have changed."""
+        with self.lock, self.transaction_lock:
+            for addr in itertools.chain(self.db.get_txi(txid), self.db.get_txo(txid)):
+                self._invalidate_addr_balance(addr)
+            if self._utxo_index is not None:
+                self._utxo_index.set_tx_height(txid, self.get_tx_height(txid).height)
+            if self._tx_history is not None and txid in self._tx_history:
+                self._tx_history.add(txid, self.get_txpos(txid), self._tx_history.get_delta(txid))
+
+    def _reset_tx_indexes(self):
+        with self.lock, self.transaction_lock:
+            self._utxo_index = None
+            self._tx_history = None
+            self._get_addr_balance_cache = {}
+            self._addr_balance_valid_heights = {}
+            self._wallet_balance = None
+
+    def _invalidate_addr_balance(self, addr):
+        with self.transaction_lock:
+            self._get_addr_balance_cache.pop(addr, None)
+            self._addr_balance_valid_heights.pop(addr, None)
+            if self._wallet_balance is not None:
+                self._dirty_balance_addrs.add(addr)
+
+    def _get_wallet_balance(self) -> Tuple[int, int, int]:
+        with self.lock, self.transaction_lock:
+            if self._wallet_balance is None:
+                self._wallet_balance = [0, 0, 0]
+                self._wallet_balance_addrs = {}
+                self._dirty_balance_addrs = set(self.db.get_history())
+            for addr in self._dirty_balance_addrs:
+                old = self._wallet_balance_addrs.pop(addr, (0, 0, 0))
+                new = self.get_addr_balance(addr) if self.db.is_addr_in_history(addr) else (0, 0, 0)
+                if any(new):
+                    self._wallet_balance_addrs[addr] = new
+                for i in range(3):
+                    self._wallet_balance[i] += new[i] - old[i]
+            self._dirty_balance_addrs.clear()
+            return tuple(self._wallet_balance)
+
     def _mark_address_history_changed(self, addr: str) -> None:
         # history for this address changed, wake up coroutines:
         self._address_history_changed_events[addr].set()
@@ -501,27 +853,37 @@ class AddressSynchronizer(Logger):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
                     self.db.remove_verified_tx(tx_hash)
+                self._on_tx_height_changed(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
                 # tx will be verified only if height > 0
                 self.unverified_tx[tx_hash] = tx_height
+            self._on_tx_height_changed(tx_hash)
+            if self.verifier:
+                self.verifier.add_unverified_tx(tx_hash, tx_height)
 
     def remove_unverified_tx(self, tx_hash, tx_height):
         with self.lock:
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._on_tx_height_changed(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+            self._on_tx_height_changed(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
+    def get_unverified_tx_height(self, tx_hash) -> Optional[int]:
+        with self.lock:
+            return self.unverified_tx.get(tx_hash)
+
     def get_unverified_txs(self):
         '''Returns a map from tx hash to transaction height'''
         with self.lock:
@@ -548,6 +910,7 @@ class AddressSynchronizer(Logger):
                         # into unverified_tx with the old height, and if we get
                         # a status update, that will overwrite it.
                         self.unverified_tx[tx_hash] = tx_height
+                        self._on_tx_height_changed(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -693,22 +1056,9 @@ class AddressSynchronizer(Logger):
         return received, sent
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
         out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out[txo] = x
+        for x in self.get_utxos([address]):
+            out[x['prevout_hash'] + ':%d' % x['prevout_n']] = x
         return out
 
     # return the total amount ever received by an address
@@ -721,67 +1071,98 @@ class AddressSynchronizer(Logger):
         """Return the balance of a bitcoin address:
         confirmed and matured, unconfirmed, unmatured
         """
-        if not excluded_coins:  # cache is only used if there are no excluded_coins
-            cached_value = self._get_addr_balance_cache.get(address)
-            if cached_value:
-                return cached_value
-        if excluded_coins is None:
-            excluded_coins = set()
-        assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        local_height = self.get_local_height()
-        for txo, (tx_height, v, is_cb) in received.items():
-            if txo in excluded_coins:
-                continue
-            if is_cb and tx_height + COINBASE_MATURITY > local_height:
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
+        with self.lock, self.transaction_lock:
+            if not excluded_coins:  # cache is only used if there are no excluded_coins
+                cached_value = self._get_addr_balance_cache.get(address)
+                if cached_value:
+                    return cached_value
+            if excluded_coins is None:
+                excluded_coins = set()
+            assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
+            received, sent = self.get_addr_io(address)
+            c = u = x = 0
+            local_height = self.get_local_height()
+            # range of local heights for which coinbase outputs keep their maturity
+            min_height, max_height = 0, float('inf')
+            has_coinbase = False
+            for txo, (tx_height, v, is_cb) in received.items():
+                if txo in excluded_coins:
+                    continue
+                if is_cb:
+                    has_coinbase = True
+                    if tx_height + COINBASE_MATURITY > local_height:
+                        max_height = min(max_height, tx_height + COINBASE_MATURITY)
+                    else:
+                        min_height = max(min_height, tx_height + COINBASE_MATURITY)
+                if is_cb and tx_height + COINBASE_MATURITY > local_height:
+                    x += v
+                elif tx_height > 0:
+                    c += v
                 else:
-                    u -= v
-        result = c, u, x
-        # cache result.
-        if not excluded_coins:
-            # Cache needs to be invalidated if a transaction is added to/
-            # removed from history; or on new blocks (maturity...)
-            self._get_addr_balance_cache[address] = result
-        return result
+                    u += v
+                if txo in sent:
+                    if sent[txo] > 0:
+                        c -= v
+                    else:
+                        u -= v
+            result = c, u, x
+            # cache result.
+            if not excluded_coins:
+                # Cache needs to be invalidated if a transaction of the address
+                # is added/removed or changes height; or on new blocks, if the
+                # maturity of a coinbase output changes
+                self._get_addr_balance_cache[address] = result
+                if has_coinbase:
+                    self._addr_balance_valid_heights[address] = (min_height, max_height)
+            return result
 
     @with_local_height_cached
     def get_utxos(self, domain=None, *, excluded_addresses=None,
                   mature_only: bool = False, confirmed_only: bool = False, nonlocal_only: bool = False):
+        if confirmed_only:
+            statuses = (UTXOIndex.CONFIRMED,)
+        elif nonlocal_only:
+            statuses = (UTXOIndex.CONFIRMED, UTXOIndex.UNCONFIRMED)
+        else:
+            statuses = (UTXOIndex.CONFIRMED, UTXOIndex.UNCONFIRMED, UTXOIndex.LOCAL)
+        if domain is not None:
+            domain = set(domain)
+            if excluded_addresses:
+                domain -= set(excluded_addresses)
+        excluded_addresses = set(excluded_addresses or ())
+        local_height = self.get_local_height()
         coins = []
-        if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
-        if excluded_addresses:
-            domain = set(domain) - set(excluded_addresses)
-        for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for x in utxos.values():
-                if confirmed_only and x['height'] <= 0:
-                    continue
-                if nonlocal_only and x['height'] == TX_HEIGHT_LOCAL:
+        with self.lock, self.transaction_lock:
+            index = self._get_utxo_index()
+            immature = set()
+            if mature_only:
+                for outpoint in index.get_coinbase_coins():
+                    if index.get_height(outpoint[0]) + COINBASE_MATURITY > local_height:
+                        immature.add(outpoint)
+            for outpoint in index.get_unspent(domain, statuses):
+                if outpoint in immature:
                     continue
-                if mature_only and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
+                prevout_hash, prevout_n = outpoint
+                address, value, is_cb = index.get(outpoint)
+                if domain is None and address in excluded_addresses:
                     continue
-                coins.append(x)
-                continue
+                coins.append({
+                    'address': address,
+                    'value': value,
+                    'prevout_n': prevout_n,
+                    'prevout_hash': prevout_hash,
+                    'height': index.get_height(prevout_hash),
+                    'coinbase': is_cb,
+                })
         return coins
 
     def get_balance(self, domain=None, *, excluded_addresses: Set[str] = None,
                     excluded_coins: Set[str] = None) -> Tuple[int, int, int]:
-        if domain is None:
-            domain = self.get_addresses()
         if excluded_addresses is None:
             excluded_addresses = set()
         assert isinstance(excluded_addresses, set), f"excluded_addresses should be set, not {type(excluded_addresses)}"
+        if domain is None:
+            return self._get_wallet_balance_excluding(excluded_addresses, excluded_coins)
         domain = set(domain) - excluded_addresses
         cc = uu = xx = 0
         for addr in domain:
@@ -791,6 +1172,31 @@ class AddressSynchronizer(Logger):
             xx += x
         return cc, uu, xx
 
+    @with_local_height_cached
+    def _get_wallet_balance_excluding(self, excluded_addresses: Set[str],
+                                      excluded_coins: Optional[Set[str]]) -> Tuple[int, int, int]:
+        with self.lock, self.transaction_lock:
+            cc, uu, xx = self._get_wallet_balance()
+            # addresses whose balance is changed by excluded_coins
+            coin_addrs = set()
+            if excluded_coins:
+                utxo_index = self._get_utxo_index()
+                for ser in excluded_coins:
+                    item = utxo_index.get(self._outpoint_from_ser(ser))
+                    if item:
+                        coin_addrs.add(item[0])
+            for addr in excluded_addresses | coin_addrs:
+                if not self.db.is_addr_in_history(addr):
+                    continue
+                c, u, x = self.get_addr_balance(addr)
+                if addr not in excluded_addresses:
+                    c2, u2, x2 = self.get_addr_balance(addr, excluded_coins=excluded_coins)
+                    c, u, x = c - c2, u - u2, x - x2
+                cc -= c
+                uu -= u
+                xx -= x
+            return cc, uu, xx
+
     def is_used(self, address):
         h = self.db.get_addr_history(address)
         return len(h) != 0
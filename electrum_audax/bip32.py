@@ -19,12 +19,12 @@ UINT32_MAX = (1 << 32) - 1
 
 
 def protect_against_invalid_ecpoint(func):
-    def func_wrapper(*args):
+    def func_wrapper(*args, **kwargs):
         child_index = args[-1]
         while True:
             is_prime = child_index & BIP32_PRIME
             try:
-                return func(*args[:-1], child_index=child_index)
+                return func(*args[:-1], child_index=child_index, **kwargs)
             except ecc.InvalidECPointException:
                 _logger.warning('bip32 protect_against_invalid_ecpoint: skipping index')
                 child_index += 1
@@ -34,28 +34,34 @@ def protect_against_invalid_ecpoint(func):
 
 
 @protect_against_invalid_ecpoint
-def CKD_priv(parent_privkey: bytes, parent_chaincode: bytes, child_index: int) -> Tuple[bytes, bytes]:
+def CKD_priv(parent_privkey: bytes, parent_chaincode: bytes, child_index: int, *,
+             parent_pubkey: bytes = None) -> Tuple[bytes, bytes]:
     """Child private key derivation function (from master private key)
     If n is hardened (i.e. the 32nd bit is set), the resulting private key's
     corresponding public key can NOT be determined without the master private key.
     However, if n is not hardened, the resulting private key's corresponding
     public key can be determined without the master private key.
+    The compressed parent_pubkey can be passed in when deriving many
+    children of the same parent, to not compute it again for each child.
     """
     if child_index < 0: raise ValueError('the bip32 index needs to be non-negative')
     is_hardened_child = bool(child_index & BIP32_PRIME)
     return _CKD_priv(parent_privkey=parent_privkey,
                      parent_chaincode=parent_chaincode,
                      child_index=bfh(rev_hex(int_to_hex(child_index, 4))),
-                     is_hardened_child=is_hardened_child)
+                     is_hardened_child=is_hardened_child,
+                     parent_pubkey=parent_pubkey)
 
 
 def _CKD_priv(parent_privkey: bytes, parent_chaincode: bytes,
-              child_index: bytes, is_hardened_child: bool) -> Tuple[bytes, bytes]:
-    try:
-        keypair = ecc.ECPrivkey(parent_privkey)
-    except ecc.InvalidECPointException as e:
-        raise BitcoinException('Impossible xprv (not within curve order)') from e
-    parent_pubkey = keypair.get_public_key_bytes(compressed=True)
+              child_index: bytes, is_hardened_child: bool,
+              parent_pubkey: bytes = None) -> Tuple[bytes, bytes]:
+    if parent_pubkey is None:
+        try:
+            keypair = ecc.ECPrivkey(parent_privkey)
+        except ecc.InvalidECPointException as e:
+            raise BitcoinException('Impossible xprv (not within curve order)') from e
+        parent_pubkey = keypair.get_public_key_bytes(compressed=True)
     if is_hardened_child:
         data = bytes([0]) + parent_privkey + child_index
     else:
@@ -21,8 +21,12 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import mmap
+import zlib
+import hashlib
 import threading
-from typing import Optional, Dict, Mapping, Sequence
+from concurrent.futures import Executor
+from typing import Optional, Dict, Mapping, Sequence, List, Tuple
 from .crypto import sha256d
 from . import util
 from .bitcoin import hash_encode, int_to_hex, rev_hex
@@ -35,7 +39,13 @@ from .logging import get_logger, Logger
 _logger = get_logger(__name__)
 
 HEADER_SIZE = 80  # bytes
+HASH_SIZE = 32  # bytes
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
+# only farm out header hashing to an executor if there are at least this many chunks
+MIN_CHUNKS_FOR_EXECUTOR = 4
+
+HEADERS_SNAPSHOT_MAGIC = b'AUDXHDRS'
+HEADERS_SNAPSHOT_VERSION = 1
 
 
 class MissingHeader(Exception):
@@ -44,6 +54,9 @@ class MissingHeader(Exception):
 class InvalidHeader(Exception):
     pass
 
+class InvalidHeadersSnapshot(Exception):
+    pass
+
 def serialize_header(header_dict: dict) -> str:
     s = int_to_hex(header_dict['version'], 4) \
         + rev_hex(header_dict['prev_block_hash']) \
@@ -81,6 +94,105 @@ def hash_raw_header(header: str) -> str:
     return hash_encode(sha256d(bfh(header)))
 
 
+def hash_raw_headers(data: bytes) -> bytes:
+    """Returns the concatenated sha256d hashes of the headers
+    serialized back-to-back in data (little-endian, like in the headers).
+    Module-level so that it can be sent to a process pool.
+    """
+    sha256 = hashlib.sha256
+    return b''.join(sha256(sha256(data[i:i+HEADER_SIZE]).digest()).digest()
+                    for i in range(0, len(data) - HEADER_SIZE + 1, HEADER_SIZE))
+
+
+def hash_raw_header_chunks(chunks: Sequence[bytes], executor: Executor = None) -> List[bytes]:
+    if executor is None or len(chunks) < MIN_CHUNKS_FOR_EXECUTOR:
+        return [hash_raw_headers(chunk) for chunk in chunks]
+    return list(executor.map(hash_raw_headers, chunks))
+
+
+def write_headers_snapshot(path: str, headers: bytes) -> None:
+    """Writes the serialized headers starting at genesis into a snapshot file.
+    Only whole chunks are stored. The prev_block_hash field of each header is
+    dropped, as it is recomputed (and thereby checked) on import.
+    Format: magic | version (1 byte) | number of headers (4 bytes, LE) |
+            sha256 of the uncompressed payload | zlib(payload)
+    """
+    num_headers = len(headers) // HEADER_SIZE // 2016 * 2016
+    payload = b''.join(headers[i:i+4] + headers[i+36:i+HEADER_SIZE]
+                       for i in range(0, num_headers * HEADER_SIZE, HEADER_SIZE))
+    with open(path, 'wb') as f:
+        f.write(HEADERS_SNAPSHOT_MAGIC)
+        f.write(bytes([HEADERS_SNAPSHOT_VERSION]))
+        f.write(num_headers.to_bytes(4, byteorder='little'))
+        f.write(hashlib.sha256(payload).digest())
+        f.write(zlib.compress(payload, 9))
+
+
+def read_headers_snapshot(path: str) -> bytes:
+    """Reads a snapshot file written by write_headers_snapshot, and returns
+    the serialized headers, after verifying that they connect to genesis
+    and match our checkpoints.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    prefix_len = len(HEADERS_SNAPSHOT_MAGIC)
+    if data[:prefix_len] != HEADERS_SNAPSHOT_MAGIC:
+        raise InvalidHeadersSnapshot('not a headers snapshot')
+    if len(data) < prefix_len + 37:
+        raise InvalidHeadersSnapshot('snapshot is truncated')
+    if data[prefix_len] != HEADERS_SNAPSHOT_VERSION:
+        raise InvalidHeadersSnapshot(f'unsupported snapshot version: {data[prefix_len]}')
+    num_headers = int.from_bytes(data[prefix_len+1:prefix_len+5], byteorder='little')
+    payload_hash = data[prefix_len+5:prefix_len+37]
+    try:
+        payload = zlib.decompress(data[prefix_len+37:])
+    except zlib.error as e:
+        raise InvalidHeadersSnapshot(f'cannot decompress snapshot: {repr(e)}') from e
+    if hashlib.sha256(payload).digest() != payload_hash or len(payload) != num_headers * 48:
+        raise InvalidHeadersSnapshot('snapshot is corrupted')
+    if num_headers % 2016 != 0 or num_headers > len(constants.net.CHECKPOINTS) * 2016:
+        raise InvalidHeadersSnapshot(f'snapshot has to end at a checkpoint: {num_headers} headers')
+    return _rebuild_and_verify_snapshot_headers(payload, num_headers)
+
+
+def _rebuild_and_verify_snapshot_headers(payload: bytes, num_headers: int) -> bytes:
+    sha256 = hashlib.sha256
+    checkpoints = constants.net.CHECKPOINTS
+    headers = []
+    prev_hash = bytes(HASH_SIZE)
+    for height in range(num_headers):
+        item = payload[height*48 : (height+1)*48]
+        header = item[:4] + prev_hash + item[4:]
+        prev_hash = sha256(sha256(header).digest()).digest()
+        headers.append(header)
+        if height == 0:
+            if hash_encode(prev_hash) != constants.net.GENESIS:
+                raise InvalidHeadersSnapshot('snapshot does not start at genesis')
+        elif (height+1) % 2016 == 0:
+            if hash_encode(prev_hash) != checkpoints[height // 2016][0]:
+                raise InvalidHeadersSnapshot(f'snapshot does not match checkpoint at height {height}')
+    return b''.join(headers)
+
+
+def read_bundled_headers_snapshot() -> bytes:
+    """Returns the verified headers from the snapshot shipped with the
+    application, or b'' if there is none, or it is not usable.
+    """
+    filename = constants.net.HEADERS_SNAPSHOT
+    if not filename:
+        return b''
+    path = os.path.join(os.path.dirname(__file__), filename)
+    if not os.path.exists(path):
+        return b''
+    try:
+        headers = read_headers_snapshot(path)
+    except (InvalidHeadersSnapshot, OSError) as e:
+        _logger.info(f"[blockchain] not using headers snapshot {filename}: {repr(e)}")
+        return b''
+    _logger.info(f"[blockchain] loaded {len(headers) // HEADER_SIZE} headers from snapshot")
+    return headers
+
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
 blockchains = {}  # type: Dict[str, Blockchain]
@@ -88,6 +200,7 @@ blockchains_lock = threading.RLock()
 
 
 def read_blockchains(config: 'SimpleConfig'):
+    load_chainwork_cache(os.path.join(util.get_headers_dir(config), 'blockchain_chainwork'))
     best_chain = Blockchain(config=config,
                             forkpoint=0,
                             parent=None,
@@ -99,6 +212,7 @@ def read_blockchains(config: 'SimpleConfig'):
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
+            best_chain.invalidate_cached_headers()
             os.unlink(best_chain.path())
             best_chain.update_size()
     # forks
@@ -136,9 +250,11 @@ def read_blockchains(config: 'SimpleConfig'):
         # consistency checks
         h = b.read_header(b.forkpoint)
         if first_hash != hash_header(h):
+            b.invalidate_cached_headers()
             delete_chain(filename, "incorrect first hash for chain")
             return
         if not b.parent.can_connect(h, check_height=False):
+            b.invalidate_cached_headers()
             delete_chain(filename, "cannot connect chain to parent")
             return
         chain_id = b.get_id()
@@ -147,6 +263,8 @@ def read_blockchains(config: 'SimpleConfig'):
 
     for filename in l:
         instantiate_chain(filename)
+    # chains might have been deleted or truncated since the cache was written
+    prune_chainwork_cache(force=True)
 
 
 def get_best_chain() -> 'Blockchain':
@@ -156,6 +274,104 @@ def get_best_chain() -> 'Blockchain':
 _CHAINWORK_CACHE = {
     "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
 }  # type: Dict[str, int]
+# block hash -> height, for the (real) blocks in _CHAINWORK_CACHE
+_CHAINWORK_CACHE_HEIGHTS = {}  # type: Dict[str, int]
+# _CHAINWORK_CACHE is persisted next to the headers file, see load_chainwork_cache
+_chainwork_cache_path = None  # type: Optional[str]
+_chainwork_cache_lock = threading.RLock()
+# set when a cached block might have been truncated away from all chains
+_chainwork_cache_dirty = False
+# record: block hash (32 bytes, as in headers), height (4 bytes LE), chainwork (32 bytes BE)
+CHAINWORK_RECORD_SIZE = 68
+
+
+def _serialize_chainwork_record(block_hash: str, height: int, chainwork: int) -> bytes:
+    return bfh(block_hash)[::-1] + height.to_bytes(4, 'little') + chainwork.to_bytes(32, 'big')
+
+
+def _set_chainwork_cache(block_hash: str, height: int, chainwork: int) -> None:
+    with _chainwork_cache_lock:
+        _CHAINWORK_CACHE[block_hash] = chainwork
+        _CHAINWORK_CACHE_HEIGHTS[block_hash] = height
+
+
+def _append_chainwork_records(entries: Sequence[Tuple[str, int, int]]) -> None:
+    if not entries:
+        return
+    with _chainwork_cache_lock:
+        if _chainwork_cache_path is None:
+            return
+        with open(_chainwork_cache_path, 'ab') as f:
+            f.write(b''.join(_serialize_chainwork_record(*entry) for entry in entries))
+
+
+def _write_chainwork_cache() -> None:
+    with _chainwork_cache_lock:
+        if _chainwork_cache_path is None:
+            return
+        tmp_path = _chainwork_cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(_serialize_chainwork_record(block_hash, height, _CHAINWORK_CACHE[block_hash])
+                             for block_hash, height in sorted(_CHAINWORK_CACHE_HEIGHTS.items(),
+                                                              key=lambda x: x[1])))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, _chainwork_cache_path)
+
+
+def load_chainwork_cache(path: str) -> None:
+    """Loads the chainwork cache persisted at path, and keeps
+    appending newly computed entries to it from then on.
+    """
+    global _chainwork_cache_path
+    with _chainwork_cache_lock:
+        _chainwork_cache_path = path
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        num_records = len(data) // CHAINWORK_RECORD_SIZE
+        for i in range(num_records):
+            record = data[i * CHAINWORK_RECORD_SIZE:(i + 1) * CHAINWORK_RECORD_SIZE]
+            _set_chainwork_cache(block_hash=hash_encode(record[:32]),
+                                 height=int.from_bytes(record[32:36], 'little'),
+                                 chainwork=int.from_bytes(record[36:], 'big'))
+        if len(data) != num_records * CHAINWORK_RECORD_SIZE:
+            # partial record left by an interrupted append
+            _write_chainwork_cache()
+
+
+def prune_chainwork_cache(force: bool = False) -> None:
+    """Drops the cached chainwork of blocks that are no longer part of
+    any chain (e.g. after a fork was truncated), in memory and on disk.
+    Unless force is set, this is a no-op if no cached block was truncated.
+    """
+    global _chainwork_cache_dirty
+    with _chainwork_cache_lock:
+        if not _chainwork_cache_dirty and not force:
+            return
+        _chainwork_cache_dirty = False
+        cached = list(_CHAINWORK_CACHE_HEIGHTS.items())
+    # note: chain locks must not be taken while holding _chainwork_cache_lock
+    with blockchains_lock:
+        chains = list(blockchains.values())
+    stale = [block_hash for block_hash, height in cached
+             if not any(chain.check_hash(height, block_hash) for chain in chains)]
+    with _chainwork_cache_lock:
+        for block_hash in stale:
+            _CHAINWORK_CACHE.pop(block_hash, None)
+            _CHAINWORK_CACHE_HEIGHTS.pop(block_hash, None)
+        if stale:
+            _logger.info(f"[blockchain] pruned {len(stale)} chainwork cache entries")
+            _write_chainwork_cache()
+
+
+def _mark_chainwork_cache_truncated(from_height: int, to_height: int) -> None:
+    global _chainwork_cache_dirty
+    with _chainwork_cache_lock:
+        if any(from_height <= height <= to_height for height in _CHAINWORK_CACHE_HEIGHTS.values()):
+            _chainwork_cache_dirty = True
 
 
 class Blockchain(Logger):
@@ -177,6 +393,11 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        # read-only mmap of our headers file; (re)opened lazily, closed on writes
+        self._mmap = None  # type: Optional[mmap.mmap]
+        # raw (little-endian) header hashes indexed by (height - forkpoint);
+        # a slot of all zeroes means "not computed yet"
+        self._hashes = bytearray()
         self.update_size()
 
     def with_lock(func):
@@ -278,6 +499,42 @@ class Blockchain(Logger):
     def update_size(self) -> None:
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        self._close_mmap()
+        self._resize_hash_index()
+
+    def _close_mmap(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _get_mmap(self) -> Optional[mmap.mmap]:
+        if self._mmap is None and self._size > 0:
+            name = self.path()
+            self.assert_headers_file_available(name)
+            with open(name, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _resize_hash_index(self) -> None:
+        n = self._size * HASH_SIZE
+        if len(self._hashes) > n:
+            del self._hashes[n:]
+        else:
+            self._hashes.extend(bytes(n - len(self._hashes)))
+
+    def _invalidate_hash_index(self, offset: int, length: int) -> None:
+        start = offset // HEADER_SIZE * HASH_SIZE
+        end = min(len(self._hashes), (offset + length + HEADER_SIZE - 1) // HEADER_SIZE * HASH_SIZE)
+        if end > start:
+            self._hashes[start:end] = bytes(end - start)
+
+    @with_lock
+    def invalidate_cached_headers(self) -> None:
+        """Drop the mmap and hash index. Must be called before
+        the headers file is modified by anything other than self.write."""
+        self._close_mmap()
+        self._hashes = bytearray()
+        self._resize_hash_index()
 
     @classmethod
     def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
@@ -286,31 +543,49 @@ class Blockchain(Logger):
             raise Exception("hash mismatches with expected: {} vs {}".format(expected_header_hash, _hash))
         if prev_hash != header.get('prev_block_hash'):
             raise Exception("prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash')))
+        cls.verify_header_pow(header.get('bits'), bfh(_hash)[::-1], target)
+
+    @classmethod
+    def verify_header_pow(cls, header_bits: int, raw_hash: bytes, target: int) -> None:
         if constants.net.TESTNET:
             return
         return
         bits = cls.target_to_bits(target)
-        if bits != header.get('bits'):
-            raise Exception("bits mismatch: %s vs %s" % (bits, header.get('bits')))
-        block_hash_as_num = int.from_bytes(bfh(_hash), byteorder='big')
+        if bits != header_bits:
+            raise Exception("bits mismatch: %s vs %s" % (bits, header_bits))
+        block_hash_as_num = int.from_bytes(raw_hash, byteorder='little')
         if block_hash_as_num > target:
             raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
 
-    def verify_chunk(self, index: int, data: bytes) -> None:
+    def verify_chunk(self, index: int, data: bytes, header_hashes: bytes=None) -> None:
+        """Verifies the headers in data without deserializing them.
+        header_hashes, if given, must be hash_raw_headers(data).
+        """
         num = len(data) // HEADER_SIZE
         start_height = index * 2016
-        prev_hash = self.get_hash(start_height - 1)
+        prev_raw_hash = bfh(self.get_hash(start_height - 1))[::-1]
         target = self.get_target(index-1)
+        if header_hashes is None:
+            header_hashes = hash_raw_headers(data)
         for i in range(num):
             height = start_height + i
-            try:
-                expected_header_hash = self.get_hash(height)
-            except MissingHeader:
-                expected_header_hash = None
             raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-            prev_hash = hash_header(header)
+            raw_hash = header_hashes[i*HASH_SIZE : (i+1)*HASH_SIZE]
+            expected_raw_hash = self._get_expected_raw_hash(height)
+            if expected_raw_hash is not None and expected_raw_hash != raw_hash:
+                raise Exception("hash mismatches with expected: {} vs {}"
+                                .format(hash_encode(expected_raw_hash), hash_encode(raw_hash)))
+            if prev_raw_hash != raw_header[4:36]:
+                raise Exception("prev hash mismatch: %s vs %s"
+                                % (hash_encode(prev_raw_hash), hash_encode(raw_header[4:36])))
+            self.verify_header_pow(int.from_bytes(raw_header[72:76], byteorder='little'), raw_hash, target)
+            prev_raw_hash = raw_hash
+
+    def _get_expected_raw_hash(self, height: int) -> Optional[bytes]:
+        """Like get_hash, but returns None instead of raising MissingHeader."""
+        if height == 0 or self.is_height_checkpoint(height):
+            return bfh(self.get_hash(height))[::-1]
+        return self.get_raw_hash(height)
 
     @with_lock
     def path(self):
@@ -339,11 +614,13 @@ class Blockchain(Logger):
         delta_bytes = delta_height * HEADER_SIZE
         # if this chunk contains our forkpoint, only save the part after forkpoint
         # (the part before is the responsibility of the parent)
+        last_height = index * 2016 + len(chunk) // HEADER_SIZE - 1
         if delta_bytes < 0:
             chunk = chunk[-delta_bytes:]
             delta_bytes = 0
         truncate = not chunk_within_checkpoint_region
         self.write(chunk, delta_bytes, truncate)
+        self._extend_chainwork_cache(last_height)
         self.swap_with_parent()
 
     def swap_with_parent(self) -> None:
@@ -362,6 +639,7 @@ class Blockchain(Logger):
                 for old_sibling in old_parent.get_direct_children():
                     if self.check_hash(old_sibling.forkpoint - 1, old_sibling._prev_hash):
                         old_sibling.parent = self
+            prune_chainwork_cache()
 
     def _swap_with_parent(self) -> bool:
         """Check if this chain became stronger than its parent, and swap
@@ -394,6 +672,7 @@ class Blockchain(Logger):
         self.write(parent_data, 0)
         parent.write(my_data, (forkpoint - parent.forkpoint)*HEADER_SIZE)
         # swap parameters
+        self._hashes, parent._hashes = parent._hashes, self._hashes
         self.parent, parent.parent = parent.parent, self  # type: Optional[Blockchain], Optional[Blockchain]
         self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
         self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_header(bh2u(parent_data[:HEADER_SIZE]))
@@ -424,14 +703,19 @@ class Blockchain(Logger):
     def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
         filename = self.path()
         self.assert_headers_file_available(filename)
+        # the mmap must be released before the file can be truncated (on Windows)
+        self._close_mmap()
         with open(filename, 'rb+') as f:
             if truncate and offset != self._size * HEADER_SIZE:
+                _mark_chainwork_cache_truncated(self.forkpoint + offset // HEADER_SIZE, self.height())
                 f.seek(offset)
                 f.truncate()
+                del self._hashes[offset // HEADER_SIZE * HASH_SIZE:]
             f.seek(offset)
             f.write(data)
             f.flush()
             os.fsync(f.fileno())
+        self._invalidate_hash_index(offset, len(data))
         self.update_size()
 
     @with_lock
@@ -442,52 +726,79 @@ class Blockchain(Logger):
         assert delta == self.size(), (delta, self.size())
         assert len(data) == HEADER_SIZE
         self.write(data, delta*HEADER_SIZE)
+        self._extend_chainwork_cache(header.get('block_height'))
         self.swap_with_parent()
 
     @with_lock
-    def read_header(self, height: int) -> Optional[dict]:
+    def read_raw_header(self, height: int) -> Optional[bytes]:
         if height < 0:
             return
         if height < self.forkpoint:
-            return self.parent.read_header(height)
+            return self.parent.read_raw_header(height)
         if height > self.height():
             return
         delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
-            if len(h) < HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*HEADER_SIZE:
+        m = self._get_mmap()
+        h = m[delta * HEADER_SIZE : (delta + 1) * HEADER_SIZE]
+        if len(h) < HEADER_SIZE:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        if h == bytes(HEADER_SIZE):
+            return None
+        return h
+
+    def read_header(self, height: int) -> Optional[dict]:
+        h = self.read_raw_header(height)
+        if h is None:
             return None
         return deserialize_header(h, height)
 
+    @with_lock
+    def get_raw_hash(self, height: int) -> Optional[bytes]:
+        """Returns sha256d of the header at given height (little-endian, as
+        in the header itself), or None if we do not have that header.
+        """
+        if height < 0:
+            return
+        if height < self.forkpoint:
+            return self.parent.get_raw_hash(height)
+        if height > self.height():
+            return
+        pos = (height - self.forkpoint) * HASH_SIZE
+        h = bytes(self._hashes[pos : pos + HASH_SIZE])
+        if h != bytes(HASH_SIZE):
+            return h
+        raw_header = self.read_raw_header(height)
+        if raw_header is None:
+            return None
+        h = sha256d(raw_header)
+        self._hashes[pos : pos + HASH_SIZE] = h
+        return h
+
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
         height = self.height()
         return self.read_header(height)
 
-    def get_hash(self, height: int) -> str:
-        def is_height_checkpoint():
-            within_cp_range = height <= constants.net.max_checkpoint()
-            at_chunk_boundary = (height+1) % 2016 == 0
-            return within_cp_range and at_chunk_boundary
+    @classmethod
+    def is_height_checkpoint(cls, height: int) -> bool:
+        within_cp_range = height <= constants.net.max_checkpoint()
+        at_chunk_boundary = (height+1) % 2016 == 0
+        return within_cp_range and at_chunk_boundary
 
+    def get_hash(self, height: int) -> str:
         if height == -1:
             return '0000000000000000000000000000000000000000000000000000000000000000'
         elif height == 0:
             return constants.net.GENESIS
-        elif is_height_checkpoint():
+        elif self.is_height_checkpoint(height):
             index = height // 2016
             h, t = self.checkpoints[index]
             return h
         else:
-            header = self.read_header(height)
-            if header is None:
+            raw_hash = self.get_raw_hash(height)
+            if raw_hash is None:
                 raise MissingHeader(height)
-            return hash_header(header)
+            return hash_encode(raw_hash)
 
     def get_target(self, index: int) -> int:
         # compute target from chunk x, used in chunk x+1
@@ -558,17 +869,34 @@ class Blockchain(Logger):
             cached_height -= 2016
         assert cached_height >= -1, cached_height
         running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
-        while cached_height < last_retarget:
-            cached_height += 2016
-            work_in_single_header = self.chainwork_of_header_at_height(cached_height)
-            work_in_chunk = 2016 * work_in_single_header
-            running_total += work_in_chunk
-            _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
+        new_entries = []
+        try:
+            while cached_height < last_retarget:
+                cached_height += 2016
+                work_in_single_header = self.chainwork_of_header_at_height(cached_height)
+                work_in_chunk = 2016 * work_in_single_header
+                running_total += work_in_chunk
+                block_hash = self.get_hash(cached_height)
+                _set_chainwork_cache(block_hash, cached_height, running_total)
+                new_entries.append((block_hash, cached_height, running_total))
+        finally:
+            _append_chainwork_records(new_entries)
         cached_height += 2016
         work_in_single_header = self.chainwork_of_header_at_height(cached_height)
         work_in_last_partial_chunk = (height % 2016 + 1) * work_in_single_header
         return running_total + work_in_last_partial_chunk
 
+    def _extend_chainwork_cache(self, height: int) -> None:
+        """Caches the chainwork up to height if it is a retarget boundary,
+        so that the cache grows as headers are saved."""
+        if constants.net.TESTNET or (height + 1) % 2016 != 0:
+            return
+        try:
+            # the work of the next block only depends on the headers up to height
+            self.get_chainwork(height + 1)
+        except MissingHeader:
+            pass
+
     def can_connect(self, header: dict, check_height: bool=True) -> bool:
         if header is None:
             return False
@@ -604,6 +932,27 @@ class Blockchain(Logger):
             self.logger.info(f'verify_chunk idx {idx} failed: {repr(e)}')
             return False
 
+    def connect_chunks(self, chunks: Sequence[Tuple[int, str]], executor: Executor=None) -> int:
+        """Connects consecutive chunks, given as (index, hexdata) pairs, in order.
+        Header hashing is spread over executor (e.g. a process pool) if there are
+        enough chunks. Returns the number of chunks connected before the first failure.
+        """
+        try:
+            datas = [bfh(hexdata) for idx, hexdata in chunks]
+        except ValueError as e:
+            self.logger.info(f'connect_chunks failed: {repr(e)}')
+            return 0
+        hashes = hash_raw_header_chunks(datas, executor)
+        for i, (idx, hexdata) in enumerate(chunks):
+            assert idx >= 0, idx
+            try:
+                self.verify_chunk(idx, datas[i], hashes[i])
+                self.save_chunk(idx, datas[i])
+            except BaseException as e:
+                self.logger.info(f'verify_chunk idx {idx} failed: {repr(e)}')
+                return i
+        return len(chunks)
+
     def get_checkpoints(self):
         # for each chunk, store the hash of the last block and the target after the chunk
         cp = []
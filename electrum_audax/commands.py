@@ -96,6 +96,10 @@ def command(s):
                 raise Exception("wallet not loaded. Use 'electrum-audax daemon load_wallet'")
             if c.requires_password and password is None and wallet.has_password():
                 return {'error': 'Password required' }
+            if c.requires_wallet:
+                # e.g. two payto calls must not pick the same coins
+                with wallet.command_lock:
+                    return func(*args, **kwargs)
             return func(*args, **kwargs)
         return func_wrapper
     return decorator
@@ -226,6 +230,13 @@ class Commands:
         sh = bitcoin.address_to_scripthash(address)
         return self.network.run_from_another_thread(self.network.get_history_for_scripthash(sh))
 
+    @command('n')
+    def getaddresshistories(self, addresses):
+        """Return the transaction histories of a list of addresses, like
+        getaddresshistory. The server is queried for all of them at once.
+        """
+        return self._query_addresses(addresses, self.network.get_history_for_scripthash)
+
     @command('w')
     def listunspent(self):
         """List unspent outputs. Returns the list of unspent transaction
@@ -244,6 +255,13 @@ class Commands:
         sh = bitcoin.address_to_scripthash(address)
         return self.network.run_from_another_thread(self.network.listunspent_for_scripthash(sh))
 
+    @command('n')
+    def getaddressunspents(self, addresses):
+        """Return the UTXO lists of a list of addresses, like
+        getaddressunspent. The server is queried for all of them at once.
+        """
+        return self._query_addresses(addresses, self.network.listunspent_for_scripthash)
+
     @command('')
     def serialize(self, jsontx):
         """Create a transaction from json inputs.
@@ -367,9 +385,27 @@ class Commands:
         """
         sh = bitcoin.address_to_scripthash(address)
         out = self.network.run_from_another_thread(self.network.get_balance_for_scripthash(sh))
-        out["confirmed"] =  str(Decimal(out["confirmed"])/COIN)
-        out["unconfirmed"] =  str(Decimal(out["unconfirmed"])/COIN)
-        return out
+        return self._format_address_balance(out)
+
+    @command('n')
+    def getaddressbalances(self, addresses):
+        """Return the balances of a list of addresses, like
+        getaddressbalance. The server is queried for all of them at once.
+        """
+        balances = self._query_addresses(addresses, self.network.get_balance_for_scripthash)
+        return {addr: self._format_address_balance(out) for addr, out in balances.items()}
+
+    def _format_address_balance(self, out):
+        # out may be shared with concurrent requests, see Network.coalesce_requests
+        return dict(out, confirmed=str(Decimal(out["confirmed"])/COIN),
+                    unconfirmed=str(Decimal(out["unconfirmed"])/COIN))
+
+    def _query_addresses(self, addresses, request):
+        """Returns a dict address -> request(scripthash of address)."""
+        addresses = list(dict.fromkeys(addresses))
+        shs = [bitcoin.address_to_scripthash(addr) for addr in addresses]
+        results = self.network.run_from_another_thread(self.network.for_scripthashes(request, shs))
+        return dict(zip(addresses, results))
 
     @command('n')
     def getmerkle(self, txid, height):
@@ -425,11 +461,11 @@ class Commands:
             out = "Error: " + str(e)
         return out
 
-    def _resolver(self, x):
+    def _resolver(self, x, nocheck):
         if x is None:
             return None
         out = self.wallet.contacts.resolve(x)
-        if out.get('type') == 'openalias' and self.nocheck is False and out.get('validated') is False:
+        if out.get('type') == 'openalias' and nocheck is False and out.get('validated') is False:
             raise Exception('cannot verify alias', x)
         return out['address']
 
@@ -441,8 +477,7 @@ class Commands:
         from .wallet import sweep
         tx_fee = satoshis(fee)
         privkeys = privkey.split()
-        self.nocheck = nocheck
-        #dest = self._resolver(destination)
+        #dest = self._resolver(destination, nocheck)
         tx = sweep(privkeys, self.network, self.config, destination, tx_fee, imax)
         return tx.as_dict() if tx else None
 
@@ -461,12 +496,11 @@ class Commands:
         return ecc.verify_message_with_address(address, sig, message)
 
     def _mktx(self, outputs, fee, change_addr, domain, nocheck, unsigned, rbf, password, locktime=None):
-        self.nocheck = nocheck
-        change_addr = self._resolver(change_addr)
-        domain = None if domain is None else map(self._resolver, domain)
+        change_addr = self._resolver(change_addr, nocheck)
+        domain = None if domain is None else [self._resolver(x, nocheck) for x in domain]
         final_outputs = []
         for address, amount in outputs:
-            address = self._resolver(address)
+            address = self._resolver(address, nocheck)
             amount = satoshis(amount)
             final_outputs.append(TxOutput(TYPE_ADDRESS, address, amount))
 
@@ -500,13 +534,16 @@ class Commands:
 
     @command('w')
     def history(self, year=None, show_addresses=False, show_fiat=False, show_fees=False,
-                from_height=None, to_height=None):
-        """Wallet history. Returns the transaction history of your wallet."""
+                from_height=None, to_height=None, cursor=None, limit=None):
+        """Wallet history. Returns the transaction history of your wallet.
+        With --limit, returns a page of transactions and the cursor of the next page."""
         kwargs = {
             'show_addresses': show_addresses,
             'show_fees': show_fees,
             'from_height': from_height,
             'to_height': to_height,
+            'cursor': cursor,
+            'limit': limit,
         }
         if year:
             import time
@@ -856,6 +893,7 @@ param_descriptions = {
     'privkey': 'Private key. Type \'?\' to get a prompt.',
     'destination': 'Audax address, contact or alias',
     'address': 'Audax address',
+    'addresses': 'List of Audax addresses',
     'seed': 'Seed phrase',
     'txid': 'Transaction ID',
     'pos': 'Position',
@@ -914,6 +952,8 @@ command_options = {
     'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position"),
     'from_height': (None, "Only show transactions that confirmed after given block height"),
     'to_height':   (None, "Only show transactions that confirmed before given block height"),
+    'cursor':      (None, "Position in the history to start from, as returned by a previous call"),
+    'limit':       (None, "Maximum number of transactions to return"),
 }
 
 
@@ -927,11 +967,14 @@ arg_types = {
     'year': int,
     'from_height': int,
     'to_height': int,
+    'cursor': int,
+    'limit': int,
     'tx': tx_from_str,
     'pubkeys': json_loads,
     'jsontx': json_loads,
     'inputs': json_loads,
     'outputs': json_loads,
+    'addresses': json_loads,
     'fee': lambda x: str(Decimal(x)) if x is not None else None,
     'amount': lambda x: str(Decimal(x)) if x != '!' else '!',
     'locktime': int,
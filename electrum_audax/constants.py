@@ -56,6 +56,7 @@ class BitcoinMainnet(AbstractNet):
     DEFAULT_PORTS = {'t': '50001', 's': '50002'}
     DEFAULT_SERVERS = read_json('servers.json', {})
     CHECKPOINTS = read_json('checkpoints.json', [])
+    HEADERS_SNAPSHOT = 'headers_snapshot.bin'
 
     XPRV_HEADERS = {
         'standard':    0x0221312b,  # xprv
@@ -87,6 +88,7 @@ class BitcoinTestnet(AbstractNet):
     DEFAULT_PORTS = {'t': '51001', 's': '51002'}
     DEFAULT_SERVERS = read_json('servers_testnet.json', {})
     CHECKPOINTS = read_json('checkpoints_testnet.json', [])
+    HEADERS_SNAPSHOT = 'headers_snapshot_testnet.bin'
 
     XPRV_HEADERS = {
         'standard':    0x04358394,  # tprv
@@ -113,6 +115,7 @@ class BitcoinRegtest(BitcoinTestnet):
     GENESIS = "000008467c3a9c587533dea06ad9380cded3ed32f9742a6c0c1aebc21bf2bc9b"
     DEFAULT_SERVERS = read_json('servers_regtest.json', {})
     CHECKPOINTS = []
+    HEADERS_SNAPSHOT = None
 
 
 # don't import net directly, import the module instead (so that net is singleton)
@@ -33,9 +33,11 @@ from typing import Dict, Optional, Tuple
 
 import jsonrpclib
 
-from .jsonrpc import VerifyingJSONRPCServer
+from .jsonrpc import AsyncJSONRPCServer
 from .version import ELECTRUM_VERSION
 from .network import Network
+from .tx_store import TxStore
+from .synchronizer import SubscriptionMultiplexer
 from .util import (json_decode, DaemonThread, to_string,
                    create_and_start_event_loop, profiler, standardize_path)
 from .wallet import Wallet, Abstract_Wallet
@@ -137,12 +139,17 @@ class Daemon(DaemonThread):
         else:
             self.network = Network(config)
             self.network._loop_thread = self._loop_thread
+            if config.get('tx_store', False):
+                self.network.tx_store = TxStore(os.path.join(config.path, 'tx_store'))
+            self.network.subscription_multiplexer = SubscriptionMultiplexer(self.network)
         self.fx = FxThread(config, self.network)
         if self.network:
             self.network.start([self.fx.run])
         self.gui = None
         # path -> wallet;   make sure path is standardized.
         self.wallets = {}  # type: Dict[str, Abstract_Wallet]
+        # commands are run concurrently, see AsyncJSONRPCServer
+        self.wallets_lock = threading.RLock()
         # Setup JSONRPC server
         self.server = None
         if listen_jsonrpc:
@@ -154,8 +161,8 @@ class Daemon(DaemonThread):
         port = config.get('rpcport', 0)
         rpc_user, rpc_password = get_rpc_credentials(config)
         try:
-            server = VerifyingJSONRPCServer((host, port), logRequests=False,
-                                            rpc_user=rpc_user, rpc_password=rpc_password)
+            server = AsyncJSONRPCServer((host, port), rpc_user=rpc_user, rpc_password=rpc_password,
+                                        loop=self.asyncio_loop)
         except Exception as e:
             self.logger.error(f'cannot initialize RPC server on host {host}: {repr(e)}')
             self.server = None
@@ -164,7 +171,6 @@ class Daemon(DaemonThread):
         os.write(fd, bytes(repr((server.socket.getsockname(), time.time())), 'utf8'))
         os.close(fd)
         self.server = server
-        server.timeout = 0.1
         server.register_function(self.ping, 'ping')
         server.register_function(self.run_gui, 'gui')
         server.register_function(self.run_daemon, 'daemon')
@@ -172,6 +178,7 @@ class Daemon(DaemonThread):
         for cmdname in known_commands:
             server.register_function(getattr(self.cmd_runner, cmdname), cmdname)
         server.register_function(self.run_cmdline, 'run_cmdline')
+        asyncio.run_coroutine_threadsafe(server.start(), self.asyncio_loop).result()
 
     def ping(self):
         return True
@@ -185,19 +192,22 @@ class Daemon(DaemonThread):
             response = "Daemon already running"
         elif sub == 'load_wallet':
             path = config.get_wallet_path()
-            wallet = self.load_wallet(path, config.get('password'))
+            with self.wallets_lock:
+                wallet = self.load_wallet(path, config.get('password'))
+                if wallet is not None:
+                    self.cmd_runner.wallet = wallet
             if wallet is not None:
-                self.cmd_runner.wallet = wallet
                 run_hook('load_wallet', wallet, None)
             response = wallet is not None
         elif sub == 'close_wallet':
             path = config.get_wallet_path()
             path = standardize_path(path)
-            if path in self.wallets:
-                self.stop_wallet(path)
-                response = True
-            else:
-                response = False
+            with self.wallets_lock:
+                if path in self.wallets:
+                    self.stop_wallet(path)
+                    response = True
+                else:
+                    response = False
         elif sub == 'status':
             if self.network:
                 net_params = self.network.get_parameters()
@@ -214,9 +224,12 @@ class Daemon(DaemonThread):
                     'auto_connect': net_params.auto_connect,
                     'version': ELECTRUM_VERSION,
                     'wallets': {k: w.is_up_to_date()
-                                for k, w in self.wallets.items()},
+                                for k, w in list(self.wallets.items())},
                     'current_wallet': current_wallet_path,
                     'fee_per_kb': self.config.fee_per_kb(),
+                    'request_cache': self.network.request_cache.get_stats(),
+                    'tx_store': self.network.tx_store.get_stats() if self.network.tx_store else None,
+                    'subscriptions': self.network.subscription_multiplexer.get_stats(),
                 }
             else:
                 response = "Daemon offline"
@@ -241,32 +254,34 @@ class Daemon(DaemonThread):
 
     def load_wallet(self, path, password) -> Optional[Abstract_Wallet]:
         path = standardize_path(path)
-        # wizard will be launched if we return
-        if path in self.wallets:
-            wallet = self.wallets[path]
-            return wallet
-        storage = WalletStorage(path, manual_upgrades=True)
-        if not storage.file_exists():
-            return
-        if storage.is_encrypted():
-            if not password:
+        with self.wallets_lock:
+            # wizard will be launched if we return
+            if path in self.wallets:
+                wallet = self.wallets[path]
+                return wallet
+            storage = WalletStorage(path, manual_upgrades=True)
+            if not storage.file_exists():
                 return
-            storage.decrypt(password)
-        if storage.requires_split():
-            return
-        if storage.requires_upgrade():
-            return
-        if storage.get_action():
-            return
-        wallet = Wallet(storage)
-        wallet.start_network(self.network)
-        self.wallets[path] = wallet
-        return wallet
+            if storage.is_encrypted():
+                if not password:
+                    return
+                storage.decrypt(password)
+            if storage.requires_split():
+                return
+            if storage.requires_upgrade():
+                return
+            if storage.get_action():
+                return
+            wallet = Wallet(storage)
+            wallet.start_network(self.network)
+            self.wallets[path] = wallet
+            return wallet
 
     def add_wallet(self, wallet: Abstract_Wallet):
         path = wallet.storage.path
         path = standardize_path(path)
-        self.wallets[path] = wallet
+        with self.wallets_lock:
+            self.wallets[path] = wallet
 
     def get_wallet(self, path):
         path = standardize_path(path)
@@ -281,7 +296,8 @@ class Daemon(DaemonThread):
 
     def stop_wallet(self, path):
         path = standardize_path(path)
-        wallet = self.wallets.pop(path, None)
+        with self.wallets_lock:
+            wallet = self.wallets.pop(path, None)
         if not wallet: return
         wallet.stop_threads()
 
@@ -321,13 +337,17 @@ class Daemon(DaemonThread):
 
     def run(self):
         while self.is_running():
-            self.server.handle_request() if self.server else time.sleep(0.1)
+            time.sleep(0.1)
+        if self.server:
+            asyncio.run_coroutine_threadsafe(self.server.stop(), self.asyncio_loop).result()
         # stop network/wallets
         for k, wallet in self.wallets.items():
             wallet.stop_threads()
         if self.network:
             self.logger.info("shutting down network")
             self.network.stop()
+            if self.network.tx_store:
+                self.network.tx_store.close()
         # stop event loop
         self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
         self._loop_thread.join(timeout=1)
@@ -25,17 +25,25 @@
 
 import base64
 import hashlib
-from typing import Union, Tuple
+from functools import lru_cache
+from itertools import repeat
+from concurrent.futures import Executor
+from typing import Union, Tuple, Sequence, List
 
 import ecdsa
 from ecdsa.ecdsa import curve_secp256k1, generator_secp256k1
 from ecdsa.curves import SECP256k1
 from ecdsa.ellipticcurve import Point
+try:
+    from ecdsa.ellipticcurve import PointJacobi
+except ImportError:  # python-ecdsa < 0.14
+    PointJacobi = None
 from ecdsa.util import string_to_number, number_to_string
 
 from .util import bfh, bh2u, assert_bytes, to_bytes, InvalidPassword, profiler
 from .crypto import (sha256d, aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot)
 from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1
+from . import ecc_fast
 from . import msqr
 from . import constants
 from .logging import get_logger
@@ -46,6 +54,13 @@ do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
 
 CURVE_ORDER = SECP256k1.order
 
+# number of parsed pubkeys kept, see _ser_to_python_ecdsa_pubkey
+PUBKEY_CACHE_SIZE = 4096
+# only farm out verification to an executor if there are at least this many signatures
+MIN_SIGNATURES_FOR_EXECUTOR = 100
+# number of signatures verified per executor job
+SIGNATURES_PER_JOB = 50
+
 
 def generator():
     return ECPubkey.from_point(generator_secp256k1)
@@ -128,6 +143,14 @@ def _ser_to_python_ecdsa_point(ser: bytes) -> ecdsa.ellipticcurve.Point:
         raise InvalidECPointException()
 
 
+@lru_cache(maxsize=PUBKEY_CACHE_SIZE)
+def _ser_to_python_ecdsa_pubkey(ser: bytes) -> ecdsa.ecdsa.Public_key:
+    # parsing (decompressing) and validating the point is slow; the
+    # result is immutable and can be shared by all ECPubkeys of ser
+    point = _ser_to_python_ecdsa_point(ser)
+    return ecdsa.ecdsa.Public_key(generator_secp256k1, point)
+
+
 class InvalidECPointException(Exception):
     """e.g. not on curve, or infinity"""
 
@@ -160,7 +183,11 @@ class _MyVerifyingKey(ecdsa.VerifyingKey):
         # 1.6 compute Q = r^-1 (sR - eG)
         inv_r = numbertheory.inverse_mod(r,order)
         try:
-            Q = inv_r * ( s * R + minus_e * G )
+            if PointJacobi is not None and isinstance(G, PointJacobi):
+                # python-ecdsa >= 0.14: both multiplications at once, in jacobian coordinates
+                Q = G.mul_add(minus_e * inv_r % order, PointJacobi.from_affine(R), s * inv_r % order)
+            else:
+                Q = inv_r * ( s * R + minus_e * G )
         except:
             raise InvalidECPointException()
         return klass.from_public_point( Q, curve )
@@ -185,8 +212,7 @@ class ECPubkey(object):
     def __init__(self, b: bytes):
         if b is not None:
             assert_bytes(b)
-            point = _ser_to_python_ecdsa_point(b)
-            self._pubkey = ecdsa.ecdsa.Public_key(generator_secp256k1, point)
+            self._pubkey = _ser_to_python_ecdsa_pubkey(bytes(b))
         else:
             self._pubkey = _PubkeyForPointAtInfinity()
 
@@ -197,6 +223,11 @@ class ECPubkey(object):
             raise Exception('Wrong encoding')
         if recid < 0 or recid > 3:
             raise ValueError('recid is {}, but should be 0 <= recid <= 3'.format(recid))
+        if ecc_fast.is_using_fast_ecc_recovery():
+            pubkey_bytes = ecc_fast.ecdsa_recover(sig_string, recid, msg_hash)
+            if pubkey_bytes is None:
+                raise InvalidECPointException()
+            return ECPubkey(pubkey_bytes)
         ecdsa_verifying_key = _MyVerifyingKey.from_signature(sig_string, recid, msg_hash, curve=SECP256k1)
         ecdsa_point = ecdsa_verifying_key.pubkey.point
         return ECPubkey.from_point(ecdsa_point)
@@ -270,6 +301,10 @@ class ECPubkey(object):
         assert_bytes(sig_string)
         if len(sig_string) != 64:
             raise Exception('Wrong encoding')
+        if ecc_fast.is_using_fast_ecc():
+            if not ecc_fast.ecdsa_verify(self.get_public_key_bytes(compressed=False), sig_string, msg_hash):
+                raise ecdsa.BadSignatureError('Signature verification failed')
+            return
         ecdsa_point = self._pubkey.point
         verifying_key = _MyVerifyingKey.from_public_point(ecdsa_point, curve=SECP256k1)
         verifying_key.verify_digest(sig_string, msg_hash, sigdecode=ecdsa.util.sigdecode_string)
@@ -338,6 +373,26 @@ def verify_message_with_address(address: str, sig65: bytes, message: bytes, *, n
         return False
 
 
+def _verify_messages_with_addresses(items: Sequence[Tuple[str, bytes, bytes]], net) -> List[bool]:
+    # module-level so that it can be sent to a process pool
+    return [verify_message_with_address(address, sig65, message, net=net)
+            for address, sig65, message in items]
+
+
+def verify_messages_with_addresses(items: Sequence[Tuple[str, bytes, bytes]], *, net=None,
+                                   executor: Executor = None) -> List[bool]:
+    """Like verify_message_with_address for each (address, sig65, message)
+    in items. Verification is spread over executor (e.g. a process pool) if
+    there are at least MIN_SIGNATURES_FOR_EXECUTOR items.
+    """
+    if net is None: net = constants.net
+    if executor is None or len(items) < MIN_SIGNATURES_FOR_EXECUTOR:
+        return _verify_messages_with_addresses(items, net)
+    jobs = [items[i:i + SIGNATURES_PER_JOB] for i in range(0, len(items), SIGNATURES_PER_JOB)]
+    results = executor.map(_verify_messages_with_addresses, jobs, repeat(net))
+    return [x for result in results for x in result]
+
+
 def is_secret_within_curve_range(secret: Union[int, bytes]) -> bool:
     if isinstance(secret, bytes):
         secret = string_to_number(secret)
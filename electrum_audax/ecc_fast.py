@@ -6,6 +6,7 @@ import sys
 import traceback
 import ctypes
 from ctypes.util import find_library
+from typing import Optional
 from ctypes import (
     byref, c_byte, c_int, c_uint, c_char_p, c_size_t, c_void_p, create_string_buffer, CFUNCTYPE, POINTER
 )
@@ -84,6 +85,19 @@ def load_library():
         secp256k1.secp256k1_ec_pubkey_tweak_mul.argtypes = [c_void_p, c_char_p, c_char_p]
         secp256k1.secp256k1_ec_pubkey_tweak_mul.restype = c_int
 
+        try:
+            # only there if the library was built with --enable-module-recovery
+            secp256k1.secp256k1_ecdsa_recoverable_signature_parse_compact.argtypes = [c_void_p, c_char_p, c_char_p, c_int]
+            secp256k1.secp256k1_ecdsa_recoverable_signature_parse_compact.restype = c_int
+
+            secp256k1.secp256k1_ecdsa_recover.argtypes = [c_void_p, c_char_p, c_char_p, c_char_p]
+            secp256k1.secp256k1_ecdsa_recover.restype = c_int
+
+            secp256k1.has_recovery = True
+        except AttributeError:
+            _logger.info('libsecp256k1 was built without the recovery module')
+            secp256k1.has_recovery = False
+
         secp256k1.ctx = secp256k1.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
         r = secp256k1.secp256k1_context_randomize(secp256k1.ctx, os.urandom(32))
         if r:
@@ -216,6 +230,46 @@ def is_using_fast_ecc():
     return _patched_functions.monkey_patching_active
 
 
+def is_using_fast_ecc_recovery():
+    return is_using_fast_ecc() and _libsecp256k1.has_recovery
+
+
+def _serialize_pubkey(pubkey) -> bytes:
+    pubkey_serialized = create_string_buffer(65)
+    pubkey_size = c_size_t(65)
+    _libsecp256k1.secp256k1_ec_pubkey_serialize(
+        _libsecp256k1.ctx, pubkey_serialized, byref(pubkey_size), pubkey, SECP256K1_EC_UNCOMPRESSED)
+    return pubkey_serialized.raw
+
+
+def ecdsa_verify(pubkey_bytes: bytes, sig_string: bytes, msg_hash: bytes) -> bool:
+    """Verifies the compact signature (r, s) of msg_hash with libsecp256k1,
+    without going through python-ecdsa. Requires is_using_fast_ecc()."""
+    pubkey_bytes, sig_string, msg_hash = bytes(pubkey_bytes), bytes(sig_string), bytes(msg_hash)
+    sig = create_string_buffer(64)
+    if not _libsecp256k1.secp256k1_ecdsa_signature_parse_compact(_libsecp256k1.ctx, sig, sig_string):
+        return False
+    _libsecp256k1.secp256k1_ecdsa_signature_normalize(_libsecp256k1.ctx, sig, sig)
+    pubkey = create_string_buffer(64)
+    if not _libsecp256k1.secp256k1_ec_pubkey_parse(_libsecp256k1.ctx, pubkey, pubkey_bytes, len(pubkey_bytes)):
+        return False
+    return 1 == _libsecp256k1.secp256k1_ecdsa_verify(_libsecp256k1.ctx, sig, msg_hash, pubkey)
+
+
+def ecdsa_recover(sig_string: bytes, recid: int, msg_hash: bytes) -> Optional[bytes]:
+    """Returns the uncompressed public key that made the compact signature
+    (r, s) of msg_hash, or None. Requires is_using_fast_ecc_recovery()."""
+    sig_string, msg_hash = bytes(sig_string), bytes(msg_hash)
+    sig = create_string_buffer(65)
+    if not _libsecp256k1.secp256k1_ecdsa_recoverable_signature_parse_compact(
+            _libsecp256k1.ctx, sig, sig_string, recid):
+        return None
+    pubkey = create_string_buffer(64)
+    if not _libsecp256k1.secp256k1_ecdsa_recover(_libsecp256k1.ctx, pubkey, sig, msg_hash):
+        return None
+    return _serialize_pubkey(pubkey)
+
+
 try:
     _libsecp256k1 = load_library()
 except:
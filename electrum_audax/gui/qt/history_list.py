@@ -662,40 +662,14 @@ class HistoryList(MyTreeView, AcceptFileDragDrop):
         self.parent.show_message(_("Your wallet history has been successfully exported."))
 
     def do_export_history(self, file_name, is_csv):
-        hist = self.wallet.get_full_history(domain=self.hm.get_domain(),
-                                            from_timestamp=None,
-                                            to_timestamp=None,
-                                            fx=self.parent.fx,
-                                            show_fees=True)
-        txns = hist['transactions']
-        lines = []
-        if is_csv:
-            for item in txns:
-                lines.append([item['txid'],
-                              item.get('label', ''),
-                              item['confirmations'],
-                              item['value'],
-                              item.get('fiat_value', ''),
-                              item.get('fee', ''),
-                              item.get('fiat_fee', ''),
-                              item['date']])
         with open(file_name, "w+", encoding='utf-8') as f:
-            if is_csv:
-                import csv
-                transaction = csv.writer(f, lineterminator='\n')
-                transaction.writerow(["transaction_hash",
-                                      "label",
-                                      "confirmations",
-                                      "value",
-                                      "fiat_value",
-                                      "fee",
-                                      "fiat_fee",
-                                      "timestamp"])
-                for line in lines:
-                    transaction.writerow(line)
-            else:
-                from electrum_audax.util import json_encode
-                f.write(json_encode(txns))
+            self.wallet.export_history(f,
+                                       fmt='csv' if is_csv else 'json',
+                                       domain=self.hm.get_domain(),
+                                       from_timestamp=None,
+                                       to_timestamp=None,
+                                       fx=self.parent.fx,
+                                       show_fees=True)
 
     def text_txid_from_coordinate(self, row, col):
         idx = self.model().mapToSource(self.model().index(row, col))
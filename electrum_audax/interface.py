@@ -28,7 +28,7 @@ import ssl
 import sys
 import traceback
 import asyncio
-from typing import Tuple, Union, List, TYPE_CHECKING, Optional
+from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Sequence
 from collections import defaultdict
 from ipaddress import IPv4Network, IPv6Network, ip_address
 
@@ -117,6 +117,32 @@ class NotificationSession(RPCSession):
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
 
+    async def send_request_batch(self, requests: Sequence[Tuple[str, List]], *,
+                                 timeout=None, raise_errors=True) -> List:
+        """Sends (method, params) pairs as a single JSON-RPC batch.
+        Returns the results in the same order; raises the first error, if any,
+        unless raise_errors is False, in which case errors are returned in place.
+        """
+        msg_id = self._get_and_inc_msg_counter()
+        self.maybe_log(f"<-- batch of {len(requests)} (id: {msg_id}): {requests}")
+
+        async def send():
+            async with self.send_batch() as batch:
+                for method, params in requests:
+                    batch.add_request(method, params)
+            return batch.results
+
+        try:
+            results = await asyncio.wait_for(send(), timeout)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            raise RequestTimedOut(f'batch request timed out: {len(requests)} requests (id: {msg_id})') from e
+        self.maybe_log(f"--> {results} (id: {msg_id})")
+        if raise_errors:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return list(results)
+
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
         self.max_send_delay = timeout
@@ -133,6 +159,21 @@ class NotificationSession(RPCSession):
             self.cache[key] = result
         await queue.put(params + [result])
 
+    async def subscribe_batch(self, method: str, params_list: Sequence[List], queue: asyncio.Queue):
+        """Like subscribe, for several subscriptions with the same method.
+        The ones that are not cached yet are requested in a single batch.
+        """
+        keys = [self.get_hashable_key_for_rpc_call(method, params) for params in params_list]
+        for key in keys:
+            self.subscriptions[key].append(queue)
+        to_request = [(key, params) for key, params in zip(keys, params_list) if key not in self.cache]
+        if to_request:
+            results = await self.send_request_batch([(method, params) for key, params in to_request])
+            for (key, params), result in zip(to_request, results):
+                self.cache[key] = result
+        for key, params in zip(keys, params_list):
+            await queue.put(params + [self.cache[key]])
+
     def unsubscribe(self, queue):
         """Unsubscribe a callback to free object references to enable GC."""
         # note: we can't unsubscribe from the server, so we keep receiving
@@ -489,6 +530,14 @@ class Interface(Logger):
         last = None
         while last is None or height <= next_height:
             prev_last, prev_height = last, height
+            if next_height // 2016 > height // 2016:
+                # several chunks to go: download them from all interfaces at once
+                new_height = await self.network.header_downloader.download(
+                    self.blockchain, height, next_height, preferred=self)
+                if new_height > height:
+                    self.network.trigger_callback('network_updated')
+                    last, height = 'catchup', new_height
+                    continue
             if next_height > height + 10:
                 could_connect, num_headers = await self.request_chunk(height, next_height)
                 if not could_connect:
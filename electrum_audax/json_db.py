@@ -27,15 +27,19 @@ import ast
 import json
 import copy
 import threading
-from collections import defaultdict
-from typing import Dict, Optional
+from collections import defaultdict, OrderedDict
+from typing import Dict, Optional, Sequence, TYPE_CHECKING
 
 from . import util, bitcoin
-from .util import profiler, WalletFileException, multisig_type, TxMinedInfo
+from .util import profiler, WalletFileException, multisig_type, TxMinedInfo, bfh
 from .keystore import bip44_derivation
 from .transaction import Transaction
 from .logging import Logger
 
+if TYPE_CHECKING:
+    from .tx_store import TxStore
+
+
 # seed_version is now used for the version of the wallet file
 
 OLD_SEED_VERSION = 4        # electrum versions < 2.0
@@ -43,24 +47,33 @@ NEW_SEED_VERSION = 11       # electrum versions >= 2.0
 FINAL_SEED_VERSION = 18     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
+# number of deserialized transactions kept in memory
+TX_CACHE_SIZE = 1000
+
 
 class JsonDBJsonEncoder(util.MyEncoder):
     def default(self, obj):
         if isinstance(obj, Transaction):
             return str(obj)
+        if isinstance(obj, bytes):
+            return obj.hex()
         return super().default(obj)
 
 
 class JsonDB(Logger):
 
-    def __init__(self, raw, *, manual_upgrades):
+    def __init__(self, raw, *, manual_upgrades, changes: Sequence[str] = ()):
         Logger.__init__(self)
         self.lock = threading.RLock()
         self.data = {}
         self._modified = False
+        # paths into self.data (as tuples of keys) modified since the last
+        # write, or _full_write if there were changes we did not track
+        self._changed_paths = OrderedDict()
+        self._full_write = False
         self.manual_upgrades = manual_upgrades
         if raw:
-            self.load_data(raw)
+            self.load_data(raw, changes)
         else:
             self.put('seed_version', FINAL_SEED_VERSION)
         self.load_transactions()
@@ -68,10 +81,21 @@ class JsonDB(Logger):
     def set_modified(self, b):
         with self.lock:
             self._modified = b
+            if b:
+                self._full_write = True
+            else:
+                self._changed_paths.clear()
+                self._full_write = False
 
     def modified(self):
         return self._modified
 
+    def requires_full_write(self):
+        return self._full_write
+
+    def _log_change(self, *path):
+        self._changed_paths[path] = None
+
     def modifier(func):
         def wrapper(self, *args, **kwargs):
             with self.lock:
@@ -105,6 +129,7 @@ class JsonDB(Logger):
         if value is not None:
             if self.data.get(key) != value:
                 self.data[key] = copy.deepcopy(value)
+                self._log_change(key)
                 return True
         elif key in self.data:
             # clear current contents in case of references
@@ -114,6 +139,7 @@ class JsonDB(Logger):
                 clear_method()
             # pop from dict to delete key
             self.data.pop(key)
+            self._log_change(key)
             return True
         return False
 
@@ -121,10 +147,42 @@ class JsonDB(Logger):
         pass
 
     @locked
-    def dump(self):
+    def dump(self, *, compact=False):
+        if compact:
+            return json.dumps(self.data, separators=(',', ':'), cls=JsonDBJsonEncoder)
         return json.dumps(self.data, indent=4, sort_keys=True, cls=JsonDBJsonEncoder)
 
-    def load_data(self, s):
+    @locked
+    def dump_changes(self) -> Optional[str]:
+        """Returns the changes since the last write, as a JSON list of
+        [path, value] for the values set and [path] for those removed,
+        or None if there are none.
+        """
+        if not self._changed_paths:
+            return None
+        changes = []
+        for path in self._changed_paths:
+            d = self.data
+            for key in path[:-1]:
+                d = d.get(key) if isinstance(d, dict) else None
+            if isinstance(d, dict) and path[-1] in d:
+                changes.append([path, d[path[-1]]])
+            else:
+                changes.append([path])
+        return json.dumps(changes, separators=(',', ':'), cls=JsonDBJsonEncoder)
+
+    def _apply_changes(self, s: str) -> None:
+        for change in json.loads(s):
+            path = change[0]
+            d = self.data
+            for key in path[:-1]:
+                d = d.setdefault(key, {})
+            if len(change) > 1:
+                d[path[-1]] = change[1]
+            else:
+                d.pop(path[-1], None)
+
+    def load_data(self, s, changes: Sequence[str] = ()):
         try:
             self.data = json.loads(s)
         except:
@@ -144,6 +202,8 @@ class JsonDB(Logger):
                 self.data[key] = value
         if not isinstance(self.data, dict):
             raise WalletFileException("Malformed wallet file (not dict)")
+        for c in changes:
+            self._apply_changes(c)
 
         if not self.manual_upgrades:
             if self.requires_split():
@@ -519,11 +579,22 @@ class JsonDB(Logger):
 
     @locked
     def get_txi_addr(self, tx_hash, address):
-        return self.txi.get(tx_hash, {}).get(address, [])
+        return self._get_addr_set(self.txi, tx_hash, address)
 
     @locked
     def get_txo_addr(self, tx_hash, address):
-        return self.txo.get(tx_hash, {}).get(address, [])
+        return self._get_addr_set(self.txo, tx_hash, address)
+
+    @staticmethod
+    def _get_addr_set(t, tx_hash, addr):
+        # the entries of txi and txo are loaded as lists of lists,
+        # and converted to sets of tuples on first access
+        d = t.get(tx_hash)
+        if d is None or addr not in d:
+            return []
+        if isinstance(d[addr], list):
+            d[addr] = set([tuple(x) for x in d[addr]])
+        return d[addr]
 
     @modifier
     def add_txi_addr(self, tx_hash, addr, ser, v):
@@ -533,7 +604,8 @@ class JsonDB(Logger):
         if addr not in d:
             # note that as this is a set, we can ignore "duplicates"
             d[addr] = set()
-        d[addr].add((ser, v))
+        self._get_addr_set(self.txi, tx_hash, addr).add((ser, v))
+        self._log_change('txi', tx_hash)
 
     @modifier
     def add_txo_addr(self, tx_hash, addr, n, v, is_coinbase):
@@ -543,7 +615,8 @@ class JsonDB(Logger):
         if addr not in d:
             # note that as this is a set, we can ignore "duplicates"
             d[addr] = set()
-        d[addr].add((n, v, is_coinbase))
+        self._get_addr_set(self.txo, tx_hash, addr).add((n, v, is_coinbase))
+        self._log_change('txo', tx_hash)
 
     @locked
     def list_txi(self):
@@ -556,10 +629,12 @@ class JsonDB(Logger):
     @modifier
     def remove_txi(self, tx_hash):
         self.txi.pop(tx_hash, None)
+        self._log_change('txi', tx_hash)
 
     @modifier
     def remove_txo(self, tx_hash):
         self.txo.pop(tx_hash, None)
+        self._log_change('txo', tx_hash)
 
     @locked
     def list_spent_outpoints(self):
@@ -581,25 +656,64 @@ class JsonDB(Logger):
         self.spent_outpoints[prevout_hash].pop(prevout_n, None)  # FIXME
         if not self.spent_outpoints[prevout_hash]:
             self.spent_outpoints.pop(prevout_hash)
+        self._log_change('spent_outpoints', prevout_hash)
 
     @modifier
     def set_spent_outpoint(self, prevout_hash, prevout_n, tx_hash):
         if prevout_hash not in self.spent_outpoints:
             self.spent_outpoints[prevout_hash] = {}
         self.spent_outpoints[prevout_hash][str(prevout_n)] = tx_hash
+        self._log_change('spent_outpoints', prevout_hash)
 
     @modifier
     def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
         assert isinstance(tx, Transaction)
-        self.transactions[tx_hash] = tx
+        raw_tx = bfh(str(tx))
+        if self.tx_store is not None:
+            raw_tx = self.tx_store.add(tx_hash, raw_tx) or raw_tx
+        self.transactions[tx_hash] = raw_tx
+        self._cache_transaction(tx_hash, tx)
+        self._log_change('transactions', tx_hash)
 
     @modifier
     def remove_transaction(self, tx_hash) -> Optional[Transaction]:
-        return self.transactions.pop(tx_hash, None)
+        tx = self.get_transaction(tx_hash)
+        self._tx_cache.pop(tx_hash, None)
+        self.transactions.pop(tx_hash, None)
+        self._log_change('transactions', tx_hash)
+        return tx
 
     @locked
     def get_transaction(self, tx_hash: str) -> Optional[Transaction]:
-        return self.transactions.get(tx_hash)
+        tx = self._tx_cache.get(tx_hash)
+        if tx is not None:
+            self._tx_cache.move_to_end(tx_hash)
+            return tx
+        raw_tx = self.transactions.get(tx_hash)
+        if raw_tx is None:
+            return None
+        tx = Transaction(raw_tx.hex())
+        self._cache_transaction(tx_hash, tx)
+        return tx
+
+    def _cache_transaction(self, tx_hash: str, tx: Transaction) -> None:
+        self._tx_cache[tx_hash] = tx
+        self._tx_cache.move_to_end(tx_hash)
+        while len(self._tx_cache) > TX_CACHE_SIZE:
+            self._tx_cache.popitem(last=False)
+
+    @locked
+    def share_transactions(self, tx_store: 'TxStore') -> None:
+        """Keeps the raw txs in tx_store, and references to them here."""
+        self.tx_store = tx_store
+        if tx_store is None:
+            return
+        for tx_hash, raw_tx in self.transactions.items():
+            self.transactions[tx_hash] = tx_store.add(tx_hash, raw_tx) or raw_tx
+
+    @locked
+    def has_transaction(self, tx_hash: str) -> bool:
+        return tx_hash in self.transactions
 
     @locked
     def list_transactions(self):
@@ -620,10 +734,12 @@ class JsonDB(Logger):
     @modifier
     def set_addr_history(self, addr, hist):
         self.history[addr] = hist
+        self._log_change('addr_history', addr)
 
     @modifier
     def remove_addr_history(self, addr):
         self.history.pop(addr, None)
+        self._log_change('addr_history', addr)
 
     @locked
     def list_verified_tx(self):
@@ -643,16 +759,20 @@ class JsonDB(Logger):
     @modifier
     def add_verified_tx(self, txid, info):
         self.verified_tx[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
+        self._log_change('verified_tx3', txid)
 
     @modifier
     def remove_verified_tx(self, txid):
         self.verified_tx.pop(txid, None)
+        self._log_change('verified_tx3', txid)
 
     def is_in_verified_tx(self, txid):
         return txid in self.verified_tx
 
     @modifier
     def update_tx_fees(self, d):
+        for txid in d:
+            self._log_change('tx_fees', txid)
         return self.tx_fees.update(d)
 
     @locked
@@ -662,6 +782,7 @@ class JsonDB(Logger):
     @modifier
     def remove_tx_fee(self, txid):
         self.tx_fees.pop(txid, None)
+        self._log_change('tx_fees', txid)
 
     @locked
     def get_data_ref(self, name):
@@ -689,11 +810,13 @@ class JsonDB(Logger):
     def add_change_address(self, addr):
         self._addr_to_addr_index[addr] = (True, len(self.change_addresses))
         self.change_addresses.append(addr)
+        self._log_change('addresses', 'change')
 
     @modifier
     def add_receiving_address(self, addr):
         self._addr_to_addr_index[addr] = (False, len(self.receiving_addresses))
         self.receiving_addresses.append(addr)
+        self._log_change('addresses', 'receiving')
 
     @locked
     def get_address_index(self, address):
@@ -702,10 +825,12 @@ class JsonDB(Logger):
     @modifier
     def add_imported_address(self, addr, d):
         self.imported_addresses[addr] = d
+        self._log_change('addresses', addr)
 
     @modifier
     def remove_imported_address(self, addr):
         self.imported_addresses.pop(addr)
+        self._log_change('addresses', addr)
 
     @locked
     def has_imported_address(self, addr):
@@ -741,19 +866,18 @@ class JsonDB(Logger):
         # references in self.data
         self.txi = self.get_data_ref('txi')  # txid -> address -> list of (prev_outpoint, value)
         self.txo = self.get_data_ref('txo')  # txid -> address -> list of (output_index, value, is_coinbase)
-        self.transactions = self.get_data_ref('transactions')   # type: Dict[str, Transaction]
+        self.transactions = self.get_data_ref('transactions')   # type: Dict[str, bytes]
         self.spent_outpoints = self.get_data_ref('spent_outpoints')
         self.history = self.get_data_ref('addr_history')  # address -> list of (txid, height)
         self.verified_tx = self.get_data_ref('verified_tx3')  # txid -> (height, timestamp, txpos, header_hash)
         self.tx_fees = self.get_data_ref('tx_fees')
-        # convert raw hex transactions to Transaction objects
+        # keep raw transactions as bytes; they are deserialized on first
+        # access, and only the TX_CACHE_SIZE most recently used are kept
+        self._tx_cache = OrderedDict()  # type: OrderedDict[str, Transaction]
+        # optional daemon-wide store the raw txs are shared with, see share_transactions
+        self.tx_store = None  # type: Optional[TxStore]
         for tx_hash, raw_tx in self.transactions.items():
-            self.transactions[tx_hash] = Transaction(raw_tx)
-        # convert list to set
-        for t in self.txi, self.txo:
-            for d in t.values():
-                for addr, lst in d.items():
-                    d[addr] = set([tuple(x) for x in lst])
+            self.transactions[tx_hash] = bfh(raw_tx)
         # remove unreferenced tx
         for tx_hash in self.transactions:
             if not self.get_txi(tx_hash) and not self.get_txo(tx_hash):
@@ -773,6 +897,10 @@ class JsonDB(Logger):
         self.txo.clear()
         self.spent_outpoints.clear()
         self.transactions.clear()
+        self._tx_cache.clear()
         self.history.clear()
         self.verified_tx.clear()
         self.tx_fees.clear()
+        for name in ('txi', 'txo', 'spent_outpoints', 'transactions',
+                     'addr_history', 'verified_tx3', 'tx_fees'):
+            self._log_change(name)
@@ -24,14 +24,26 @@
 # SOFTWARE.
 
 from base64 import b64decode
+import asyncio
+import functools
+import inspect
+import json
+import socket
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+from aiohttp import web
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
 
 from . import util
 from .logging import Logger
 
 
+# commands that are not coroutines run in a pool of this many threads
+RPC_THREADS = 32
+
+
 class RPCAuthCredentialsInvalid(Exception):
     def __str__(self):
         return 'Authentication failed (bad credentials)'
@@ -78,22 +90,161 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer, Logger):
             self, requestHandler=VerifyingRequestHandler, *args, **kargs)
 
     def authenticate(self, headers):
-        if self.rpc_password == '':
-            # RPC authentication is disabled
-            return
-
-        auth_string = headers.get('Authorization', None)
-        if auth_string is None:
-            raise RPCAuthCredentialsMissing()
-
-        (basic, _, encoded) = auth_string.partition(' ')
-        if basic != 'Basic':
-            raise RPCAuthUnsupportedType()
-
-        encoded = util.to_bytes(encoded, 'utf8')
-        credentials = util.to_string(b64decode(encoded), 'utf8')
-        (username, _, password) = credentials.partition(':')
-        if not (util.constant_time_compare(username, self.rpc_user)
-                and util.constant_time_compare(password, self.rpc_password)):
+        try:
+            check_credentials(headers, self.rpc_user, self.rpc_password)
+        except RPCAuthCredentialsInvalid:
             time.sleep(0.050)
-            raise RPCAuthCredentialsInvalid()
+            raise
+
+
+def check_credentials(headers, rpc_user, rpc_password):
+    if rpc_password == '':
+        # RPC authentication is disabled
+        return
+
+    auth_string = headers.get('Authorization', None)
+    if auth_string is None:
+        raise RPCAuthCredentialsMissing()
+
+    (basic, _, encoded) = auth_string.partition(' ')
+    if basic != 'Basic':
+        raise RPCAuthUnsupportedType()
+
+    encoded = util.to_bytes(encoded, 'utf8')
+    credentials = util.to_string(b64decode(encoded), 'utf8')
+    (username, _, password) = credentials.partition(':')
+    if not (util.constant_time_compare(username, rpc_user)
+            and util.constant_time_compare(password, rpc_password)):
+        raise RPCAuthCredentialsInvalid()
+
+
+class JSONRPCError(Exception):
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+class AsyncJSONRPCServer(Logger):
+    """JSON-RPC over HTTP on an asyncio event loop, with the basic auth of
+    VerifyingJSONRPCServer. Connections are kept alive, and a JSON array
+    of requests is answered as a batch. Calls run concurrently: functions
+    registered as coroutines run on the loop, the others in a thread pool,
+    where they may block on the loop (e.g. Network.run_from_another_thread).
+    """
+
+    def __init__(self, addr, *, rpc_user, rpc_password, loop, num_threads=RPC_THREADS):
+        Logger.__init__(self)
+        self.rpc_user = rpc_user
+        self.rpc_password = rpc_password
+        self.loop = loop
+        self.funcs = {}
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='JSONRPC')
+        self.socket = socket.socket(socket.AF_INET6 if ':' in addr[0] else socket.AF_INET)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.socket.bind(addr)
+        except BaseException:
+            self.socket.close()
+            raise
+        self.runner = None
+
+    def register_function(self, func, name):
+        self.funcs[name] = func
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/', self.handle)
+        app.router.add_route('OPTIONS', '/', self.handle_options)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.SockSite(self.runner, self.socket).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+        self.executor.shutdown(wait=False)
+
+    async def authenticate(self, headers):
+        try:
+            check_credentials(headers, self.rpc_user, self.rpc_password)
+        except RPCAuthCredentialsInvalid:
+            await asyncio.sleep(0.050)
+            raise
+
+    async def handle_options(self, request):
+        # Do not authenticate OPTIONS-requests
+        return web.Response(headers={'Allow': 'POST, OPTIONS'})
+
+    async def handle(self, request):
+        try:
+            await self.authenticate(request.headers)
+        except (RPCAuthCredentialsInvalid, RPCAuthCredentialsMissing,
+                RPCAuthUnsupportedType) as e:
+            return web.Response(status=401, text=str(e))
+        try:
+            data = json.loads(await request.text())
+        except Exception as e:
+            response = self.error_response(None, -32700, f'Request invalid. ({type(e).__name__}: {e})')
+        else:
+            if isinstance(data, list):
+                if data:
+                    responses = await asyncio.gather(*[self.handle_call(call) for call in data])
+                    responses = [r for r in responses if r is not None]
+                    response = '[' + ','.join(responses) + ']' if responses else None
+                else:
+                    response = self.error_response(None, -32600, 'Empty batch')
+            else:
+                response = await self.handle_call(data)
+        if response is None:
+            # only notifications
+            return web.Response()
+        return web.Response(text=response, content_type='application/json')
+
+    async def handle_call(self, call):
+        """Returns the JSON encoded response to call, or None for a notification."""
+        if not isinstance(call, dict) or not isinstance(call.get('method'), str):
+            return self.error_response(None, -32600, 'Invalid request')
+        rpcid = call.get('id')
+        try:
+            result = await self.call(call['method'], call.get('params', []))
+            response = json.dumps({'jsonrpc': '2.0', 'result': result, 'id': rpcid}, cls=util.MyEncoder)
+        except JSONRPCError as e:
+            response = self.error_response(rpcid, e.code, e.message)
+        except Exception:
+            response = self.error_response(rpcid, -32603, self.log_server_error('preparing the JSON-RPC result'))
+        if rpcid is None:
+            return None
+        return response
+
+    async def call(self, method, params):
+        func = self.funcs.get(method)
+        if func is None:
+            raise JSONRPCError(-32601, f'Method {method} not supported.')
+        if isinstance(params, list):
+            args, kwargs = params, {}
+        elif isinstance(params, dict):
+            args, kwargs = [], params
+        else:
+            raise JSONRPCError(-32602, 'Invalid parameters')
+        try:
+            # a TypeError raised by the method itself is a server error
+            inspect.signature(func).bind(*args, **kwargs)
+        except TypeError as e:
+            raise JSONRPCError(-32602, f'Invalid parameters: {e}') from e
+        try:
+            if asyncio.iscoroutinefunction(func):
+                return await func(*args, **kwargs)
+            return await self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        except Exception as e:
+            raise JSONRPCError(-32603, self.log_server_error(f'calling method {method}')) from e
+
+    def log_server_error(self, context):
+        # like jsonrpclib, the caller only gets a reference to the error in the log
+        error_ref = uuid.uuid4().hex[:8]
+        self.logger.exception(f'Server-side error while {context} [ref: {error_ref}]')
+        return f'Server error (ref: {error_ref})'
+
+    def error_response(self, rpcid, code, message):
+        return json.dumps({'jsonrpc': '2.0', 'error': {'code': code, 'message': message}, 'id': rpcid})
@@ -26,13 +26,15 @@
 
 from unicodedata import normalize
 import hashlib
-from typing import Tuple
+from itertools import repeat
+from concurrent.futures import Executor
+from typing import Tuple, Sequence, List, Dict, Any
 
 from . import bitcoin, ecc, constants, bip32
 from .bitcoin import (deserialize_privkey, serialize_privkey,
                       public_key_to_p2pkh)
 from .bip32 import (convert_bip32_path_to_list_of_uint32, BIP32_PRIME,
-                    is_xpub, is_xprv, BIP32Node)
+                    is_xpub, is_xprv, BIP32Node, CKD_pub, CKD_priv)
 from .ecc import string_to_number, number_to_string
 from .crypto import (pw_decode, pw_encode, sha256, sha256d, PW_HASH_VERSION_LATEST,
                      SUPPORTED_PW_HASH_VERSIONS, UnsupportedPasswordHashVersion)
@@ -43,6 +45,12 @@ from .plugin import run_hook
 from .logging import Logger
 
 
+# only farm out key derivation to an executor if there are at least this many keys
+MIN_PUBKEYS_FOR_EXECUTOR = 1000
+# number of keys derived per executor job
+PUBKEYS_PER_JOB = 250
+
+
 class KeyStore(Logger):
 
     def __init__(self):
@@ -116,18 +124,16 @@ class Software_KeyStore(KeyStore):
         decrypted = ec.decrypt_message(message)
         return decrypted
 
-    def sign_transaction(self, tx, password):
+    def sign_transaction(self, tx, password, *, executor: Executor = None):
         if self.is_watching_only():
             return
         # Raise if password is not correct.
         self.check_password(password)
         # Add private keys
-        keypairs = self.get_tx_derivations(tx)
-        for k, v in keypairs.items():
-            keypairs[k] = self.get_private_key(v, password)
+        keypairs = self.get_keypairs(self.get_tx_derivations(tx), password)
         # Sign
         if keypairs:
-            tx.sign(keypairs)
+            tx.sign(keypairs, executor=executor)
 
     def update_password(self, old_password, new_password):
         raise NotImplementedError()  # implemented by subclasses
@@ -138,6 +144,14 @@ class Software_KeyStore(KeyStore):
     def get_private_key(self, *args, **kwargs) -> Tuple[bytes, bool]:
         raise NotImplementedError()  # implemented by subclasses
 
+    def get_keypairs(self, derivations: Dict[str, Any], password) -> Dict[str, Tuple[bytes, bool]]:
+        """Returns the private key for each x_pubkey -> derivation (as
+        returned by get_tx_derivations). Subclasses override this to
+        decrypt their key material only once for all keys.
+        """
+        return {x_pubkey: self.get_private_key(derivation, password)
+                for x_pubkey, derivation in derivations.items()}
+
 
 class Imported_KeyStore(Software_KeyStore):
     # keystore for imported private keys
@@ -255,26 +269,49 @@ class Deterministic_KeyStore(Software_KeyStore):
             return ''
 
 
+def derive_child_pubkeys(parent_pubkey: bytes, parent_chaincode: bytes,
+                         indexes: Sequence[int]) -> List[str]:
+    """Returns the compressed pubkeys of the non-hardened children at
+    indexes of a BIP32 node, in hex.
+    Module-level so that it can be sent to a process pool.
+    """
+    return [bh2u(CKD_pub(parent_pubkey, parent_chaincode, n)[0]) for n in indexes]
+
+
 class Xpub:
 
     def __init__(self):
         self.xpub = None
-        self.xpub_receive = None
-        self.xpub_change = None
+        # for_change -> (pubkey, chaincode) of the branch node
+        self._branches = {}
 
     def get_master_public_key(self):
         return self.xpub
 
+    def _get_branch(self, for_change) -> Tuple[bytes, bytes]:
+        branch = self._branches.get(for_change)
+        if branch is None:
+            node = BIP32Node.from_xkey(self.xpub).subkey_at_public_derivation((for_change,))
+            branch = node.eckey.get_public_key_bytes(compressed=True), node.chaincode
+            self._branches[for_change] = branch
+        return branch
+
     def derive_pubkey(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            rootnode = BIP32Node.from_xkey(self.xpub)
-            xpub = rootnode.subkey_at_public_derivation((for_change,)).to_xpub()
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        pubkey, chaincode = self._get_branch(for_change)
+        return bh2u(CKD_pub(pubkey, chaincode, n)[0])
+
+    def derive_pubkeys(self, for_change, indexes: Sequence[int],
+                       executor: Executor = None) -> List[str]:
+        """Like derive_pubkey, for each n in indexes (e.g. a range).
+        Derivation is spread over executor (e.g. a process pool) if there
+        are at least MIN_PUBKEYS_FOR_EXECUTOR indexes.
+        """
+        pubkey, chaincode = self._get_branch(for_change)
+        if executor is None or len(indexes) < MIN_PUBKEYS_FOR_EXECUTOR:
+            return derive_child_pubkeys(pubkey, chaincode, indexes)
+        jobs = [indexes[i:i + PUBKEYS_PER_JOB] for i in range(0, len(indexes), PUBKEYS_PER_JOB)]
+        results = executor.map(derive_child_pubkeys, repeat(pubkey), repeat(chaincode), jobs)
+        return [x for result in results for x in result]
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
@@ -374,6 +411,26 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
         pk = node.eckey.get_secret_bytes()
         return pk, True
 
+    def get_keypairs(self, derivations, password):
+        xprv = self.get_master_private_key(password)
+        root = BIP32Node.from_xkey(xprv)
+        # branch -> (privkey, chaincode, pubkey) of the branch node
+        branches = {}
+        keypairs = {}
+        for x_pubkey, sequence in derivations.items():
+            if not sequence:
+                keypairs[x_pubkey] = root.eckey.get_secret_bytes(), True
+                continue
+            *branch, n = sequence
+            branch = tuple(branch)
+            if branch not in branches:
+                node = root.subkey_at_private_derivation(branch)
+                branches[branch] = (node.eckey.get_secret_bytes(), node.chaincode,
+                                    node.eckey.get_public_key_bytes(compressed=True))
+            privkey, chaincode, pubkey = branches[branch]
+            keypairs[x_pubkey] = CKD_priv(privkey, chaincode, n, parent_pubkey=pubkey)[0], True
+        return keypairs
+
 
 
 class Old_KeyStore(Deterministic_KeyStore):
@@ -448,6 +505,9 @@ class Old_KeyStore(Deterministic_KeyStore):
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkeys(self, for_change, indexes, executor=None):
+        return [self.derive_pubkey(for_change, n) for n in indexes]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % ecc.CURVE_ORDER
         pk = number_to_string(secexp, ecc.CURVE_ORDER)
@@ -461,6 +521,13 @@ class Old_KeyStore(Deterministic_KeyStore):
         pk = self.get_private_key_from_stretched_exponent(for_change, n, secexp)
         return pk, False
 
+    def get_keypairs(self, derivations, password):
+        seed = self.get_hex_seed(password)
+        secexp = self.stretch_key(seed)
+        self.check_seed(seed, secexp=secexp)
+        return {x_pubkey: (self.get_private_key_from_stretched_exponent(for_change, n, secexp), False)
+                for x_pubkey, (for_change, n) in derivations.items()}
+
     def check_seed(self, seed, *, secexp=None):
         if secexp is None:
             secexp = self.stretch_key(seed)
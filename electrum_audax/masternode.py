@@ -398,3 +398,10 @@ class MasternodeAnnounce(object):
         if not addr:
             addr = bitcoin.public_key_to_p2pkh(bfh(self.collateral_key))
         return ecc.verify_message_with_address(addr, self.sig, self.serialize_for_sig())
+
+
+def verify_announces(announces, executor=None):
+    """Verify the sigs of many announces at once, see MasternodeAnnounce.verify."""
+    items = [(bitcoin.public_key_to_p2pkh(bfh(mnb.collateral_key)), mnb.sig, mnb.serialize_for_sig())
+             for mnb in announces]
+    return ecc.verify_messages_with_addresses(items, executor=executor)
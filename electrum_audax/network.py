@@ -25,14 +25,14 @@ import queue
 import os
 import random
 import re
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import threading
 import socket
 import json
 import sys
 import ipaddress
 import asyncio
-from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple
+from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, Callable, Awaitable, Hashable
 import traceback
 
 import dns
@@ -43,7 +43,7 @@ from aiohttp import ClientResponse
 
 from . import util
 from .util import (log_exceptions, ignore_exceptions,
-                   bfh, SilentTaskGroup, make_aiohttp_session, send_exception_to_crash_reporter,
+                   bfh, bh2u, SilentTaskGroup, make_aiohttp_session, send_exception_to_crash_reporter,
                    is_hash256_str, is_non_negative_integer)
 
 from .bitcoin import COIN
@@ -51,6 +51,8 @@ from . import constants
 from . import blockchain
 from . import bitcoin
 from .blockchain import Blockchain, HEADER_SIZE
+from .transaction import get_tx_hashes_from_raw
+from .tx_store import TxStore
 from .interface import (Interface, serialize_server, deserialize_server,
                         RequestTimedOut, NetworkTimeout)
 from .version import PROTOCOL_VERSION
@@ -67,6 +69,12 @@ NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
 NUM_TARGET_CONNECTED_SERVERS = 10
 NUM_RECENT_SERVERS = 20
+MAX_HEADER_CHUNKS_IN_FLIGHT = 8
+MAX_HEADER_CHUNK_ATTEMPTS = 3
+REQUEST_CACHE_SIZE = 5000
+# merkle proofs of txs at least this deep are assumed not to change anymore
+MIN_CONFIRMATIONS_TO_CACHE_MERKLE = 10
+MAX_CONCURRENT_SCRIPTHASH_REQUESTS = 50
 
 
 def parse_servers(result: Sequence[Tuple[str, str, List[str]]]) -> Dict[str, dict]:
@@ -217,6 +225,218 @@ class UntrustedServerReturnedError(Exception):
         return f"<UntrustedServerReturnedError original_exception: {repr(self.original_exception)}>"
 
 
+class HeaderDownloader(Logger):
+    """Downloads chunks of headers from all usable interfaces at once,
+    keeping several requests in flight, and connects them to a
+    blockchain in order as they arrive. A chunk that fails to download
+    or to connect is retried on another interface.
+    """
+
+    LOGGING_SHORTCUT = 'h'
+
+    def __init__(self, network: 'Network', *, max_in_flight: int = MAX_HEADER_CHUNKS_IN_FLIGHT):
+        Logger.__init__(self)
+        self.network = network
+        self.max_in_flight = max_in_flight
+        # optional concurrent.futures.Executor to hash headers in, see Blockchain.connect_chunks
+        self.executor = None
+        # throughput counters
+        self.num_chunks_requested = 0
+        self.num_chunks_failed = 0
+        self.num_headers_connected = 0
+        self.num_bytes_received = 0
+        self.time_spent = 0.0
+
+    def get_stats(self) -> dict:
+        return {
+            'chunks_requested': self.num_chunks_requested,
+            'chunks_failed': self.num_chunks_failed,
+            'headers_connected': self.num_headers_connected,
+            'bytes_received': self.num_bytes_received,
+            'seconds': round(self.time_spent, 3),
+            'headers_per_second': int(self.num_headers_connected / self.time_spent) if self.time_spent else 0,
+        }
+
+    def _get_usable_interfaces(self, min_tip: int) -> List[Interface]:
+        with self.network.interfaces_lock:
+            interfaces = list(self.network.interfaces.values())
+        return [iface for iface in interfaces
+                if iface.ready.done() and not iface.ready.cancelled()
+                and iface.session and not iface.session.is_closing()
+                and iface.tip >= min_tip]
+
+    async def _request_chunk(self, interface: Interface, index: int, size: int) -> str:
+        self.num_chunks_requested += 1
+        res = await interface.session.send_request('blockchain.block.headers', [index * 2016, size])
+        hexdata = res['hex']
+        if res['count'] != size or len(hexdata) != size * HEADER_SIZE * 2:
+            raise Exception(f'unexpected number of headers: {res["count"]} vs {size}')
+        self.num_bytes_received += len(hexdata) // 2
+        return hexdata
+
+    async def download(self, chain: Blockchain, height: int, tip: int, *,
+                       preferred: Interface = None) -> int:
+        """Connects the chunks covering heights height..tip to chain.
+        Returns the height of the first header that is not connected yet. Gives up on the first
+        chunk that cannot be connected with data from any interface; the
+        caller should then fall back to its usual header-by-header logic.
+        """
+        start_time = time.time()
+        first_index, last_index = height // 2016, tip // 2016
+        next_to_request = next_to_connect = first_index
+        next_height = height
+        in_flight = {}  # type: Dict[asyncio.Future, Tuple[int, Interface]]
+        arrived = {}  # type: Dict[int, str]  # chunk index -> hexdata
+        tried = defaultdict(set)  # type: Dict[int, set]  # chunk index -> servers
+        load = defaultdict(int)  # type: Dict[str, int]  # server -> requests in flight
+
+        def chunk_size(index):
+            return min(2016, tip - index * 2016 + 1)
+
+        def schedule(index) -> bool:
+            min_tip = index * 2016 + chunk_size(index) - 1
+            candidates = [iface for iface in self._get_usable_interfaces(min_tip)
+                          if iface.server not in tried[index]]
+            if len(tried[index]) >= MAX_HEADER_CHUNK_ATTEMPTS or not candidates:
+                return False
+            # least loaded first; ties broken in favour of the preferred interface
+            iface = min(candidates, key=lambda i: (load[i.server], i is not preferred))
+            tried[index].add(iface.server)
+            load[iface.server] += 1
+            fut = asyncio.ensure_future(self._request_chunk(iface, index, chunk_size(index)))
+            in_flight[fut] = (index, iface)
+            return True
+
+        try:
+            while next_to_connect <= last_index:
+                while next_to_request <= last_index and len(in_flight) + len(arrived) < self.max_in_flight:
+                    if not schedule(next_to_request):
+                        break
+                    next_to_request += 1
+                if not in_flight:
+                    break
+                done, _ = await asyncio.wait(list(in_flight), return_when=asyncio.FIRST_COMPLETED)
+                retry = []
+                for fut in done:
+                    index, iface = in_flight.pop(fut)
+                    load[iface.server] -= 1
+                    if fut.cancelled() or fut.exception() is not None:
+                        # e.g. aiorpcx cancels the pending requests of a server that disconnected
+                        error = 'cancelled' if fut.cancelled() else repr(fut.exception())
+                        self.logger.info(f'chunk {index} from {iface.server} failed: {error}')
+                        self.num_chunks_failed += 1
+                        retry.append(index)
+                    else:
+                        arrived[index] = fut.result()
+                # connect whatever is contiguous now
+                batch = []
+                while next_to_connect + len(batch) in arrived:
+                    index = next_to_connect + len(batch)
+                    batch.append((index, arrived.pop(index)))
+                if batch:
+                    num_connected = chain.connect_chunks(batch, self.executor)
+                    for index, hexdata in batch[:num_connected]:
+                        num_headers = len(hexdata) // (2 * HEADER_SIZE)
+                        self.num_headers_connected += num_headers
+                        next_height = index * 2016 + num_headers
+                    next_to_connect += num_connected
+                    if num_connected < len(batch):
+                        self.num_chunks_failed += 1
+                        retry.append(next_to_connect)
+                        arrived.update(batch[num_connected + 1:])
+                for index in retry:
+                    if not schedule(index):
+                        self.logger.info(f'giving up on chunk {index}')
+                        return next_height
+            return next_height
+        finally:
+            for fut in in_flight:
+                fut.cancel()
+            self.time_spent += time.time() - start_time
+
+
+class RequestCache:
+    """Sends a request only once while it is in flight, however many
+    callers ask for it meanwhile, and keeps the results that cannot
+    change anymore (e.g. raw txs, deep merkle proofs) in a bounded LRU.
+    Keys are usually (method, params). Not thread-safe; to be used on
+    the network's event loop.
+    """
+
+    def __init__(self, *, max_size: int = REQUEST_CACHE_SIZE):
+        self.max_size = max_size
+        self._results = OrderedDict()  # type: OrderedDict[Hashable, object]
+        self._in_flight = {}  # type: Dict[Hashable, asyncio.Future]
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_coalesced = 0
+
+    def get_stats(self) -> dict:
+        return {
+            'hits': self.num_hits,
+            'misses': self.num_misses,
+            'coalesced': self.num_coalesced,
+            'in_flight': len(self._in_flight),
+            'cached': len(self._results),
+        }
+
+    def get_cached(self, key: Hashable, default=None):
+        if key not in self._results:
+            return default
+        self._results.move_to_end(key)
+        self.num_hits += 1
+        return self._results[key]
+
+    def put(self, key: Hashable, result) -> None:
+        self._results[key] = result
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+
+    def discard(self, key: Hashable) -> bool:
+        """Removes the cached result for key. Returns whether there was one."""
+        return self._results.pop(key, None) is not None
+
+    def clear(self) -> None:
+        self._results.clear()
+
+    async def get(self, key: Hashable, make_request: Callable[[], Awaitable], *,
+                  is_immutable: Callable[[object], bool] = None):
+        """Returns the cached result for key, or awaits the request that is
+        in flight for key, or sends a new one with make_request().
+        Results for which is_immutable(result) is true are cached.
+        """
+        fut = self.get_future(key, make_request, is_immutable=is_immutable)
+        # a caller that gets cancelled must not cancel the request for the others
+        return await asyncio.shield(fut)
+
+    def get_future(self, key: Hashable, make_request: Callable[[], Awaitable], *,
+                   is_immutable: Callable[[object], bool] = None) -> asyncio.Future:
+        """Like get, but returns a future without waiting for it, so that
+        the requests for several keys can be sent together.
+        """
+        if key in self._results:
+            fut = asyncio.get_event_loop().create_future()
+            fut.set_result(self.get_cached(key))
+            return fut
+        fut = self._in_flight.get(key)
+        if fut is not None:
+            self.num_coalesced += 1
+        else:
+            self.num_misses += 1
+            fut = asyncio.ensure_future(make_request())
+            self._in_flight[key] = fut
+
+            def on_done(fut):
+                del self._in_flight[key]
+                if fut.cancelled() or fut.exception() is not None:
+                    return
+                if is_immutable is not None and is_immutable(fut.result()):
+                    self.put(key, fut.result())
+            fut.add_done_callback(on_done)
+        return fut
+
+
 INSTANCE = None
 
 
@@ -284,6 +504,12 @@ class Network(Logger):
         self.interface = None  # type: Interface
         # set of servers we have an ongoing connection with
         self.interfaces = {}  # type: Dict[str, Interface]
+        self.header_downloader = HeaderDownloader(self)
+        self.request_cache = RequestCache()
+        # optional raw tx store shared by all wallets, set by the daemon
+        self.tx_store = None  # type: Optional[TxStore]
+        # optional SubscriptionMultiplexer shared by all wallets, set by the daemon
+        self.subscription_multiplexer = None
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
         self.server_queue = None
@@ -794,13 +1020,17 @@ class Network(Logger):
         b = blockchain.get_best_chain()
         filename = b.path()
         length = HEADER_SIZE * len(constants.net.CHECKPOINTS) * 2016
-        if not os.path.exists(filename) or os.path.getsize(filename) < length:
-            with open(filename, 'wb') as f:
-                if length > 0:
-                    f.seek(length-1)
-                    f.write(b'\x00')
-            util.ensure_sparse_file(filename)
         with b.lock:
+            if not os.path.exists(filename) or os.path.getsize(filename) < length:
+                b.invalidate_cached_headers()
+                # start from the bundled snapshot, if any; the rest is downloaded
+                headers = blockchain.read_bundled_headers_snapshot()
+                with open(filename, 'wb') as f:
+                    f.write(headers)
+                    if length > len(headers):
+                        f.seek(length-1)
+                        f.write(b'\x00')
+                util.ensure_sparse_file(filename)
             b.update_size()
 
     def best_effort_reliable(func):
@@ -842,6 +1072,47 @@ class Network(Logger):
                 raise UntrustedServerReturnedError(original_exception=e) from e
         return wrapper
 
+    def coalesce_requests(is_immutable=None):
+        """Concurrent calls with the same arguments share one request, see
+        RequestCache. is_immutable(network, result, *args) tells whether
+        the result can be cached.
+        """
+        def decorator(func):
+            async def wrapper(self, *args, **kwargs):
+                key = (func.__name__, args, tuple(sorted(kwargs.items())))
+                return await self.request_cache.get(
+                    key, lambda: func(self, *args, **kwargs),
+                    is_immutable=(lambda result: is_immutable(self, result, *args)) if is_immutable else None)
+            return wrapper
+        return decorator
+
+    def is_raw_tx_for_txid(self, raw_tx, tx_hash: str) -> bool:
+        try:
+            return bh2u(get_tx_hashes_from_raw(bfh(raw_tx))[0][::-1]) == tx_hash
+        except Exception:
+            return False
+
+    def cache_verified_merkle(self, tx_hash: str, merkle: dict) -> None:
+        """Caches a merkle branch once it has been verified against the
+        header, if the tx is deep enough for the branch not to change.
+        """
+        tx_height = merkle['block_height']
+        if tx_height + MIN_CONFIRMATIONS_TO_CACHE_MERKLE <= self.get_local_height():
+            self.request_cache.put(self._merkle_cache_key(tx_hash, tx_height), merkle)
+
+    def uncache_merkle(self, tx_hash: str, tx_height: int) -> bool:
+        """Forgets the cached merkle branch, e.g. if it failed verification
+        after a deep reorg. Returns whether one was cached.
+        """
+        return self.request_cache.discard(self._merkle_cache_key(tx_hash, tx_height))
+
+    def _merkle_cache_key(self, tx_hash: str, tx_height: int) -> Hashable:
+        # the key of get_merkle_for_transaction, see coalesce_requests
+        return ('get_merkle_for_transaction', (tx_hash, tx_height), ())
+
+    # branches from the server are not cached here, as they have not been
+    # verified yet; SPV caches them, see cache_verified_merkle
+    @coalesce_requests()
     @best_effort_reliable
     @catch_server_exceptions
     async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int) -> dict:
@@ -851,6 +1122,45 @@ class Network(Logger):
             raise Exception(f"{repr(tx_height)} is not a block height")
         return await self.interface.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
 
+    async def get_merkle_for_transactions(self, txs: Sequence[Tuple[str, int]]) -> List:
+        """Returns the merkle branches for (tx_hash, tx_height) pairs, in order.
+        Where the server returned an error, an UntrustedServerReturnedError
+        is returned in place. Cached branches and branches that are already
+        being requested are not requested again; the others are requested
+        in one batch.
+        """
+        to_request = []
+        batch = None  # type: asyncio.Future  # set before any get_result() runs
+
+        def request_merkle(item):
+            index = len(to_request)
+            to_request.append(item)
+
+            async def get_result():
+                return (await batch)[index]
+            return get_result()
+
+        futs = [self.request_cache.get_future(self._merkle_cache_key(*item),
+                                              lambda item=tuple(item): request_merkle(item))
+                for item in txs]
+        if to_request:
+            batch = asyncio.ensure_future(self._get_merkle_for_transactions(to_request))
+        return await asyncio.gather(*[asyncio.shield(fut) for fut in futs])
+
+    @best_effort_reliable
+    async def _get_merkle_for_transactions(self, txs: Sequence[Tuple[str, int]]) -> List:
+        for tx_hash, tx_height in txs:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+            if not is_non_negative_integer(tx_height):
+                raise Exception(f"{repr(tx_height)} is not a block height")
+        results = await self.interface.session.send_request_batch(
+            [('blockchain.transaction.get_merkle', [tx_hash, tx_height]) for tx_hash, tx_height in txs],
+            raise_errors=False)
+        return [UntrustedServerReturnedError(original_exception=result)
+                if isinstance(result, aiorpcx.jsonrpc.CodeMessageError) else result
+                for result in results]
+
     @best_effort_reliable
     async def broadcast_transaction(self, tx, *, timeout=None) -> None:
         if timeout is None:
@@ -1017,6 +1327,7 @@ class Network(Logger):
             raise Exception(f"{repr(height)} is not a block height")
         return await self.interface.request_chunk(height, tip=tip, can_return_early=can_return_early)
 
+    @coalesce_requests(is_raw_tx_for_txid)
     @best_effort_reliable
     @catch_server_exceptions
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
@@ -1025,6 +1336,7 @@ class Network(Logger):
         return await self.interface.session.send_request('blockchain.transaction.get', [tx_hash],
                                                          timeout=timeout)
 
+    @coalesce_requests()
     @best_effort_reliable
     @catch_server_exceptions
     async def get_history_for_scripthash(self, sh: str) -> List[dict]:
@@ -1032,6 +1344,16 @@ class Network(Logger):
             raise Exception(f"{repr(sh)} is not a scripthash")
         return await self.interface.session.send_request('blockchain.scripthash.get_history', [sh])
 
+    @best_effort_reliable
+    @catch_server_exceptions
+    async def get_history_for_scripthashes(self, shs: Sequence[str]) -> List[List[dict]]:
+        for sh in shs:
+            if not is_hash256_str(sh):
+                raise Exception(f"{repr(sh)} is not a scripthash")
+        return await self.interface.session.send_request_batch(
+            [('blockchain.scripthash.get_history', [sh]) for sh in shs])
+
+    @coalesce_requests()
     @best_effort_reliable
     @catch_server_exceptions
     async def listunspent_for_scripthash(self, sh: str) -> List[dict]:
@@ -1039,6 +1361,7 @@ class Network(Logger):
             raise Exception(f"{repr(sh)} is not a scripthash")
         return await self.interface.session.send_request('blockchain.scripthash.listunspent', [sh])
 
+    @coalesce_requests()
     @best_effort_reliable
     @catch_server_exceptions
     async def get_balance_for_scripthash(self, sh: str) -> dict:
@@ -1046,6 +1369,18 @@ class Network(Logger):
             raise Exception(f"{repr(sh)} is not a scripthash")
         return await self.interface.session.send_request('blockchain.scripthash.get_balance', [sh])
 
+    async def for_scripthashes(self, func, shs: Sequence[str]) -> List:
+        """Calls func(sh) for all shs, e.g. get_balance_for_scripthash,
+        with up to MAX_CONCURRENT_SCRIPTHASH_REQUESTS requests in flight.
+        Returns the results in order.
+        """
+        slots = asyncio.Semaphore(MAX_CONCURRENT_SCRIPTHASH_REQUESTS)
+
+        async def request(sh):
+            async with slots:
+                return await func(sh)
+        return await asyncio.gather(*[request(sh) for sh in shs])
+
     def blockchain(self) -> Blockchain:
         interface = self.interface
         if interface and interface.blockchain is not None:
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+#
+# Benchmark for reconciling the balances of many deposit addresses against
+# a local stand-in server that answers every request after a delay, like a
+# remote server would. Compares calling getaddressbalance for one address
+# after the other (as a client had to) with one getaddressbalances call,
+# by time until all balances are known.
+#
+# usage: bench_address_queries.py [num_addresses] [latency_ms]
+
+import os
+import sys
+import time
+import asyncio
+
+import aiorpcx
+
+from electrum_audax import bitcoin
+from electrum_audax.commands import Commands
+from electrum_audax.interface import NotificationSession
+from electrum_audax.network import Network
+from electrum_audax.util import create_and_start_event_loop
+
+
+class StandInServerSession(aiorpcx.RPCSession):
+
+    latency = 0.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cost_hard_limit = 0  # disable aiorpcx resource limits
+
+    async def handle_request(self, request):
+        await asyncio.sleep(self.latency)
+        if request.method == 'blockchain.scripthash.get_balance':
+            return {'confirmed': 100000, 'unconfirmed': 0}
+        raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+
+
+class BenchNetwork:
+
+    for_scripthashes = Network.for_scripthashes
+
+    def __init__(self, loop, session):
+        self.asyncio_loop = loop
+        self.session = session
+
+    def run_from_another_thread(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop).result()
+
+    async def get_balance_for_scripthash(self, sh):
+        return await self.session.send_request('blockchain.scripthash.get_balance', [sh])
+
+
+async def connect(latency):
+    StandInServerSession.latency = latency
+    server = aiorpcx.Server(StandInServerSession, 'localhost', 0)
+    await server.listen()
+    port = server.server.sockets[0].getsockname()[1]
+    connector = aiorpcx.Connector(NotificationSession, 'localhost', port)
+    session = await connector.__aenter__()
+    return server, connector, session
+
+
+async def disconnect(server, connector):
+    await connector.__aexit__(None, None, None)
+    await server.close()
+
+
+def main():
+    num_addresses = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    latency = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    addresses = [bitcoin.hash160_to_p2pkh(os.urandom(20)) for i in range(num_addresses)]
+    loop, stop_loop, loop_thread = create_and_start_event_loop()
+    server, connector, session = asyncio.run_coroutine_threadsafe(connect(latency / 1000), loop).result()
+    cmds = Commands(config=None, wallet=None, network=BenchNetwork(loop, session))
+    print(f"balances of {num_addresses} addresses, {latency} ms server latency")
+    try:
+        t0 = time.time()
+        balances = {addr: cmds.getaddressbalance(addr) for addr in addresses}
+        t_single = time.time() - t0
+        t0 = time.time()
+        assert cmds.getaddressbalances(addresses) == balances
+        t_bulk = time.time() - t0
+        for name, t in (('one by one', t_single), ('bulk', t_bulk)):
+            print(f"{name:>10}: {t:6.2f}s, {num_addresses / t:7.0f} addresses/s")
+    finally:
+        asyncio.run_coroutine_threadsafe(disconnect(server, connector), loop).result()
+        loop.call_soon_threadsafe(stop_loop.set_result, 1)
+        loop_thread.join(timeout=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+#
+# Benchmark for the wallet balance after a new block, with a wallet of N
+# addresses that each received one coin. Compares throwing away the
+# balances of all addresses on every block and summing them up again
+# (as get_balance used to) with invalidating only what changed.
+#
+# usage: bench_balance.py [num_addresses] [num_blocks]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from electrum_audax.address_synchronizer import AddressSynchronizer
+from electrum_audax.bitcoin import hash160_to_p2pkh
+from electrum_audax.storage import WalletStorage
+
+
+class ClearingAddressSynchronizer(AddressSynchronizer):
+    """Clears all cached balances on new blocks, like before."""
+
+    def on_blockchain_updated(self, event, *args):
+        self._get_addr_balance_cache = {}
+
+    def get_balance(self, domain=None, *, excluded_addresses=None, excluded_coins=None):
+        if domain is None:
+            domain = self.get_addresses()
+        cc = uu = xx = 0
+        for addr in set(domain) - (excluded_addresses or set()):
+            c, u, x = self.get_addr_balance(addr, excluded_coins=excluded_coins)
+            cc += c
+            uu += u
+            xx += x
+        return cc, uu, xx
+
+
+def create_wallet_file(path, num_addresses):
+    storage = WalletStorage(path)
+    storage.put('stored_height', num_addresses + 1)
+    db = storage.db
+    for i in range(num_addresses):
+        addr = hash160_to_p2pkh(os.urandom(20))
+        txid = os.urandom(32).hex()
+        db.add_txo_addr(txid, addr, 0, 100000, False)
+        db.set_addr_history(addr, [(txid, i + 1)])
+    storage.write()
+
+
+def main():
+    num_addresses = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    num_blocks = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'wallet')
+        create_wallet_file(path, num_addresses)
+        print(f"wallet with {num_addresses} addresses, {num_blocks} blocks")
+        for name, cls in (('clear all', ClearingAddressSynchronizer), ('precise', AddressSynchronizer)):
+            adb = cls(WalletStorage(path))
+            t0 = time.time()
+            balance = adb.get_balance()
+            t_first = time.time() - t0
+            t0 = time.time()
+            for i in range(num_blocks):
+                adb.storage.put('stored_height', num_addresses + 2 + i)
+                adb.on_blockchain_updated('blockchain_updated')
+                assert adb.get_balance() == balance
+            t_block = (time.time() - t0) / num_blocks
+            print(f"{name:>10}: first get_balance {1000 * t_first:8.2f} ms, "
+                  f"get_balance after a block {1000 * t_block:8.2f} ms")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
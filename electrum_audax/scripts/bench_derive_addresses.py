@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# Benchmark for deriving the addresses of standard, segwit and 2of3
+# multisig wallets, in addresses/second. Compares re-parsing the branch
+# xpub for every key (as Xpub.derive_pubkey used to) with the cached
+# branch nodes of Xpub.derive_pubkeys, with and without a process pool.
+#
+# usage: bench_derive_addresses.py [num_addresses]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from electrum_audax import keystore
+from electrum_audax.bip32 import BIP32Node
+from electrum_audax.keystore import Xpub
+from electrum_audax.storage import WalletStorage
+from electrum_audax.wallet import Wallet, Multisig_Wallet
+
+
+def derive_addresses_one_by_one(wallet, for_change, indexes):
+    branch_xpubs = [BIP32Node.from_xkey(k.xpub).subkey_at_public_derivation((for_change,)).to_xpub()
+                    for k in wallet.get_keystores()]
+    addresses = []
+    for n in indexes:
+        pubkeys = [Xpub.get_pubkey_from_xpub(xpub, (n,)) for xpub in branch_xpubs]
+        if not isinstance(wallet, Multisig_Wallet):
+            pubkeys = pubkeys[0]
+        addresses.append(wallet.pubkeys_to_address(pubkeys))
+    return addresses
+
+
+def make_wallet(path, xtype, num_cosigners):
+    storage = WalletStorage(path)
+    xpubs = [BIP32Node.from_rootseed(os.urandom(32), xtype=xtype).to_xpub() for i in range(num_cosigners)]
+    if num_cosigners == 1:
+        storage.put('wallet_type', 'standard')
+        storage.put('keystore', keystore.from_xpub(xpubs[0]).dump())
+    else:
+        storage.put('wallet_type', '2of%d' % num_cosigners)
+        for i, xpub in enumerate(xpubs):
+            storage.put('x%d/' % (i + 1), keystore.from_xpub(xpub).dump())
+    return Wallet(storage)
+
+
+def main():
+    num_addresses = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print(f"deriving {num_addresses} addresses, {os.cpu_count()} cpus")
+        with ProcessPoolExecutor() as executor:
+            executor.submit(int).result()  # start a worker
+            for name, xtype, num_cosigners in (('standard', 'standard', 1),
+                                               ('segwit', 'p2wpkh', 1),
+                                               ('multisig', 'standard', 3)):
+                wallet = make_wallet(os.path.join(tmp_dir, name), xtype, num_cosigners)
+                indexes = range(100, 100 + num_addresses)
+                t0 = time.time()
+                expected = derive_addresses_one_by_one(wallet, False, indexes)
+                t_one = time.time() - t0
+                t0 = time.time()
+                assert wallet.derive_addresses(False, indexes) == expected
+                t_cached = time.time() - t0
+                wallet.executor = executor
+                t0 = time.time()
+                assert wallet.derive_addresses(False, indexes) == expected
+                t_pool = time.time() - t0
+                print(f"{name:>9}: one by one {num_addresses / t_one:8.0f}/s, "
+                      f"cached {num_addresses / t_cached:8.0f}/s, "
+                      f"cached + pool {num_addresses / t_pool:8.0f}/s")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Benchmark for the headers store in blockchain.py.
+# Compares the mmap/hash-index backend against reading the headers
+# file with open/seek/read and re-hashing every header (the old backend),
+# for random-height reads and for chainwork recomputation from scratch.
+#
+# usage: bench_headers.py [num_headers]
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from electrum_audax import constants, blockchain
+from electrum_audax.blockchain import Blockchain, HEADER_SIZE, deserialize_header, hash_header
+from electrum_audax.simple_config import SimpleConfig
+from electrum_audax.util import make_dir
+
+
+class LegacyBlockchain(Blockchain):
+    """Reads headers the way Blockchain used to: one file open per read,
+    and get_hash re-hashing the deserialized header every time."""
+
+    def read_raw_header(self, height):
+        if height < 0 or height > self.height():
+            return
+        with open(self.path(), 'rb') as f:
+            f.seek((height - self.forkpoint) * HEADER_SIZE)
+            h = f.read(HEADER_SIZE)
+        if h == bytes(HEADER_SIZE):
+            return None
+        return h
+
+    def get_hash(self, height):
+        if height == -1:
+            return '00' * 32
+        header = self.read_header(height)
+        if header is None:
+            raise blockchain.MissingHeader(height)
+        return hash_header(header)
+
+
+def make_headers_file(path, num_headers):
+    bits = 0x1d00ffff
+    with open(path, 'wb') as f:
+        for height in range(num_headers):
+            f.write(os.urandom(68)
+                    + (1500000000 + height * 60).to_bytes(4, 'little')
+                    + bits.to_bytes(4, 'little')
+                    + os.urandom(4))
+
+
+def bench(chain_class, config, num_headers, num_reads):
+    chain = chain_class(config=config, forkpoint=0, parent=None,
+                        forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+    heights = [random.randrange(1, num_headers) for i in range(num_reads)]
+    t0 = time.time()
+    for height in heights:
+        deserialize_header(chain.read_raw_header(height), height)
+    t_reads = time.time() - t0
+    t0 = time.time()
+    for height in heights:
+        chain.get_hash(height)
+    t_hashes = time.time() - t0
+    blockchain._CHAINWORK_CACHE.clear()
+    blockchain._CHAINWORK_CACHE['00' * 32] = 0
+    t0 = time.time()
+    chain.get_chainwork()
+    t_chainwork = time.time() - t0
+    return t_reads, t_hashes, t_chainwork
+
+
+def main():
+    num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    num_reads = 50000
+    # no checkpoints: targets are computed from the synthetic headers
+    constants.net.CHECKPOINTS = []
+    data_dir = tempfile.mkdtemp()
+    try:
+        make_dir(os.path.join(data_dir, 'forks'))
+        config = SimpleConfig({'electrum_path': data_dir})
+        make_headers_file(os.path.join(data_dir, 'blockchain_headers'), num_headers)
+        print(f"{num_headers} headers, {num_reads} random reads")
+        for name, chain_class in (('file+rehash', LegacyBlockchain), ('mmap+index', Blockchain)):
+            t_reads, t_hashes, t_chainwork = bench(chain_class, config, num_headers, num_reads)
+            print(f"{name:>12}: read_header {num_reads / t_reads:10.0f}/s, "
+                  f"get_hash {num_reads / t_hashes:10.0f}/s, "
+                  f"get_chainwork (cold) {t_chainwork:.3f}s")
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main()
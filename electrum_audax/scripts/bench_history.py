@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# Benchmark for AddressSynchronizer.get_history, with a wallet of N txs
+# over N / 2 addresses. Compares recomputing the deltas of every tx and
+# sorting them on each call (as get_history used to) with reading the
+# maintained history, in full and one page at a time.
+#
+# usage: bench_history.py [num_txs]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from collections import defaultdict
+
+from electrum_audax.address_synchronizer import AddressSynchronizer
+from electrum_audax.bitcoin import hash160_to_p2pkh
+from electrum_audax.storage import WalletStorage
+from electrum_audax.util import TxMinedInfo
+
+
+class ScanningAddressSynchronizer(AddressSynchronizer):
+    """Computes the history from every address, like before TxHistory."""
+
+    @AddressSynchronizer.with_local_height_cached
+    def get_history(self, domain=None, *, start=0, stop=None):
+        if domain is None:
+            domain = self.get_addresses()
+        domain = set(domain)
+        tx_deltas = defaultdict(int)
+        for addr in domain:
+            for tx_hash, height in self.get_address_history(addr):
+                tx_deltas[tx_hash] += self.get_tx_delta(tx_hash, addr)
+        history = []
+        for tx_hash in tx_deltas:
+            history.append((tx_hash, self.get_tx_height(tx_hash), tx_deltas[tx_hash]))
+        history.sort(key=lambda x: self.get_txpos(x[0]), reverse=True)
+        c, u, x = self.get_balance(domain)
+        balance = c + u + x
+        h2 = []
+        for tx_hash, tx_mined_status, delta in history:
+            h2.append((tx_hash, tx_mined_status, delta, balance))
+            balance -= delta
+        h2.reverse()
+        return h2[start:stop]
+
+
+def create_wallet_file(path, num_txs):
+    storage = WalletStorage(path)
+    storage.put('stored_height', num_txs + 1)
+    db = storage.db
+    addrs = [hash160_to_p2pkh(os.urandom(20)) for i in range(num_txs // 2)]
+    hist = defaultdict(list)
+    for i in range(num_txs):
+        addr = addrs[i % len(addrs)]
+        txid = os.urandom(32).hex()
+        db.add_txo_addr(txid, addr, 0, 100000, False)
+        db.add_verified_tx(txid, TxMinedInfo(height=i + 1, timestamp=i, txpos=0, header_hash='00' * 32))
+        hist[addr].append((txid, i + 1))
+    for addr in addrs:
+        db.set_addr_history(addr, hist[addr])
+    storage.write()
+
+
+def bench(f, num_runs):
+    t0 = time.time()
+    for i in range(num_runs):
+        result = f()
+    return (time.time() - t0) / num_runs, result
+
+
+def main():
+    num_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'wallet')
+        create_wallet_file(path, num_txs)
+        print(f"wallet with {num_txs} txs")
+        for name, cls in (('scan', ScanningAddressSynchronizer), ('index', AddressSynchronizer)):
+            adb = cls(WalletStorage(path))
+            addr = adb.get_addresses()[0]
+            t_first, h = bench(adb.get_history, 1)
+            t_full, h = bench(adb.get_history, 3)
+            assert len(h) == num_txs
+            t_page, page = bench(lambda: adb.get_history(start=num_txs - 100), 3)
+            assert page == h[-100:]
+            t_addr, addr_h = bench(lambda: adb.get_history([addr]), 3)
+            print(f"{name:>6}: first {1000 * t_first:8.2f} ms, full {1000 * t_full:8.2f} ms, "
+                  f"last 100 {1000 * t_page:8.2f} ms, one address {1000 * t_addr:6.2f} ms")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
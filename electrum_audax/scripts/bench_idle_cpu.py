@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#
+# Benchmark for the CPU used by an idle daemon with N loaded wallets,
+# i.e. wallets that are up to date, connected to a local stand-in server
+# that has nothing new to tell. Compares the synchronizer and verifier
+# loops polling every 100ms (as they used to) with the event-driven ones.
+#
+# usage: bench_idle_cpu.py [num_wallets] [seconds]
+
+import os
+import sys
+import time
+import asyncio
+import shutil
+import tempfile
+
+import aiorpcx
+
+from electrum_audax import address_synchronizer
+from electrum_audax.interface import NotificationSession
+from electrum_audax.synchronizer import Synchronizer
+from electrum_audax.util import create_and_start_event_loop, SilentTaskGroup
+from electrum_audax.verifier import SPV
+from electrum_audax.wallet import create_new_wallet
+
+
+class PollingSynchronizer(Synchronizer):
+
+    async def main(self):
+        self.wallet.set_up_to_date(False)
+        await self.group.spawn(self.send_history_requests())
+        for addr in self.wallet.get_addresses():
+            await self._add_address(addr)
+        while True:
+            await asyncio.sleep(0.1)
+            await aiorpcx.run_in_thread(self.wallet.synchronize)
+            up_to_date = self.is_up_to_date()
+            if (up_to_date != self.wallet.is_up_to_date()
+                    or up_to_date and self._processed_some_notifications):
+                self._processed_some_notifications = False
+                self.wallet.set_up_to_date(up_to_date)
+
+
+class PollingSPV(SPV):
+
+    async def main(self):
+        self.blockchain = self.network.blockchain()
+        while True:
+            await self._maybe_undo_verifications()
+            await self._request_proofs()
+            await asyncio.sleep(0.1)
+
+
+class StandInServerSession(aiorpcx.RPCSession):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cost_hard_limit = 0  # disable aiorpcx resource limits
+
+    async def handle_request(self, request):
+        if request.method == 'blockchain.scripthash.subscribe':
+            return None  # unused address
+        raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+
+
+class BenchBlockchain:
+
+    def height(self):
+        return 0
+
+
+class BenchInterface:
+
+    def __init__(self, session):
+        self.session = session
+        self.group = SilentTaskGroup()
+
+
+class BenchNetwork:
+
+    def __init__(self, loop, session):
+        self.asyncio_loop = loop
+        self.interface = BenchInterface(session)
+        self._blockchain = BenchBlockchain()
+
+    def register_callback(self, callback, events):
+        pass
+
+    def unregister_callback(self, callback):
+        pass
+
+    def trigger_callback(self, event, *args):
+        pass
+
+    def notify(self, key):
+        pass
+
+    def blockchain(self):
+        return self._blockchain
+
+    def get_local_height(self):
+        return 0
+
+
+def run_in_loop(loop, coro):
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def bench(loop, network, wallets, seconds, synchronizer_class, spv_class):
+    address_synchronizer.Synchronizer = synchronizer_class
+    address_synchronizer.SPV = spv_class
+    for wallet in wallets:
+        wallet.start_network(network)
+    while not all(wallet.is_up_to_date() for wallet in wallets):
+        time.sleep(0.1)
+    time.sleep(1)  # let it settle
+    t0, cpu0 = time.time(), time.process_time()
+    time.sleep(seconds)
+    cpu_time = time.process_time() - cpu0
+    wall_time = time.time() - t0
+    for wallet in wallets:
+        run_in_loop(loop, wallet.synchronizer.stop())
+        run_in_loop(loop, wallet.verifier.stop())
+        wallet.synchronizer = wallet.verifier = None
+    return 100 * cpu_time / wall_time
+
+
+def main():
+    num_wallets = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    loop, stopping_fut, loop_thread = create_and_start_event_loop()
+    data_dir = tempfile.mkdtemp()
+    try:
+        server = aiorpcx.Server(StandInServerSession, 'localhost', 0)
+        run_in_loop(loop, server.listen())
+        port = server.server.sockets[0].getsockname()[1]
+        connector = aiorpcx.Connector(NotificationSession, 'localhost', port)
+        session = run_in_loop(loop, connector.__aenter__())
+        network = BenchNetwork(loop, session)
+        wallets = [create_new_wallet(path=os.path.join(data_dir, f'wallet_{i}'),
+                                     encrypt_file=False, segwit=False)['wallet']
+                   for i in range(num_wallets)]
+        print(f"{num_wallets} idle wallets, CPU measured over {seconds}s")
+        for name, synchronizer_class, spv_class in (('polling', PollingSynchronizer, PollingSPV),
+                                                    ('event-driven', Synchronizer, SPV)):
+            cpu_percent = bench(loop, network, wallets, seconds, synchronizer_class, spv_class)
+            print(f"{name:>12}: {cpu_percent:6.2f}% CPU")
+        run_in_loop(loop, connector.__aexit__(None, None, None))
+        run_in_loop(loop, server.close())
+    finally:
+        loop.call_soon_threadsafe(stopping_fut.set_result, 1)
+        loop_thread.join(timeout=1)
+        shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main()
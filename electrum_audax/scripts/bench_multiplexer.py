@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#
+# Benchmark for running 1, 100 and 1000 watch-only wallets in one daemon
+# against a local stand-in server. Neighbouring wallets have half of their
+# addresses in common. Compares every wallet subscribing its addresses on
+# the session by itself (as the synchronizers used to) with sharing one
+# SubscriptionMultiplexer, by subscriptions sent to the server, CPU time
+# until all wallets have the status of all their addresses, CPU time to
+# unload them again, and memory held by the subscriptions.
+#
+# usage: bench_multiplexer.py [max_num_wallets] [addresses_per_wallet]
+
+import os
+import sys
+import time
+import asyncio
+import hashlib
+import tracemalloc
+
+import aiorpcx
+from aiorpcx import TaskGroup
+
+from electrum_audax import bitcoin
+from electrum_audax.interface import NotificationSession
+from electrum_audax.synchronizer import SynchronizerBase, SubscriptionMultiplexer
+
+
+class StandInServerSession(aiorpcx.RPCSession):
+
+    num_subscriptions = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cost_hard_limit = 0  # disable aiorpcx resource limits
+
+    async def handle_request(self, request):
+        if request.method == 'blockchain.scripthash.subscribe':
+            StandInServerSession.num_subscriptions += 1
+            return hashlib.sha256(request.args[0].encode('ascii')).hexdigest()
+        raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+
+
+class WatchingSynchronizer(SynchronizerBase):
+    """Keeps the statuses of the addresses of a watch-only wallet."""
+
+    def _reset(self):
+        super()._reset()
+        self.statuses = {}
+
+    async def _on_address_status(self, addr, status):
+        self.statuses[addr] = status
+
+    async def main(self):
+        pass
+
+
+class BenchInterface:
+
+    def __init__(self, session):
+        self.session = session
+        self.group = TaskGroup()
+
+
+class BenchNetwork:
+
+    def __init__(self, session):
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.interface = BenchInterface(session)
+        self.tx_store = None
+        self.subscription_multiplexer = None
+
+    def register_callback(self, callback, events):
+        pass
+
+    def trigger_callback(self, event, *args):
+        pass
+
+
+def make_wallet_addresses(num_wallets, addresses_per_wallet):
+    step = addresses_per_wallet // 2
+    pool = [bitcoin.hash160_to_p2pkh(os.urandom(20)) for i in range(step * (num_wallets + 1))]
+    return [pool[i * step:i * step + addresses_per_wallet] for i in range(num_wallets)]
+
+
+async def run(port, wallet_addresses, use_multiplexer):
+    StandInServerSession.num_subscriptions = 0
+    async with aiorpcx.Connector(NotificationSession, 'localhost', port) as session:
+        network = BenchNetwork(session)
+        mem0 = tracemalloc.get_traced_memory()[0]
+        t0 = time.process_time()
+        if use_multiplexer:
+            network.subscription_multiplexer = SubscriptionMultiplexer(network)
+        synchronizers = [WatchingSynchronizer(network) for addrs in wallet_addresses]
+        while any(synchronizer.interface is None for synchronizer in synchronizers):
+            await asyncio.sleep(0.01)
+        for synchronizer, addrs in zip(synchronizers, wallet_addresses):
+            for addr in addrs:
+                await synchronizer._add_address(addr)
+        while any(len(synchronizer.statuses) < len(addrs)
+                  for synchronizer, addrs in zip(synchronizers, wallet_addresses)):
+            await asyncio.sleep(0.01)
+        t_subscribe = time.process_time() - t0
+        mem = tracemalloc.get_traced_memory()[0] - mem0
+        t0 = time.process_time()
+        for synchronizer in synchronizers:
+            await synchronizer.stop()
+        await asyncio.sleep(0)  # let the synchronizers unsubscribe
+        if use_multiplexer:
+            await network.subscription_multiplexer.stop()
+        t_unload = time.process_time() - t0
+    return StandInServerSession.num_subscriptions, t_subscribe, t_unload, mem
+
+
+async def main():
+    max_num_wallets = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    addresses_per_wallet = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    server = aiorpcx.Server(StandInServerSession, 'localhost', 0)
+    await server.listen()
+    port = server.server.sockets[0].getsockname()[1]
+    tracemalloc.start()
+    print(f"watch-only wallets with {addresses_per_wallet} addresses each")
+    try:
+        for num_wallets in (1, 100, 1000):
+            if num_wallets > max_num_wallets:
+                continue
+            wallet_addresses = make_wallet_addresses(num_wallets, addresses_per_wallet)
+            for name, use_multiplexer in (('per wallet', False), ('multiplexer', True)):
+                num_subscriptions, t_subscribe, t_unload, mem = await run(port, wallet_addresses, use_multiplexer)
+                print(f"{num_wallets:>5} wallets, {name:>11}: {num_subscriptions:6} subscriptions, "
+                      f"cpu {t_subscribe:6.2f}s to sync, {t_unload:6.2f}s to unload, "
+                      f"{mem / 1024 / 1024:6.1f} MiB")
+    finally:
+        tracemalloc.stop()
+        await server.close()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# Benchmark for restoring a deep wallet from its xpub against a local
+# stand-in server that answers every request after a delay, like a remote
+# server would. Every 10th receiving address of the wallet has a coin.
+# Compares growing the address list one gap at a time with looking up a
+# whole restore window of addresses at once, by time until the wallet is
+# synchronized.
+#
+# usage: bench_restore.py [num_used_addresses] [latency_ms]
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+
+import aiorpcx
+from aiorpcx import TaskGroup
+
+from electrum_audax import bitcoin, keystore
+from electrum_audax.bip32 import BIP32Node
+from electrum_audax.interface import NotificationSession
+from electrum_audax.storage import WalletStorage
+from electrum_audax.synchronizer import Synchronizer, history_status
+from electrum_audax.transaction import Transaction, TxOutput
+from electrum_audax.wallet import Wallet, Deterministic_Wallet
+
+
+class StandInServerSession(aiorpcx.RPCSession):
+
+    txs = {}  # scripthash -> tx
+    txs_by_txid = {}
+    latency = 0.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cost_hard_limit = 0  # disable aiorpcx resource limits
+
+    async def handle_request(self, request):
+        await asyncio.sleep(self.latency)
+        if request.method == 'blockchain.scripthash.subscribe':
+            tx = self.txs.get(request.args[0])
+            return history_status([(tx.txid(), 1)]) if tx else None
+        if request.method == 'blockchain.scripthash.get_history':
+            tx = self.txs.get(request.args[0])
+            return [{'tx_hash': tx.txid(), 'height': 1}] if tx else []
+        if request.method == 'blockchain.transaction.get':
+            return str(self.txs_by_txid[request.args[0]])
+        raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+
+
+class BenchInterface:
+
+    def __init__(self, session):
+        self.session = session
+        self.group = TaskGroup()
+
+
+class BenchNetwork:
+
+    def __init__(self, session):
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.interface = BenchInterface(session)
+        self.tx_store = None
+        self.subscription_multiplexer = None
+
+    def register_callback(self, callback, events):
+        pass
+
+    def trigger_callback(self, event, *args):
+        pass
+
+    def notify(self, key):
+        pass
+
+    def get_local_height(self):
+        return 1000
+
+    async def get_history_for_scripthashes(self, shs):
+        return await self.interface.session.send_request_batch(
+            [('blockchain.scripthash.get_history', [sh]) for sh in shs])
+
+    async def get_transaction(self, tx_hash):
+        return await self.interface.session.send_request('blockchain.transaction.get', [tx_hash])
+
+
+def make_wallet(path, xpub):
+    storage = WalletStorage(path)
+    storage.put('wallet_type', 'standard')
+    storage.put('keystore', keystore.from_xpub(xpub).dump())
+    return Wallet(storage)
+
+
+def make_txs(wallet, num_used):
+    txs = {}
+    for addr in wallet.derive_addresses(False, range(0, 10 * num_used, 10)):
+        inputs = [{'type': 'coinbase', 'prevout_hash': '00' * 32, 'prevout_n': 0xffffffff,
+                   'scriptSig': '0101', 'sequence': 0xffffffff}]
+        outputs = [TxOutput(bitcoin.TYPE_ADDRESS, addr, 100000)]
+        txs[bitcoin.address_to_scripthash(addr)] = Transaction(str(Transaction.from_io(inputs, outputs)))
+    return txs
+
+
+async def restore(port, wallet, restore_window):
+    wallet.restore_window = restore_window
+    async with aiorpcx.Connector(NotificationSession, 'localhost', port) as session:
+        wallet.network = BenchNetwork(session)
+        t0 = time.time()
+        wallet.synchronizer = synchronizer = Synchronizer(wallet)
+        while synchronizer._time_to_up_to_date is None:
+            await asyncio.sleep(0.01)
+        t_restore = time.time() - t0
+        stats = synchronizer.get_sync_stats()
+        await synchronizer.stop()
+    return t_restore, stats
+
+
+async def main():
+    num_used = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    xpub = BIP32Node.from_rootseed(os.urandom(32), xtype='standard').to_xpub()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        txs = make_txs(make_wallet(os.path.join(tmp_dir, 'txs'), xpub), num_used)
+        StandInServerSession.txs = txs
+        StandInServerSession.txs_by_txid = {tx.txid(): tx for tx in txs.values()}
+        StandInServerSession.latency = latency / 1000
+        server = aiorpcx.Server(StandInServerSession, 'localhost', 0)
+        await server.listen()
+        port = server.server.sockets[0].getsockname()[1]
+        print(f"restoring a wallet with {num_used} used addresses, {latency} ms server latency")
+        try:
+            for name, restore_window in (('gap by gap', 0),
+                                         ('restore window', Deterministic_Wallet.restore_window)):
+                wallet = make_wallet(os.path.join(tmp_dir, name), xpub)
+                t_restore, stats = await restore(port, wallet, restore_window)
+                assert len(wallet.db.list_transactions()) == num_used
+                print(f"{name:>14}: synchronized after {t_restore:6.2f}s, "
+                      f"{stats['subscriptions']} subscriptions")
+        finally:
+            await server.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
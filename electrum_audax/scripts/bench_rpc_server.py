@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#
+# Benchmark for the daemon JSON-RPC server under many concurrent clients.
+# Every call waits for a reply from the network event loop after a delay,
+# like getaddressbalance waiting for the server. Compares the
+# VerifyingJSONRPCServer handling one request after the other in the daemon
+# thread (as the daemon used to do) with the AsyncJSONRPCServer on the event
+# loop, by calls/second, latency per call and calls that failed.
+#
+# usage: bench_rpc_server.py [num_calls] [concurrency] [latency_ms]
+
+import sys
+import time
+import asyncio
+import threading
+
+import aiohttp
+
+from electrum_audax.jsonrpc import VerifyingJSONRPCServer, AsyncJSONRPCServer
+from electrum_audax.util import create_and_start_event_loop
+
+
+def make_getbalance(loop, latency):
+    def getbalance(address):
+        # like network.run_from_another_thread
+        fut = asyncio.run_coroutine_threadsafe(asyncio.sleep(latency, result='1.0'), loop)
+        return fut.result()
+    return getbalance
+
+
+def start_polled_server(loop, latency):
+    server = VerifyingJSONRPCServer(('127.0.0.1', 0), logRequests=False,
+                                    rpc_user='user', rpc_password='secret')
+    server.timeout = 0.1
+    server.register_function(make_getbalance(loop, latency), 'getaddressbalance')
+    running = threading.Event()
+    running.set()
+
+    def run():
+        while running.is_set():
+            server.handle_request()
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    def stop():
+        running.clear()
+        thread.join()
+        server.server_close()
+    return server.socket.getsockname()[1], stop
+
+
+def start_async_server(loop, latency):
+    server = AsyncJSONRPCServer(('127.0.0.1', 0), rpc_user='user', rpc_password='secret', loop=loop)
+    server.register_function(make_getbalance(loop, latency), 'getaddressbalance')
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    return server.socket.getsockname()[1], stop
+
+
+async def run_clients(port, num_calls, concurrency, keep_alive):
+    latencies = []
+    failed = []
+    calls = iter(range(num_calls))
+
+    async def client(session):
+        for i in calls:
+            t0 = time.time()
+            request = {'jsonrpc': '2.0', 'method': 'getaddressbalance', 'params': ['addr%d' % i], 'id': i}
+            try:
+                async with session.post('http://127.0.0.1:%d/' % port, json=request) as response:
+                    assert (await response.json())['result'] == '1.0'
+            except aiohttp.ClientError:
+                # e.g. the connection was dropped
+                failed.append(i)
+                continue
+            latencies.append(time.time() - t0)
+
+    auth = aiohttp.BasicAuth('user', 'secret')
+    connector = aiohttp.TCPConnector(limit=concurrency, force_close=not keep_alive)
+    async with aiohttp.ClientSession(auth=auth, connector=connector) as session:
+        t0 = time.time()
+        await asyncio.gather(*[client(session) for i in range(concurrency)])
+        t = time.time() - t0
+    latencies.sort()
+    return len(latencies) / t, latencies[len(latencies) // 2], latencies[-1], len(failed)
+
+
+def main():
+    num_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    latency = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    loop, stop_loop, loop_thread = create_and_start_event_loop()
+    client_loop = asyncio.new_event_loop()
+    print(f"{num_calls} calls from {concurrency} concurrent clients, {latency} ms network latency per call")
+    try:
+        # the polled server closes the connection after every call
+        for name, start_server, keep_alive in (('polled', start_polled_server, False),
+                                               ('async', start_async_server, True)):
+            port, stop_server = start_server(loop, latency / 1000)
+            try:
+                rate, median, worst, num_failed = client_loop.run_until_complete(
+                    run_clients(port, num_calls, concurrency, keep_alive))
+            finally:
+                stop_server()
+            print(f"{name:>9}: {rate:7.0f} calls/s, latency median {median * 1000:6.0f} ms, "
+                  f"max {worst * 1000:6.0f} ms, {num_failed} failed")
+    finally:
+        client_loop.close()
+        loop.call_soon_threadsafe(stop_loop.set_result, 1)
+        loop_thread.join(timeout=1)
+
+
+if __name__ == '__main__':
+    main()
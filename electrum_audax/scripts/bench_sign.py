@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Benchmark for signing txs with 1, 100 and 1000 p2pkh or p2wpkh inputs.
+# Compares serializing and hashing the whole tx again for the sighash of
+# every input (as Transaction.serialize_preimage used to) with computing
+# the shared parts once per tx. Reports the sighashes/second, and the
+# signatures/second including the ECDSA signing.
+#
+# usage: bench_sign.py [max_num_inputs]
+
+import os
+import copy
+import sys
+import time
+
+from electrum_audax import ecc
+from electrum_audax.bitcoin import (TYPE_ADDRESS, hash160_to_p2pkh, public_key_to_p2pkh,
+                                    var_int, int_to_hex)
+from electrum_audax.crypto import sha256d
+from electrum_audax.transaction import Transaction, TxOutput
+from electrum_audax.util import bh2u, bfh
+
+
+class PerInputTransaction(Transaction):
+    """Builds every sighash preimage from scratch, like before."""
+
+    def serialize_preimage_bytes(self, i, shared_txdigest_fields=None):
+        nVersion = int_to_hex(self.version, 4)
+        nHashType = int_to_hex(1, 4)
+        nLocktime = int_to_hex(self.locktime, 4)
+        inputs = self.inputs()
+        outputs = self.outputs()
+        txin = inputs[i]
+        if self.is_segwit_input(txin):
+            hashPrevouts = bh2u(sha256d(bfh(''.join(self.serialize_outpoint(txin) for txin in inputs))))
+            hashSequence = bh2u(sha256d(bfh(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs))))
+            hashOutputs = bh2u(sha256d(bfh(''.join(self.serialize_output(o) for o in outputs))))
+            outpoint = self.serialize_outpoint(txin)
+            preimage_script = self.get_preimage_script(txin)
+            scriptCode = var_int(len(preimage_script) // 2) + preimage_script
+            amount = int_to_hex(txin['value'], 8)
+            nSequence = int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
+            preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
+        else:
+            txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.get_preimage_script(txin) if i==k else '') for k, txin in enumerate(inputs))
+            txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
+            preimage = nVersion + txins + txouts + nLocktime + nHashType
+        return bfh(preimage)
+
+
+def make_io(privkey, num_inputs, txin_type):
+    pubkey = privkey.get_public_key_hex()
+    inputs = [{'type': txin_type, 'prevout_hash': bh2u(os.urandom(32)), 'prevout_n': i,
+               'num_sig': 1, 'signatures': [None], 'pubkeys': [pubkey], 'x_pubkeys': [pubkey],
+               'address': public_key_to_p2pkh(bfh(pubkey)), 'sequence': 0xfffffffd, 'value': 100000}
+              for i in range(num_inputs)]
+    outputs = [TxOutput(TYPE_ADDRESS, hash160_to_p2pkh(os.urandom(20)), 100000 * num_inputs - 1000)]
+    return inputs, outputs
+
+
+def bench_sighashes(tx):
+    t0 = time.time()
+    shared_txdigest_fields = tx.calc_shared_txdigest_fields()
+    sighashes = [sha256d(tx.serialize_preimage_bytes(i, shared_txdigest_fields))
+                 for i in range(len(tx.inputs()))]
+    return len(sighashes) / (time.time() - t0), sighashes
+
+
+def bench_sign(tx, privkey):
+    pubkey = privkey.get_public_key_hex()
+    t0 = time.time()
+    tx.sign({pubkey: (privkey.get_secret_bytes(), True)})
+    assert tx.is_complete()
+    return len(tx.inputs()) / (time.time() - t0)
+
+
+def main():
+    max_num_inputs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    privkey = ecc.ECPrivkey(os.urandom(32))
+    for txin_type in ('p2pkh', 'p2wpkh'):
+        for num_inputs in (1, 100, 1000):
+            if num_inputs > max_num_inputs:
+                continue
+            inputs, outputs = make_io(privkey, num_inputs, txin_type)
+            results = []
+            for name, cls in (('per input', PerInputTransaction), ('shared', Transaction)):
+                tx = cls.from_io(copy.deepcopy(inputs), outputs)
+                rate, sighashes = bench_sighashes(tx)
+                results.append((name, rate, sighashes, bench_sign(tx, privkey)))
+            assert results[0][2] == results[1][2]
+            for name, rate, sighashes, sign_rate in results:
+                print(f"{txin_type:>6} {num_inputs:>5} inputs, {name:>9}: "
+                      f"sighash {rate:9.0f}/s, sign {sign_rate:7.0f}/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+# Benchmark for signing a payout tx with many inputs from a password
+# protected BIP32 keystore, in inputs/second. Compares decrypting the xprv
+# and deriving the key of every input from the root (as
+# Software_KeyStore.sign_transaction used to) and signing one input after
+# the other, with get_keypairs deriving all keys from the cached branch
+# nodes and signing them in a batch, with and without a process pool.
+#
+# usage: bench_sign_keystore.py [num_inputs]
+
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from electrum_audax import keystore
+from electrum_audax.bip32 import BIP32Node
+from electrum_audax.bitcoin import TYPE_ADDRESS, hash160_to_p2pkh, pubkey_to_address
+from electrum_audax.keystore import BIP32_KeyStore, Software_KeyStore
+from electrum_audax.transaction import Transaction, TxOutput
+
+
+class PerKeyKeyStore(BIP32_KeyStore):
+    """Decrypts the xprv again for every key, like before."""
+
+    get_keypairs = Software_KeyStore.get_keypairs
+
+
+class PerInputTransaction(Transaction):
+    """Signs one input after the other, like before."""
+
+    def sign(self, keypairs, *, executor=None):
+        shared_txdigest_fields = self.calc_shared_txdigest_fields()
+        for i, txin in enumerate(self.inputs()):
+            pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
+            for j, x_pubkey in enumerate(x_pubkeys):
+                if x_pubkey in keypairs and not self.is_txin_complete(txin):
+                    sec, compressed = keypairs[x_pubkey]
+                    sig = self.sign_txin(i, sec, shared_txdigest_fields=shared_txdigest_fields)
+                    self.add_signature_to_txin(i, j, sig)
+        self.raw = self.serialize()
+
+
+def make_tx(cls, ks, num_inputs):
+    inputs = []
+    for i in range(num_inputs):
+        pubkey = ks.derive_pubkey(0, i)
+        inputs.append({'type': 'p2wpkh', 'prevout_hash': '%064x' % i, 'prevout_n': 0,
+                       'x_pubkeys': [ks.get_xpubkey(0, i)], 'pubkeys': [pubkey],
+                       'signatures': [None], 'num_sig': 1, 'value': 100000,
+                       'address': pubkey_to_address('p2wpkh', pubkey)})
+    outputs = [TxOutput(TYPE_ADDRESS, hash160_to_p2pkh(bytes(20)), 1000 * num_inputs)]
+    return cls.from_io(inputs, outputs)
+
+
+def main():
+    num_inputs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    password = 'secret'
+    ks = keystore.from_xprv(BIP32Node.from_rootseed(os.urandom(32), xtype='p2wpkh').to_xprv())
+    ks.update_password(None, password)
+    print(f"signing {num_inputs} inputs, {os.cpu_count()} cpus")
+    expected = None
+    with ProcessPoolExecutor() as executor:
+        executor.submit(int).result()  # start a worker
+        for name, ks_cls, tx_cls, pool in (('per key', PerKeyKeyStore, PerInputTransaction, None),
+                                           ('batch', BIP32_KeyStore, Transaction, None),
+                                           ('batch + pool', BIP32_KeyStore, Transaction, executor)):
+            k = ks_cls(ks.dump())
+            tx = make_tx(tx_cls, k, num_inputs)
+            t0 = time.time()
+            k.sign_transaction(tx, password, executor=pool)
+            t_sign = time.time() - t0
+            assert tx.is_complete()
+            if expected is None:
+                expected = tx.serialize()
+            assert tx.serialize() == expected
+            print(f"{name:>12}: {num_inputs / t_sign:8.1f} inputs/s, {t_sign:6.2f}s")
+
+
+if __name__ == '__main__':
+    main()
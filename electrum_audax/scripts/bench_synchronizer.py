@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+#
+# Benchmark for scripthash subscriptions in SynchronizerBase, against a
+# local stand-in server. Compares one request per address (like before
+# subscriptions were batched) with JSON-RPC batches.
+#
+# usage: bench_synchronizer.py [num_addresses]
+
+import os
+import sys
+import time
+import asyncio
+
+import aiorpcx
+from aiorpcx import TaskGroup
+
+from electrum_audax import bitcoin
+from electrum_audax.interface import NotificationSession
+from electrum_audax.synchronizer import SynchronizerBase
+
+
+class StandInServerSession(aiorpcx.RPCSession):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cost_hard_limit = 0  # disable aiorpcx resource limits
+
+    async def handle_request(self, request):
+        if request.method == 'blockchain.scripthash.subscribe':
+            return None  # unused address
+        raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+
+
+class BenchInterface:
+
+    def __init__(self, session):
+        self.session = session
+        self.group = TaskGroup()
+
+
+class BenchNetwork:
+
+    def __init__(self, session):
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.interface = BenchInterface(session)
+
+    def register_callback(self, callback, events):
+        pass
+
+
+class BenchSynchronizer(SynchronizerBase):
+
+    def _reset(self):
+        super()._reset()
+        self.num_statuses = 0
+
+    async def _on_address_status(self, addr, status):
+        self.num_statuses += 1
+
+    async def main(self):
+        pass
+
+
+async def bench(port, addresses, batch_size, max_batches_in_flight):
+    BenchSynchronizer.batch_size = batch_size
+    BenchSynchronizer.max_batches_in_flight = max_batches_in_flight
+    async with aiorpcx.Connector(NotificationSession, 'localhost', port) as session:
+        synchronizer = BenchSynchronizer(BenchNetwork(session))
+        while synchronizer.interface is None:
+            await asyncio.sleep(0.01)
+        t0 = time.time()
+        for addr in addresses:
+            await synchronizer._add_address(addr)
+        while synchronizer.num_statuses < len(addresses):
+            await asyncio.sleep(0.001)
+        t_up_to_date = time.time() - t0
+        stats = synchronizer.get_sync_stats()
+        await synchronizer.stop()
+    return stats['subscriptions_per_second'], t_up_to_date
+
+
+async def main():
+    num_addresses = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    addresses = [bitcoin.hash160_to_p2pkh(os.urandom(20)) for i in range(num_addresses)]
+    server = aiorpcx.Server(StandInServerSession, 'localhost', 0)
+    await server.listen()
+    port = server.server.sockets[0].getsockname()[1]
+    print(f"subscribing to {num_addresses} addresses")
+    try:
+        for name, batch_size, max_batches_in_flight in (
+                ('one request per address', 1, num_addresses),
+                ('batches', SynchronizerBase.batch_size, SynchronizerBase.max_batches_in_flight)):
+            rate, t_up_to_date = await bench(port, addresses, batch_size, max_batches_in_flight)
+            print(f"{name:>24}: {rate:8d} subscriptions/s, all statuses after {t_up_to_date:.2f}s")
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Benchmark for parsing txs and computing their txids, in txs/second.
+# Compares reading the tx through a BCDataStream and hashing the
+# re-serialized tx (as Transaction used to) with the byte-level parser and
+# the txid hashed from the raw bytes. The corpus is read from a wallet file
+# or from a text file with one raw tx in hex per line; without one, txs of
+# common shapes are generated.
+#
+# usage: bench_tx_parse.py [wallet_file | hex_file]
+
+import os
+import sys
+import time
+
+from electrum_audax import ecc
+from electrum_audax.bitcoin import (TYPE_ADDRESS, hash160_to_p2pkh, hash160_to_p2sh,
+                                    hash_to_segwit_addr)
+from electrum_audax.crypto import sha256d
+from electrum_audax.storage import WalletStorage
+from electrum_audax.transaction import (Transaction, TxOutput, BCDataStream, parse_input,
+                                        parse_output, construct_witness, PARTIAL_TXN_HEADER_MAGIC)
+from electrum_audax.util import bh2u, bfh
+
+
+class StreamTransaction(Transaction):
+    """Parses through a BCDataStream and hashes the re-serialized tx, like before."""
+
+    def deserialize(self, force_full_parse=False):
+        if self.raw is None or self._inputs is not None:
+            return
+        raw_bytes = bfh(self.raw)
+        assert raw_bytes[:5] != PARTIAL_TXN_HEADER_MAGIC
+        vds = BCDataStream()
+        vds.write(raw_bytes)
+        self.version = vds.read_int32()
+        n_vin = vds.read_compact_size()
+        self._segwit_ser = is_segwit = (n_vin == 0)
+        if is_segwit:
+            vds.read_bytes(1)
+            n_vin = vds.read_compact_size()
+        self._inputs = [parse_input(vds, full_parse=force_full_parse) for i in range(n_vin)]
+        outputs = [parse_output(vds, i) for i in range(vds.read_compact_size())]
+        self._outputs = [TxOutput(x['type'], x['address'], x['value']) for x in outputs]
+        if is_segwit:
+            for txin in self._inputs:
+                n = vds.read_compact_size()
+                w = [bh2u(vds.read_bytes(vds.read_compact_size())) for i in range(n)]
+                txin['witness'] = construct_witness(w) if n else '00'
+        self.locktime = vds.read_uint32()
+        self.is_partial_originally = False
+
+    def txid(self):
+        self.deserialize()
+        return bh2u(sha256d(bfh(self.serialize_to_network(witness=False)))[::-1])
+
+
+def make_tx(num_inputs, num_outputs, segwit):
+    pubkey = ecc.ECPrivkey(os.urandom(32)).get_public_key_hex()
+    inputs = [{'type': 'p2wpkh' if segwit else 'p2pkh', 'prevout_hash': bh2u(os.urandom(32)),
+               'prevout_n': i, 'num_sig': 1, 'signatures': ['30' * 71], 'pubkeys': [pubkey],
+               'x_pubkeys': [pubkey], 'sequence': 0xfffffffd, 'value': 100000}
+              for i in range(num_inputs)]
+    addresses = [hash160_to_p2pkh(os.urandom(20)), hash160_to_p2sh(os.urandom(20)),
+                 hash_to_segwit_addr(os.urandom(20), witver=0)]
+    outputs = [TxOutput(TYPE_ADDRESS, addresses[i % len(addresses)], 10000 + i)
+               for i in range(num_outputs)]
+    return str(Transaction.from_io(inputs, outputs))
+
+
+def load_corpus(path):
+    if path is None:
+        shapes = [(1, 2, False), (2, 2, False), (1, 2, True), (3, 1, True), (10, 2, False), (1, 20, False)]
+        return [make_tx(*shapes[i % len(shapes)]) for i in range(600)]
+    with open(path, 'rb') as f:
+        is_wallet = f.read(1) == b'{'
+    if is_wallet:
+        return [bh2u(raw) for raw in WalletStorage(path).db.transactions.values()]
+    with open(path) as f:
+        corpus = [line.strip() for line in f if line.strip()]
+    # only complete txs, as received from the network
+    return [raw for raw in corpus if bfh(raw[:10]) != PARTIAL_TXN_HEADER_MAGIC]
+
+
+def bench(cls, corpus):
+    t0 = time.time()
+    txids = []
+    for raw in corpus:
+        tx = cls(raw)
+        tx.inputs()
+        tx.outputs()
+        txids.append(tx.txid())
+    return len(corpus) / (time.time() - t0), txids
+
+
+def main():
+    corpus = load_corpus(sys.argv[1] if len(sys.argv) > 1 else None)
+    num_segwit = sum(raw[8:12] == '0001' for raw in corpus)
+    print(f"{len(corpus)} txs, {num_segwit} segwit")
+    expected = None
+    for name, cls in (('stream', StreamTransaction), ('bytes', Transaction)):
+        rate, txids = bench(cls, corpus)
+        if expected is None:
+            expected = txids
+        assert txids == expected
+        print(f"{name:>7}: parse + txid {rate:8.0f}/s")
+
+
+if __name__ == '__main__':
+    main()
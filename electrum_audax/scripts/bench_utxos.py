@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#
+# Benchmark for listing the coins of a wallet with N addresses, each of
+# which has received one coin; a fraction of the coins are spent or
+# unconfirmed. Compares rebuilding the coins of every address from its
+# history (as get_utxos used to) with querying the UTXO index.
+#
+# usage: bench_utxos.py [num_addresses]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from electrum_audax.address_synchronizer import AddressSynchronizer
+from electrum_audax.bitcoin import COINBASE_MATURITY, hash160_to_p2pkh
+from electrum_audax.storage import WalletStorage
+
+
+class ScanningAddressSynchronizer(AddressSynchronizer):
+    """Computes coins from the history of every address, like before the index."""
+
+    def get_addr_utxo(self, address):
+        coins, spent = self.get_addr_io(address)
+        for txi in spent:
+            coins.pop(txi)
+        out = {}
+        for txo, v in coins.items():
+            tx_height, value, is_cb = v
+            prevout_hash, prevout_n = txo.split(':')
+            out[txo] = {'address': address, 'value': value, 'prevout_n': int(prevout_n),
+                        'prevout_hash': prevout_hash, 'height': tx_height, 'coinbase': is_cb}
+        return out
+
+    @AddressSynchronizer.with_local_height_cached
+    def get_utxos(self, domain=None, *, excluded_addresses=None,
+                  mature_only=False, confirmed_only=False, nonlocal_only=False):
+        coins = []
+        if domain is None:
+            domain = self.get_addresses()
+        domain = set(domain)
+        if excluded_addresses:
+            domain = set(domain) - set(excluded_addresses)
+        for addr in domain:
+            for x in self.get_addr_utxo(addr).values():
+                if confirmed_only and x['height'] <= 0:
+                    continue
+                if mature_only and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
+                    continue
+                coins.append(x)
+        return coins
+
+
+def create_wallet_file(path, num_addresses):
+    storage = WalletStorage(path)
+    storage.put('stored_height', 2 * num_addresses)
+    db = storage.db
+    for i in range(num_addresses):
+        addr = hash160_to_p2pkh(os.urandom(20))
+        txid = os.urandom(32).hex()
+        height = i + 1 if i % 100 else 0
+        hist = [(txid, height)]
+        db.add_txo_addr(txid, addr, 0, 100000, False)
+        if i % 3 == 0:
+            # spent by a tx with no output to the wallet
+            txid2 = os.urandom(32).hex()
+            db.add_txi_addr(txid2, addr, '%s:0' % txid, 100000)
+            db.set_spent_outpoint(txid, 0, txid2)
+            hist.append((txid2, i + 2))
+        db.set_addr_history(addr, hist)
+    storage.write()
+
+
+def bench(f, num_runs):
+    t0 = time.time()
+    for i in range(num_runs):
+        result = f()
+    return (time.time() - t0) / num_runs, result
+
+
+def main():
+    num_addresses = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'wallet')
+        create_wallet_file(path, num_addresses)
+        print(f"wallet with {num_addresses} addresses")
+        for name, cls in (('scan', ScanningAddressSynchronizer), ('index', AddressSynchronizer)):
+            adb = cls(WalletStorage(path))
+            addr = adb.get_addresses()[1]
+            t_first, coins = bench(adb.get_utxos, 1)
+            t_all, coins = bench(adb.get_utxos, 5)
+            t_spendable, spendable = bench(lambda: adb.get_utxos(mature_only=True, confirmed_only=True), 5)
+            t_addr, addr_coins = bench(lambda: adb.get_addr_utxo(addr), 100)
+            print(f"{name:>6}: first get_utxos {1000 * t_first:8.2f} ms, "
+                  f"get_utxos {1000 * t_all:8.2f} ms ({len(coins)} coins), "
+                  f"confirmed {1000 * t_spendable:8.2f} ms ({len(spendable)} coins), "
+                  f"get_addr_utxo {1000 * t_addr:6.3f} ms")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Benchmark for verifying many signed messages and masternode announces, in
+# signatures/second. Compares parsing every pubkey again and recovering it
+# with affine point arithmetic in python-ecdsa (as ecc used to), with the
+# cached pubkeys and recovery/verification in libsecp256k1 (or jacobian
+# python-ecdsa without it), one by one and in a batch with a process pool.
+#
+# usage: bench_verify.py [num_signatures]
+
+import os
+import sys
+import time
+import contextlib
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+
+from electrum_audax import ecc, ecc_fast
+from electrum_audax.bitcoin import public_key_to_p2pkh
+from electrum_audax.masternode import MasternodeAnnounce, NetworkAddress, verify_announces
+from electrum_audax.util import bh2u
+
+
+@contextlib.contextmanager
+def old_behaviour():
+    """Parses every pubkey again and recovers it with affine points in
+    python-ecdsa, like before."""
+    with mock.patch.object(ecc, '_ser_to_python_ecdsa_pubkey', ecc._ser_to_python_ecdsa_pubkey.__wrapped__), \
+            mock.patch.object(ecc, 'PointJacobi', None), \
+            mock.patch.object(ecc_fast, 'is_using_fast_ecc', lambda: False), \
+            mock.patch.object(ecc_fast, 'is_using_fast_ecc_recovery', lambda: False):
+        yield
+
+
+def make_messages(keys, num):
+    items = []
+    for i in range(num):
+        key = keys[i % len(keys)]
+        message = b'message %d' % i
+        items.append((public_key_to_p2pkh(key.get_public_key_bytes()), key.sign_message(message, True), message))
+    return items
+
+
+def make_announces(keys, num):
+    announces = []
+    for i in range(num):
+        key = keys[i % len(keys)]
+        vin = {'prevout_hash': '%064x' % i, 'prevout_n': 0, 'scriptSig': '', 'sequence': 0xffffffff}
+        mnb = MasternodeAnnounce(vin=vin, addr=NetworkAddress('10.0.%d.%d:9333' % (i // 256 % 256, i % 256)),
+                                 collateral_key=key.get_public_key_hex(),
+                                 masternode_pubkey=bh2u(keys[0].get_public_key_bytes()),
+                                 protocol_version=70914, sig_time=1553596040)
+        mnb.sig = key.sign_message(mnb.serialize_for_sig(), True)
+        announces.append(mnb)
+    return announces
+
+
+def bench(name, num, f):
+    t0 = time.time()
+    results = f()
+    t = time.time() - t0
+    assert all(results) and len(results) == num
+    print(f"{name:>25}: {num / t:8.0f} sigs/s, {t:6.2f}s")
+
+
+def main():
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    keys = [ecc.ECPrivkey(os.urandom(32)) for i in range(num // 10 or 1)]
+    messages = make_messages(keys, num)
+    announces = make_announces(keys, num)
+    print(f"verifying {num} signatures, {os.cpu_count()} cpus, "
+          f"libsecp256k1: {ecc_fast.is_using_fast_ecc()}, recovery: {ecc_fast.is_using_fast_ecc_recovery()}")
+    with old_behaviour():
+        bench('messages one by one, old', num,
+              lambda: [ecc.verify_message_with_address(*item) for item in messages])
+        bench('announces one by one, old', num, lambda: [mnb.verify() for mnb in announces])
+    bench('messages one by one', num,
+          lambda: [ecc.verify_message_with_address(*item) for item in messages])
+    bench('messages batch', num, lambda: ecc.verify_messages_with_addresses(messages))
+    bench('announces batch', num, lambda: verify_announces(announces))
+    with ProcessPoolExecutor() as executor:
+        executor.submit(int).result()  # start a worker
+        bench('messages batch + pool', num,
+              lambda: ecc.verify_messages_with_addresses(messages, executor=executor))
+        bench('announces batch + pool', num, lambda: verify_announces(announces, executor=executor))
+
+
+if __name__ == '__main__':
+    main()
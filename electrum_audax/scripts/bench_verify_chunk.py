@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# Benchmark for chunk verification in blockchain.py, in headers/second.
+# Compares deserializing and hashing one header at a time (the old
+# verify_chunk) with the bulk path, with and without a process pool.
+#
+# usage: bench_verify_chunk.py [num_chunks]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from electrum_audax import constants, blockchain
+from electrum_audax.blockchain import Blockchain, deserialize_header, hash_header
+from electrum_audax.crypto import sha256d
+from electrum_audax.simple_config import SimpleConfig
+from electrum_audax.util import make_dir, bh2u
+
+
+def make_chunks(num_chunks):
+    chunks = []
+    prev_hash = bytes(32)
+    for index in range(num_chunks):
+        headers = []
+        for i in range(2016):
+            header = (4).to_bytes(4, 'little') + prev_hash + os.urandom(32) \
+                     + (1500000000 + index * 2016 + i).to_bytes(4, 'little') \
+                     + (0x207fffff).to_bytes(4, 'little') + os.urandom(4)
+            headers.append(header)
+            prev_hash = sha256d(header)
+        chunks.append(b''.join(headers))
+    return chunks
+
+
+def verify_chunk_one_by_one(chain, index, data):
+    prev_hash = chain.get_hash(index * 2016 - 1)
+    target = chain.get_target(index - 1)
+    for i in range(len(data) // 80):
+        height = index * 2016 + i
+        try:
+            expected_header_hash = chain.get_hash(height)
+        except blockchain.MissingHeader:
+            expected_header_hash = None
+        header = deserialize_header(data[i * 80:(i + 1) * 80], height)
+        chain.verify_header(header, prev_hash, target, expected_header_hash)
+        prev_hash = hash_header(header)
+
+
+def reset_chain(chain, base_chunk):
+    chain.invalidate_cached_headers()
+    with open(chain.path(), 'wb') as f:
+        f.write(base_chunk)
+    chain.update_size()
+
+
+def main():
+    num_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    constants.set_regtest()
+    chunks = make_chunks(num_chunks + 1)
+    hexchunks = [(index, bh2u(chunks[index])) for index in range(1, num_chunks + 1)]
+    num_headers = num_chunks * 2016
+    data_dir = tempfile.mkdtemp()
+    try:
+        make_dir(os.path.join(data_dir, 'forks'))
+        config = SimpleConfig({'electrum_path': data_dir})
+        chain = Blockchain(config=config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        blockchain.blockchains[constants.net.GENESIS] = chain
+        print(f"connecting {num_chunks} chunks")
+        # the first chunk is the base that is connected to; it is not verified
+        reset_chain(chain, chunks[0])
+        t0 = time.time()
+        for index in range(1, num_chunks + 1):
+            verify_chunk_one_by_one(chain, index, chunks[index])
+            chain.save_chunk(index, chunks[index])
+        print(f" one by one: {num_headers / (time.time() - t0):10.0f} headers/s")
+        reset_chain(chain, chunks[0])
+        t0 = time.time()
+        assert chain.connect_chunks(hexchunks) == num_chunks
+        print(f"       bulk: {num_headers / (time.time() - t0):10.0f} headers/s")
+        reset_chain(chain, chunks[0])
+        with ProcessPoolExecutor() as executor:
+            executor.submit(int).result()  # start a worker
+            t0 = time.time()
+            assert chain.connect_chunks(hexchunks, executor) == num_chunks
+            print(f"bulk + pool: {num_headers / (time.time() - t0):10.0f} headers/s")
+        chain.invalidate_cached_headers()
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main()
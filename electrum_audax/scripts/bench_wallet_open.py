@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# Benchmark for opening a wallet file with N transactions: time spent in
+# WalletStorage() and resident memory afterwards. Compares building a
+# Transaction object for every tx and converting every txi/txo entry to
+# a set at load time (as JsonDB.load_transactions used to) with keeping
+# raw txs as bytes, parsed on first access. Each measurement runs in a
+# fresh process.
+#
+# usage: bench_wallet_open.py [num_txs]
+
+import gc
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from electrum_audax import storage
+from electrum_audax.json_db import JsonDB
+from electrum_audax.storage import WalletStorage
+from electrum_audax.transaction import Transaction
+from electrum_audax.util import TxMinedInfo
+
+
+class EagerJsonDB(JsonDB):
+
+    def load_transactions(self):
+        super().load_transactions()
+        for tx_hash, raw_tx in self.transactions.items():
+            self.transactions[tx_hash] = Transaction(raw_tx.hex())
+        for t in self.txi, self.txo:
+            for d in t.values():
+                for addr, lst in d.items():
+                    d[addr] = set([tuple(x) for x in lst])
+
+
+def create_wallet_file(path, num_txs):
+    s = WalletStorage(path)
+    db = s.db
+    for i in range(num_txs):
+        # random bytes of the size of a typical tx; it is never deserialized
+        raw_tx = os.urandom(250).hex()
+        txid = os.urandom(32).hex()
+        db.add_transaction(txid, Transaction(raw_tx))
+        db.add_txo_addr(txid, 'addr%d' % (i % 1000), 0, 100000, False)
+        db.add_txi_addr(txid, 'addr%d' % (i % 1000), '%s:0' % os.urandom(32).hex(), 100000)
+        db.add_verified_tx(txid, TxMinedInfo(height=i, timestamp=i, txpos=0, header_hash=os.urandom(32).hex()))
+    s.write()
+
+
+def get_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(path, eager):
+    if eager:
+        storage.JsonDB = EagerJsonDB
+    gc.collect()
+    rss0 = get_rss()
+    t0 = time.time()
+    s = WalletStorage(path, manual_upgrades=True)
+    t_open = time.time() - t0
+    gc.collect()
+    print(t_open, get_rss() - rss0, len(s.db.transactions))
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], sys.argv[3] == 'eager')
+        return
+    num_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'wallet')
+        create_wallet_file(path, num_txs)
+        print(f"wallet with {num_txs} txs, {os.path.getsize(path) / 1e6:.2f} MB file")
+        for name in ('eager', 'lazy'):
+            out = subprocess.check_output([sys.executable, __file__, '--measure', path, name])
+            t_open, rss, n = out.split()
+            assert int(n) == num_txs
+            print(f"{name:>6}: open {float(t_open):6.2f}s, {int(rss) / 1e6:7.1f} MB resident")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# Benchmark for WalletStorage writes, with a wallet of N transactions.
+# Compares rewriting the whole db as JSON on every write (as the older
+# file format required) with appending the changes to the log. Reports
+# the latency of a write after a single label change, and the size of
+# the file after a number of such writes.
+#
+# usage: bench_wallet_storage.py [num_txs] [num_writes] [password]
+
+import os
+import sys
+import time
+import zlib
+import shutil
+import tempfile
+
+from electrum_audax import ecc
+from electrum_audax.storage import WalletStorage, STO_EV_USER_PW
+from electrum_audax.transaction import Transaction
+from electrum_audax.util import TxMinedInfo, bfh
+
+
+class FullRewriteStorage(WalletStorage):
+    """Writes the whole db every time, like before the log format."""
+
+    def _write(self):
+        if not self.db.modified():
+            return
+        s = self.db.dump()
+        if self.pubkey:
+            c = zlib.compress(bytes(s, 'utf8'))
+            s = ecc.ECPubkey(bfh(self.pubkey)).encrypt_message(c, self._get_encryption_magic()).decode('utf8')
+        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+        with open(temp_path, "w", encoding='utf-8') as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self._file_exists = True
+        self.db.set_modified(False)
+
+
+def fill_db(db, num_txs):
+    for i in range(num_txs):
+        # random bytes of the size of a typical tx; it is never deserialized
+        raw_tx = os.urandom(250).hex()
+        txid = os.urandom(32).hex()
+        db.add_transaction(txid, Transaction(raw_tx))
+        db.add_txo_addr(txid, 'addr%d' % (i % 1000), 0, 100000, False)
+        db.add_verified_tx(txid, TxMinedInfo(height=i, timestamp=i, txpos=0, header_hash=os.urandom(32).hex()))
+
+
+def bench(storage_class, path, num_txs, num_writes, password):
+    storage = storage_class(path)
+    if password:
+        storage.set_password(password, enc_version=STO_EV_USER_PW)
+    fill_db(storage.db, num_txs)
+    storage.write()
+    initial_size = os.path.getsize(path)
+    labels = {}
+    t0 = time.time()
+    for i in range(num_writes):
+        labels['label%d' % i] = 'some label'
+        storage.put('labels', labels)
+        storage.write()
+    latency = (time.time() - t0) / num_writes
+    return initial_size, os.path.getsize(path), latency
+
+
+def main():
+    num_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_writes = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    password = sys.argv[3] if len(sys.argv) > 3 else None
+    tmp_dir = tempfile.mkdtemp()
+    print(f"wallet with {num_txs} txs, {num_writes} writes of one label change"
+          f"{', encrypted' if password else ''}")
+    try:
+        for name, storage_class in (('full rewrite', FullRewriteStorage),
+                                    ('append-only log', WalletStorage)):
+            path = os.path.join(tmp_dir, name.replace(' ', '_'))
+            initial_size, size, latency = bench(storage_class, path, num_txs, num_writes, password)
+            print(f"{name:>16}: {1000 * latency:8.2f} ms/write, "
+                  f"file {initial_size / 1e6:.2f} MB -> {size / 1e6:.2f} MB")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+#
+# Creates a headers snapshot, to be bundled with the application,
+# from an existing (fully synced) headers file. Only the headers up
+# to the last checkpoint are included, as that is what can be verified
+# when the snapshot is imported.
+#
+# usage: make_headers_snapshot.py [--testnet] <blockchain_headers> <output>
+
+import os
+import sys
+
+from electrum_audax import constants, blockchain
+from electrum_audax.blockchain import HEADER_SIZE
+
+
+args = sys.argv[1:]
+if args and args[0] == '--testnet':
+    constants.set_testnet()
+    args = args[1:]
+try:
+    headers_file, output = args
+except ValueError:
+    print("usage: make_headers_snapshot.py [--testnet] <blockchain_headers> <output>")
+    sys.exit(1)
+
+num_headers = min(os.path.getsize(headers_file) // HEADER_SIZE,
+                  len(constants.net.CHECKPOINTS) * 2016)
+with open(headers_file, 'rb') as f:
+    headers = f.read(num_headers * HEADER_SIZE)
+if bytes(HEADER_SIZE) in (headers[i:i+HEADER_SIZE] for i in range(0, len(headers), HEADER_SIZE)):
+    print("headers file is not fully synced (it has missing headers)")
+    sys.exit(1)
+
+blockchain.write_headers_snapshot(output, headers)
+# make sure it can be imported
+num_imported = len(blockchain.read_headers_snapshot(output)) // HEADER_SIZE
+print(f"wrote {num_imported} headers to {output} ({os.path.getsize(output)} bytes, "
+      f"{num_imported * HEADER_SIZE} bytes uncompressed)")
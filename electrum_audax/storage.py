@@ -27,7 +27,9 @@ import threading
 import stat
 import hashlib
 import base64
+import struct
 import zlib
+from typing import List, Optional, Tuple
 
 from . import ecc
 from .util import profiler, InvalidPassword, WalletFileException, bfh, standardize_path
@@ -45,6 +47,25 @@ def get_derivation_used_for_hw_device_encryption():
 # storage encryption version
 STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW = range(0, 3)
 
+# Wallet files are append-only logs: a header (magic, format version,
+# storage encryption version), then records of (length, crc32, payload).
+# The first record holds a snapshot of the whole db, each of the others
+# the changes made by one write. Payloads are a record type byte followed
+# by zlib-compressed JSON, and are encrypted one by one if the storage is.
+# Files in the older format (the whole db as JSON, maybe encrypted) are
+# converted the first time they are written to.
+WALLET_LOG_MAGIC = b'AUDAXWDB'
+WALLET_LOG_VERSION = 1
+WALLET_LOG_HEADER_SIZE = len(WALLET_LOG_MAGIC) + 2
+RECORD_HEADER = struct.Struct('<II')
+RECORD_SNAPSHOT, RECORD_CHANGES = b'S', b'C'
+# the log gets compacted into a new snapshot once the records appended
+# since the last one take more space than the snapshot itself (with a
+# lower bound, so that small wallets are not rewritten all the time),
+# or once there are too many of them to load quickly
+MIN_COMPACTION_SIZE = 1 << 20
+MAX_CHANGE_RECORDS = 500
+
 
 
 class WalletStorage(Logger):
@@ -58,18 +79,78 @@ class WalletStorage(Logger):
         DB_Class = JsonDB
         self.logger.info(f"wallet path {self.path}")
         self.pubkey = None
+        # records of the log not decoded yet, if the file is in that format
+        self._log_records = None  # type: Optional[List[bytes]]
+        self._log_size = 0
+        self._snapshot_size = 0
+        self._num_change_records = 0
+        self._needs_compaction = True
         if self.file_exists():
-            with open(self.path, "r", encoding='utf-8') as f:
-                self.raw = f.read()
-            self._encryption_version = self._init_encryption_version()
+            with open(self.path, "rb") as f:
+                raw = f.read()
+            if raw.startswith(WALLET_LOG_MAGIC):
+                self._read_log(raw)
+            else:
+                self.raw = raw.decode('utf-8')
+                self._encryption_version = self._init_encryption_version()
             if not self.is_encrypted():
-                self.db = DB_Class(self.raw, manual_upgrades=manual_upgrades)
+                if raw.startswith(WALLET_LOG_MAGIC):
+                    snapshot, changes = self._decode_log_records(None)
+                    self.db = DB_Class(snapshot, manual_upgrades=manual_upgrades, changes=changes)
+                else:
+                    self.db = DB_Class(self.raw, manual_upgrades=manual_upgrades)
                 self.load_plugins()
         else:
             self._encryption_version = STO_EV_PLAINTEXT
             # avoid new wallets getting 'upgraded'
             self.db = DB_Class('', manual_upgrades=False)
 
+    def _read_log(self, raw: bytes) -> None:
+        if len(raw) < WALLET_LOG_HEADER_SIZE or raw[len(WALLET_LOG_MAGIC)] != WALLET_LOG_VERSION:
+            raise WalletFileException('Unsupported wallet file format')
+        self._encryption_version = raw[len(WALLET_LOG_MAGIC) + 1]
+        records = []
+        offset = WALLET_LOG_HEADER_SIZE
+        while offset + RECORD_HEADER.size <= len(raw):
+            length, checksum = RECORD_HEADER.unpack_from(raw, offset)
+            start = offset + RECORD_HEADER.size
+            payload = raw[start:start+length]
+            if len(payload) != length or zlib.crc32(payload) != checksum:
+                break
+            records.append(payload)
+            offset = start + length
+        if not records:
+            raise WalletFileException('Malformed wallet file (no snapshot)')
+        # a write that was interrupted leaves an incomplete record at the
+        # end; it is ignored, and dropped by compacting on the next write
+        if offset != len(raw):
+            self.logger.warning(f"ignoring incomplete record at the end of {self.path}")
+        self._needs_compaction = offset != len(raw)
+        self._log_records = records
+        self._log_size = offset
+        self._snapshot_size = RECORD_HEADER.size + len(records[0])
+        self._num_change_records = len(records) - 1
+
+    def _decode_log_records(self, ec_key) -> Tuple[str, List[str]]:
+        items = [self._decode_record(payload, ec_key) for payload in self._log_records]
+        if items[0][0] != RECORD_SNAPSHOT or any(kind != RECORD_CHANGES for kind, s in items[1:]):
+            raise WalletFileException('Malformed wallet file (unexpected record type)')
+        # no need to keep them around once decoded
+        self._log_records = None
+        return items[0][1], [s for kind, s in items[1:]]
+
+    def _decode_record(self, payload: bytes, ec_key) -> Tuple[bytes, str]:
+        if ec_key:
+            payload = ec_key.decrypt_message(payload, self._get_encryption_magic())
+        return payload[0:1], zlib.decompress(payload[1:]).decode('utf8')
+
+    def _encode_record(self, kind: bytes, s: str) -> bytes:
+        payload = kind + zlib.compress(bytes(s, 'utf8'))
+        if self.pubkey:
+            public_key = ecc.ECPubkey(bfh(self.pubkey))
+            payload = public_key.encrypt_message(payload, self._get_encryption_magic())
+        return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
 
     def load_plugins(self):
         wallet_type = self.db.get('wallet_type')
@@ -94,9 +175,20 @@ class WalletStorage(Logger):
         if not self.db.modified():
             return
         self.db.commit()
-        s = self.encrypt_before_writing(self.db.dump())
+        if (self._needs_compaction
+                or self.db.requires_full_write()
+                or self._log_size - self._snapshot_size > max(self._snapshot_size, MIN_COMPACTION_SIZE)
+                or self._num_change_records >= MAX_CHANGE_RECORDS):
+            self._compact()
+        else:
+            self._append_changes()
+        self.db.set_modified(False)
+
+    def _compact(self):
+        snapshot = self._encode_record(RECORD_SNAPSHOT, self.db.dump(compact=True))
+        s = WALLET_LOG_MAGIC + bytes([WALLET_LOG_VERSION, self._encryption_version]) + snapshot
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
-        with open(temp_path, "w", encoding='utf-8') as f:
+        with open(temp_path, "wb") as f:
             f.write(s)
             f.flush()
             os.fsync(f.fileno())
@@ -107,8 +199,23 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self._file_exists = True
+        self._log_size = len(s)
+        self._snapshot_size = len(snapshot)
+        self._num_change_records = 0
+        self._needs_compaction = False
         self.logger.info(f"saved {self.path}")
-        self.db.set_modified(False)
+
+    def _append_changes(self):
+        changes = self.db.dump_changes()
+        if changes is None:
+            return
+        record = self._encode_record(RECORD_CHANGES, changes)
+        with open(self.path, "ab") as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_size += len(record)
+        self._num_change_records += 1
 
     def file_exists(self):
         return self._file_exists
@@ -175,27 +282,19 @@ class WalletStorage(Logger):
 
     def decrypt(self, password):
         ec_key = self.get_eckey_from_password(password)
-        if self.raw:
+        changes = []
+        if self._log_records is not None:
+            s, changes = self._decode_log_records(ec_key)
+        elif self.raw:
             enc_magic = self._get_encryption_magic()
             s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
+            s = s.decode('utf8')
         else:
             s = None
         self.pubkey = ec_key.get_public_key_hex()
-        s = s.decode('utf8')
-        self.db = JsonDB(s, manual_upgrades=True)
+        self.db = JsonDB(s, manual_upgrades=True, changes=changes)
         self.load_plugins()
 
-    def encrypt_before_writing(self, plaintext: str) -> str:
-        s = plaintext
-        if self.pubkey:
-            s = bytes(s, 'utf8')
-            c = zlib.compress(s)
-            enc_magic = self._get_encryption_magic()
-            public_key = ecc.ECPubkey(bfh(self.pubkey))
-            s = public_key.encrypt_message(c, enc_magic)
-            s = s.decode('utf8')
-        return s
-
     def check_password(self, password):
         """Raises an InvalidPassword exception on invalid password"""
         if not self.is_encrypted():
@@ -24,7 +24,8 @@
 # SOFTWARE.
 import asyncio
 import hashlib
-from typing import Dict, List, TYPE_CHECKING
+import time
+from typing import Dict, List, Set, Sequence, Tuple, TYPE_CHECKING
 from collections import defaultdict
 
 from aiorpcx import TaskGroup, run_in_thread
@@ -56,6 +57,11 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
     """Subscribe over the network to a set of addresses, and monitor their statuses.
     Every time a status changes, run a coroutine provided by the subclass.
     """
+    # requests are sent to the server in JSON-RPC batches of up to batch_size,
+    # with at most max_batches_in_flight batches awaiting a response
+    batch_size = 100
+    max_batches_in_flight = 4
+
     def __init__(self, network: 'Network'):
         self.asyncio_loop = network.asyncio_loop
         NetworkJobOnDefaultServer.__init__(self, network)
@@ -68,6 +74,26 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         # Queues
         self.add_queue = asyncio.Queue()
         self.status_queue = asyncio.Queue()
+        # set when something happened that main might need to act on
+        self._wakeup = asyncio.Event()
+        self._subscription_slots = asyncio.Semaphore(self.max_batches_in_flight)
+        # statuses taken from status_queue that _on_address_status is handling
+        self._num_statuses_in_progress = 0
+        # stats
+        self._start_time = time.monotonic()
+        self._num_subscriptions = 0
+        self._subscription_batches_in_flight = 0
+        self._subscribing_since = None
+        self._subscription_time = 0.0
+
+    def get_sync_stats(self) -> dict:
+        subscription_time = self._subscription_time
+        if self._subscribing_since is not None:
+            subscription_time += time.monotonic() - self._subscribing_since
+        return {
+            'subscriptions': self._num_subscriptions,
+            'subscriptions_per_second': int(self._num_subscriptions / subscription_time) if subscription_time else 0,
+        }
 
     async def _start_tasks(self):
         try:
@@ -77,7 +103,11 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
                 await group.spawn(self.main())
         finally:
             # we are being cancelled now
-            self.session.unsubscribe(self.status_queue)
+            multiplexer = self.network.subscription_multiplexer
+            if multiplexer is not None:
+                multiplexer.unsubscribe(self.status_queue)
+            else:
+                self.session.unsubscribe(self.status_queue)
 
     def add(self, addr):
         asyncio.run_coroutine_threadsafe(self._add_address(addr), self.asyncio_loop)
@@ -87,33 +117,232 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         if addr in self.requested_addrs: return
         self.requested_addrs.add(addr)
         await self.add_queue.put(addr)
+        self._wakeup.set()
 
     async def _on_address_status(self, addr, status):
         """Handle the change of the status of an address."""
         raise NotImplementedError()  # implemented by subclasses
 
+    async def _get_batch(self, queue: asyncio.Queue) -> list:
+        """Waits for an item on the queue, and returns it together with
+        the items already queued after it, up to batch_size in total.
+        """
+        items = [await queue.get()]
+        while len(items) < self.batch_size and not queue.empty():
+            items.append(queue.get_nowait())
+        return items
+
     async def send_subscriptions(self):
-        async def subscribe_to_address(addr):
-            h = address_to_scripthash(addr)
-            self.scripthash_to_address[h] = addr
-            await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
-            self.requested_addrs.remove(addr)
+        async def subscribe_to_addresses(addrs):
+            if self._subscription_batches_in_flight == 0:
+                self._subscribing_since = time.monotonic()
+            self._subscription_batches_in_flight += 1
+            try:
+                hashes = [address_to_scripthash(addr) for addr in addrs]
+                for h, addr in zip(hashes, addrs):
+                    self.scripthash_to_address[h] = addr
+                await self._subscribe_to_scripthashes(hashes)
+                self.requested_addrs.difference_update(addrs)
+                self._num_subscriptions += len(addrs)
+                self._wakeup.set()
+            finally:
+                self._subscription_batches_in_flight -= 1
+                if self._subscription_batches_in_flight == 0:
+                    self._subscription_time += time.monotonic() - self._subscribing_since
+                    self._subscribing_since = None
+                self._subscription_slots.release()
 
         while True:
-            addr = await self.add_queue.get()
-            await self.group.spawn(subscribe_to_address, addr)
+            addrs = await self._get_batch(self.add_queue)
+            await self._subscription_slots.acquire()
+            await self.group.spawn(subscribe_to_addresses, addrs)
+
+    async def _subscribe_to_scripthashes(self, hashes: Sequence[str]):
+        """Returns once the current status of each of hashes is on status_queue."""
+        multiplexer = self.network.subscription_multiplexer
+        if multiplexer is not None:
+            await multiplexer.subscribe(hashes, self.status_queue)
+        else:
+            await self.session.subscribe_batch('blockchain.scripthash.subscribe',
+                                               [[h] for h in hashes], self.status_queue)
 
     async def handle_status(self):
+        async def on_address_status(addr, status):
+            try:
+                await self._on_address_status(addr, status)
+            finally:
+                self._num_statuses_in_progress -= 1
+                self._wakeup.set()
+
         while True:
             h, status = await self.status_queue.get()
             addr = self.scripthash_to_address[h]
-            await self.group.spawn(self._on_address_status, addr, status)
+            self._num_statuses_in_progress += 1
+            await self.group.spawn(on_address_status, addr, status)
             self._processed_some_notifications = True
+            self._wakeup.set()
 
     async def main(self):
         raise NotImplementedError()  # implemented by subclasses
 
 
+class SubscriptionMultiplexer(NetworkJobOnDefaultServer):
+    """Subscribes to scripthashes on behalf of all the synchronizers of a
+    daemon. Each scripthash is subscribed to once, however many wallets
+    watch it, and its statuses are put on the status queues of the
+    synchronizers watching it. The merkle branches requested by the
+    verifiers of the wallets go through one queue as well, so that they
+    are requested together, and only once if several wallets need them.
+    """
+    batch_size = SynchronizerBase.batch_size
+    max_batches_in_flight = SynchronizerBase.max_batches_in_flight
+
+    _get_batch = SynchronizerBase._get_batch
+
+    def __init__(self, network: 'Network'):
+        self.asyncio_loop = network.asyncio_loop
+        # who watches what; kept when the server changes
+        self.owners = defaultdict(set)  # type: Dict[str, Set[asyncio.Queue]]  # scripthash -> status queues
+        self.owned = defaultdict(set)  # type: Dict[asyncio.Queue, Set[str]]  # status queue -> scripthashes
+        # requests that were not answered yet; sent again when the server changes
+        self.requested = {}  # type: Dict[str, asyncio.Future]  # scripthash -> done once subscribed
+        self.requested_merkle = {}  # type: Dict[Tuple[str, int], asyncio.Future]  # (tx_hash, tx_height) -> branch
+        # stats
+        self._num_subscriptions = 0
+        self._num_merkle_requests = 0
+        self._num_coalesced_merkle_requests = 0
+        NetworkJobOnDefaultServer.__init__(self, network)
+
+    def _reset(self):
+        super()._reset()
+        self.statuses = {}  # scripthash -> status on the current server
+        self.add_queue = asyncio.Queue()  # of scripthashes
+        self.status_queue = asyncio.Queue()
+        self.merkle_queue = asyncio.Queue()  # of (tx_hash, tx_height)
+        self._subscription_slots = asyncio.Semaphore(self.max_batches_in_flight)
+        self._merkle_slots = asyncio.Semaphore(self.max_batches_in_flight)
+
+    def get_stats(self) -> dict:
+        return {
+            'scripthashes': len(self.owners),
+            'subscribers': len(self.owned),
+            'subscriptions': self._num_subscriptions,
+            'merkle_requests': self._num_merkle_requests,
+            'coalesced_merkle_requests': self._num_coalesced_merkle_requests,
+        }
+
+    async def _start_tasks(self):
+        # (re)send everything to the new server
+        for h in self.owners:
+            if h not in self.requested:
+                self.requested[h] = self.asyncio_loop.create_future()
+        for queue, items in ((self.add_queue, self.requested), (self.merkle_queue, self.requested_merkle)):
+            while not queue.empty():
+                queue.get_nowait()
+            for item in items:
+                queue.put_nowait(item)
+        try:
+            async with self.group as group:
+                await group.spawn(self.send_subscriptions())
+                await group.spawn(self.handle_status())
+                await group.spawn(self.send_merkle_requests())
+        finally:
+            # we are being cancelled now
+            self.session.unsubscribe(self.status_queue)
+
+    async def subscribe(self, hashes: Sequence[str], queue: asyncio.Queue):
+        """Puts the statuses of hashes on queue, (scripthash, status) pairs,
+        from now on. Returns once the current status of each is on queue.
+        """
+        futs = []
+        for h in hashes:
+            self.owners[h].add(queue)
+            self.owned[queue].add(h)
+            if h in self.statuses:
+                await queue.put((h, self.statuses[h]))
+                continue
+            fut = self.requested.get(h)
+            if fut is None:
+                fut = self.requested[h] = self.asyncio_loop.create_future()
+                await self.add_queue.put(h)
+            futs.append(fut)
+        if futs:
+            await asyncio.wait(futs)
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        for h in self.owned.pop(queue, ()):
+            owners = self.owners[h]
+            owners.discard(queue)
+            if not owners:
+                del self.owners[h]
+
+    async def send_subscriptions(self):
+        async def subscribe_to_scripthashes(hashes):
+            try:
+                await self.session.subscribe_batch('blockchain.scripthash.subscribe',
+                                                   [[h] for h in hashes], self.status_queue)
+                self._num_subscriptions += len(hashes)
+            finally:
+                self._subscription_slots.release()
+
+        while True:
+            hashes = await self._get_batch(self.add_queue)
+            await self._subscription_slots.acquire()
+            await self.group.spawn(subscribe_to_scripthashes, hashes)
+
+    async def handle_status(self):
+        while True:
+            h, status = await self.status_queue.get()
+            self.statuses[h] = status
+            for queue in list(self.owners.get(h, ())):
+                await queue.put((h, status))
+            fut = self.requested.pop(h, None)
+            if fut is not None and not fut.done():
+                fut.set_result(None)
+
+    async def get_merkle_for_transactions(self, txs: Sequence[Tuple[str, int]]) -> List:
+        """Like Network.get_merkle_for_transactions, batched together with
+        the branches requested by other wallets around the same time.
+        """
+        futs = []
+        for item in txs:
+            item = tuple(item)
+            fut = self.requested_merkle.get(item)
+            if fut is None:
+                fut = self.requested_merkle[item] = self.asyncio_loop.create_future()
+                await self.merkle_queue.put(item)
+            else:
+                self._num_coalesced_merkle_requests += 1
+            futs.append(fut)
+        await asyncio.wait(futs)
+        return [fut.result() for fut in futs]
+
+    async def send_merkle_requests(self):
+        async def request_merkle_branches(items):
+            try:
+                results = await self.network.get_merkle_for_transactions(items)
+            except asyncio.CancelledError:
+                raise  # the server changed; they are requested again
+            except Exception as e:
+                for item in items:
+                    fut = self.requested_merkle.pop(item)
+                    if not fut.done():
+                        fut.set_exception(e)
+            else:
+                self._num_merkle_requests += len(items)
+                for item, result in zip(items, results):
+                    fut = self.requested_merkle.pop(item)
+                    if not fut.done():
+                        fut.set_result(result)
+            finally:
+                self._merkle_slots.release()
+
+        while True:
+            items = await self._get_batch(self.merkle_queue)
+            await self._merkle_slots.acquire()
+            await self.group.spawn(request_merkle_branches, items)
+
+
 class Synchronizer(SynchronizerBase):
     '''The synchronizer keeps the wallet up-to-date with its set of
     addresses and their transactions.  It subscribes over the network
@@ -130,16 +359,75 @@ class Synchronizer(SynchronizerBase):
         super()._reset()
         self.requested_tx = {}
         self.requested_histories = {}
+        self.history_queue = asyncio.Queue()  # of (scripthash, future)
+        self._history_slots = asyncio.Semaphore(self.max_batches_in_flight)
+        self._num_history_requests = 0
+        self._time_to_up_to_date = None
+        # restore mode: addresses beyond the end of the wallet's address
+        # chains are looked up a whole window at a time, see _extend_lookahead
+        self._restoring = False
+        self._lookahead = {}  # addr -> (for_change, n), not in the wallet yet
+        self._lookahead_chains = {False: {}, True: {}}  # for_change -> n -> addr
+        self._lookahead_end = {False: 0, True: 0}  # for_change -> next n to look up
+        self._looked_up = set()
+
+    def get_sync_stats(self) -> dict:
+        stats = super().get_sync_stats()
+        stats['history_requests'] = self._num_history_requests
+        stats['lookahead_subscriptions'] = len(self._looked_up)
+        stats['seconds_to_up_to_date'] = (round(self._time_to_up_to_date, 3)
+                                          if self._time_to_up_to_date is not None else None)
+        return stats
 
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
 
     def is_up_to_date(self):
         return (not self.requested_addrs
+                and self.status_queue.empty()
+                and not self._num_statuses_in_progress
                 and not self.requested_histories
                 and not self.requested_tx)
 
+    async def _add_address(self, addr: str):
+        if addr in self._looked_up:
+            return  # already subscribed to as part of the lookahead
+        await super()._add_address(addr)
+
+    async def _extend_lookahead(self):
+        """Subscribes to the restore_window addresses that follow the last
+        address of each chain of the wallet."""
+        window = self.wallet.restore_window
+        for for_change in (False, True):
+            num = (self.wallet.db.num_change_addresses() if for_change
+                   else self.wallet.db.num_receiving_addresses())
+            chain = self._lookahead_chains[for_change]
+            for n in [n for n in chain if n < num]:
+                # the wallet has it now
+                self._lookahead.pop(chain.pop(n), None)
+            start = max(num, self._lookahead_end[for_change])
+            stop = num + window
+            if start >= stop:
+                continue
+            addrs = await run_in_thread(self.wallet.derive_addresses, for_change, range(start, stop))
+            self._lookahead_end[for_change] = stop
+            for n, addr in zip(range(start, stop), addrs):
+                self._lookahead[addr] = (for_change, n)
+                chain[n] = addr
+                self._looked_up.add(addr)
+                await super()._add_address(addr)
+
     async def _on_address_status(self, addr, status):
+        if addr in self._lookahead:
+            if status is None:
+                return
+            # the address has a history: add it, and all addresses
+            # before it, to the wallet, which moves the window on
+            for_change, n = self._lookahead.pop(addr)
+            chain = self._lookahead_chains[for_change]
+            start = min(chain)
+            addrs = [chain[i] for i in range(start, n + 1)]
+            await run_in_thread(self.wallet.add_derived_addresses, for_change, start, addrs)
         history = self.wallet.db.get_addr_history(addr)
         if history_status(history) == status:
             return
@@ -148,7 +436,7 @@ class Synchronizer(SynchronizerBase):
         # request address history
         self.requested_histories[addr] = status
         h = address_to_scripthash(addr)
-        result = await self.network.get_history_for_scripthash(h)
+        result = await self._get_history(h)
         self.logger.info(f"receiving history {addr} {len(result)}")
         hashes = set(map(lambda item: item['tx_hash'], result))
         hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
@@ -169,6 +457,37 @@ class Synchronizer(SynchronizerBase):
 
         # Remove request; this allows up_to_date to be True
         self.requested_histories.pop(addr)
+        # the wallet might need new addresses now
+        self._wakeup.set()
+
+    async def _get_history(self, h: str) -> List[dict]:
+        """Requests the history of a scripthash, in a batch
+        with the other history requests made around the same time.
+        """
+        fut = asyncio.get_event_loop().create_future()
+        await self.history_queue.put((h, fut))
+        return await fut
+
+    async def send_history_requests(self):
+        async def request_histories(items):
+            try:
+                results = await self.network.get_history_for_scripthashes([h for h, fut in items])
+            except Exception as e:
+                for h, fut in items:
+                    if not fut.done():
+                        fut.set_exception(e)
+            else:
+                self._num_history_requests += len(items)
+                for (h, fut), result in zip(items, results):
+                    if not fut.done():  # the requester might have been cancelled
+                        fut.set_result(result)
+            finally:
+                self._history_slots.release()
+
+        while True:
+            items = await self._get_batch(self.history_queue)
+            await self._history_slots.acquire()
+            await self.group.spawn(request_histories, items)
 
     async def _request_missing_txs(self, hist, *, allow_server_not_finding_tx=False):
         # "hist" is a list of [tx_hash, tx_height] lists
@@ -176,7 +495,7 @@ class Synchronizer(SynchronizerBase):
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
-            if self.wallet.db.get_transaction(tx_hash):
+            if self.wallet.db.has_transaction(tx_hash):
                 continue
             transaction_hashes.append(tx_hash)
             self.requested_tx[tx_hash] = tx_height
@@ -187,15 +506,21 @@ class Synchronizer(SynchronizerBase):
                 await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
 
     async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
-        try:
-            result = await self.network.get_transaction(tx_hash)
-        except UntrustedServerReturnedError as e:
-            # most likely, "No such mempool or blockchain transaction"
-            if allow_server_not_finding_tx:
-                self.requested_tx.pop(tx_hash)
-                return
-            else:
-                raise
+        tx_store = self.network.tx_store
+        raw_tx = tx_store.get(tx_hash) if tx_store else None
+        if raw_tx is not None:
+            result = raw_tx.hex()
+        else:
+            try:
+                result = await self.network.get_transaction(tx_hash)
+            except UntrustedServerReturnedError as e:
+                # most likely, "No such mempool or blockchain transaction"
+                if allow_server_not_finding_tx:
+                    self.requested_tx.pop(tx_hash)
+                    self._wakeup.set()
+                    return
+                else:
+                    raise
         tx = Transaction(result)
         try:
             tx.deserialize()  # see if raises
@@ -210,12 +535,16 @@ class Synchronizer(SynchronizerBase):
             raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
         tx_height = self.requested_tx.pop(tx_hash)
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+        self._wakeup.set()
         self.logger.info(f"received tx {tx_hash} height: {tx_height} bytes: {len(tx.raw)}")
         # callbacks
         self.wallet.network.trigger_callback('new_transaction', self.wallet, tx)
 
     async def main(self):
         self.wallet.set_up_to_date(False)
+        # a wallet without transactions is restored, or new
+        self._restoring = self.wallet.restore_window > 0 and not self.wallet.db.list_transactions()
+        await self.group.spawn(self.send_history_requests())
         # request missing txns, if any
         for addr in self.wallet.db.get_history():
             history = self.wallet.db.get_addr_history(addr)
@@ -226,15 +555,27 @@ class Synchronizer(SynchronizerBase):
         # add addresses to bootstrap
         for addr in self.wallet.get_addresses():
             await self._add_address(addr)
-        # main loop
+        # main loop; runs when woken up, e.g. when a history or tx was
+        # received, or an address added. run it once to begin with
+        self._wakeup.set()
         while True:
-            await asyncio.sleep(0.1)
+            await self._wakeup.wait()
+            self._wakeup.clear()
             await run_in_thread(self.wallet.synchronize)
+            if self._restoring:
+                await self._extend_lookahead()
             up_to_date = self.is_up_to_date()
+            if up_to_date and self._restoring:
+                # nothing found in the last window; from now on, addresses
+                # are only added one gap at a time by wallet.synchronize
+                self._restoring = False
             if (up_to_date != self.wallet.is_up_to_date()
                     or up_to_date and self._processed_some_notifications):
                 self._processed_some_notifications = False
                 self.wallet.set_up_to_date(up_to_date)
+                if up_to_date and self._time_to_up_to_date is None:
+                    self._time_to_up_to_date = time.monotonic() - self._start_time
+                    self.logger.info(f"up to date: {self.get_sync_stats()}")
                 self.wallet.network.trigger_callback('wallet_updated', self.wallet)
 
 
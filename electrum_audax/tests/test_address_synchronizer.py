@@ -0,0 +1,309 @@
+import os
+import random
+import shutil
+import tempfile
+
+from electrum_audax import ecc
+from electrum_audax.address_synchronizer import (AddressSynchronizer, TxHistory, TX_HEIGHT_LOCAL,
+                                                 TX_HEIGHT_UNCONFIRMED)
+from electrum_audax.bitcoin import TYPE_ADDRESS, COINBASE_MATURITY, public_key_to_p2pkh
+from electrum_audax.storage import WalletStorage
+from electrum_audax.transaction import Transaction, TxOutput
+
+from . import SequentialTestCase
+
+
+def make_address(i):
+    pubkey = ecc.ECPrivkey((i + 1).to_bytes(32, 'big')).get_public_key_hex()
+    return public_key_to_p2pkh(bytes.fromhex(pubkey)), pubkey
+
+
+def make_tx(prevouts, outputs, *, coinbase=False):
+    """prevouts: list of (prevout_hash, prevout_n, pubkey); outputs: list of (address, value)"""
+    if coinbase:
+        inputs = [{'type': 'coinbase', 'prevout_hash': '00' * 32, 'prevout_n': 0xffffffff,
+                   'scriptSig': '0101', 'sequence': 0xffffffff}]
+    else:
+        inputs = [{'type': 'p2pkh', 'prevout_hash': prevout_hash, 'prevout_n': prevout_n,
+                   'num_sig': 1, 'signatures': ['30' * 35], 'pubkeys': [pubkey], 'x_pubkeys': [pubkey],
+                   'sequence': 0xffffffff}
+                  for prevout_hash, prevout_n, pubkey in prevouts]
+    outputs = [TxOutput(TYPE_ADDRESS, address, value) for address, value in outputs]
+    tx = Transaction(str(Transaction.from_io(inputs, outputs)))
+    return tx.txid(), tx
+
+
+def get_utxos_by_scanning(adb, domain=None, **kwargs):
+    """get_utxos as computed from the history of every address."""
+    coins = []
+    local_height = adb.get_local_height()
+    for addr in (domain if domain is not None else adb.get_addresses()):
+        if addr in (kwargs.get('excluded_addresses') or ()):
+            continue
+        received, sent = adb.get_addr_io(addr)
+        for txo, (height, value, is_cb) in received.items():
+            if txo in sent:
+                continue
+            if kwargs.get('confirmed_only') and height <= 0:
+                continue
+            if kwargs.get('nonlocal_only') and height == TX_HEIGHT_LOCAL:
+                continue
+            if kwargs.get('mature_only') and is_cb and height + COINBASE_MATURITY > local_height:
+                continue
+            prevout_hash, prevout_n = txo.split(':')
+            coins.append({'address': addr, 'value': value, 'prevout_n': int(prevout_n),
+                          'prevout_hash': prevout_hash, 'height': height, 'coinbase': is_cb})
+    return coins
+
+
+def get_history_by_scanning(adb, domain=None):
+    """get_history as computed from the history of every address."""
+    if domain is None:
+        domain = adb.get_addresses()
+    tx_deltas = {}
+    for addr in domain:
+        for tx_hash, height in adb.get_address_history(addr):
+            tx_deltas[tx_hash] = tx_deltas.get(tx_hash, 0) + adb.get_tx_delta(tx_hash, addr)
+    history = []
+    balance = 0
+    for tx_hash in sorted(tx_deltas, key=lambda tx_hash: adb.get_txpos(tx_hash) + (tx_hash,)):
+        balance += tx_deltas[tx_hash]
+        history.append((tx_hash, adb.get_tx_height(tx_hash), tx_deltas[tx_hash], balance))
+    if balance != sum(adb.get_balance(domain)):
+        return []
+    return history
+
+
+def get_balance_by_scanning(adb, excluded_addresses=(), excluded_coins=()):
+    """get_balance as computed from the history of every address."""
+    cc = uu = xx = 0
+    local_height = adb.get_local_height()
+    for addr in set(adb.get_addresses()) - set(excluded_addresses):
+        received, sent = adb.get_addr_io(addr)
+        for txo, (height, v, is_cb) in received.items():
+            if txo in excluded_coins:
+                continue
+            if is_cb and height + COINBASE_MATURITY > local_height:
+                xx += v
+            elif height > 0:
+                cc += v
+            else:
+                uu += v
+            if txo in sent:
+                if sent[txo] > 0:
+                    cc -= v
+                else:
+                    uu -= v
+    return cc, uu, xx
+
+
+class AddressSynchronizerTestCase(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        storage = WalletStorage(os.path.join(self.user_dir, 'wallet'))
+        storage.put('stored_height', 1000)
+        self.adb = AddressSynchronizer(storage)
+        self.keys = [make_address(i) for i in range(5)]
+        for addr, pubkey in self.keys:
+            self.adb.add_address(addr)
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def add_tx(self, txid, tx, height):
+        self.adb.add_unverified_tx(txid, height)
+        self.assertTrue(self.adb.add_transaction(txid, tx))
+
+    def do_random_ops(self, num_ops, check):
+        rng = random.Random(42)
+        coins = [('%02x' % i * 32, 0, '02' + '33' * 32) for i in range(20)]
+        txids = []
+        for i in range(num_ops):
+            r = rng.random()
+            if r < 0.1 and txids:
+                txid = rng.choice(txids)
+                for txid in {txid} | self.adb.get_depending_transactions(txid):
+                    self.adb.remove_transaction(txid)
+                    txids.remove(txid)
+            elif r < 0.3 and txids:
+                self.adb.add_unverified_tx(rng.choice(txids), rng.choice([TX_HEIGHT_UNCONFIRMED, rng.randrange(1, 1000)]))
+            else:
+                spent = [coins.pop(rng.randrange(len(coins))) for _ in range(min(len(coins), rng.randrange(1, 3)))]
+                outputs = [rng.choice(self.keys) for _ in range(rng.randrange(1, 4))]
+                txid, tx = make_tx(spent, [(addr, rng.randrange(1, 10**6)) for addr, pk in outputs],
+                                   coinbase=not spent)
+                self.add_tx(txid, tx, rng.choice([TX_HEIGHT_LOCAL, TX_HEIGHT_UNCONFIRMED, rng.randrange(1, 1000)]))
+                txids.append(txid)
+                coins += [(txid, n, pk) for n, (addr, pk) in enumerate(outputs)]
+            check()
+
+
+class TestUTXOIndex(AddressSynchronizerTestCase):
+
+    def assert_utxos(self, domain=None, **kwargs):
+        key = lambda x: (x['prevout_hash'], x['prevout_n'])
+        expected = sorted(get_utxos_by_scanning(self.adb, domain, **kwargs), key=key)
+        self.assertEqual(expected, sorted(self.adb.get_utxos(domain, **kwargs), key=key))
+        return expected
+
+    def assert_all_utxos(self):
+        for kwargs in ({}, {'confirmed_only': True}, {'nonlocal_only': True}, {'mature_only': True}):
+            self.assert_utxos(**kwargs)
+            self.assert_utxos([self.keys[0][0], self.keys[1][0]], **kwargs)
+
+    def test_receive_and_spend(self):
+        (addr0, pk0), (addr1, pk1) = self.keys[:2]
+        txid1, tx1 = make_tx([('11' * 32, 0, '02' + '33' * 32)], [(addr0, 1000), (addr1, 2000)])
+        self.add_tx(txid1, tx1, 100)
+        self.assertEqual(2, len(self.assert_utxos()))
+        self.assertEqual(['%s:0' % txid1], list(self.adb.get_addr_utxo(addr0)))
+        txid2, tx2 = make_tx([(txid1, 0, pk0)], [(addr1, 900)])
+        self.add_tx(txid2, tx2, TX_HEIGHT_UNCONFIRMED)
+        coins = self.assert_utxos()
+        self.assertEqual({(txid1, 1), (txid2, 0)}, {(x['prevout_hash'], x['prevout_n']) for x in coins})
+        self.assertEqual({}, self.adb.get_addr_utxo(addr0))
+        self.assertEqual([(txid1, 1)], [(x['prevout_hash'], x['prevout_n'])
+                                        for x in self.adb.get_utxos(confirmed_only=True)])
+        # removing the spending tx makes the coin unspent again
+        self.adb.remove_transaction(txid2)
+        self.assertEqual(2, len(self.assert_utxos()))
+        self.assertIn('%s:0' % txid1, self.adb.get_addr_utxo(addr0))
+
+    def test_spend_received_before_funding_tx(self):
+        addr0, pk0 = self.keys[0]
+        txid1, tx1 = make_tx([('11' * 32, 0, '02' + '33' * 32)], [(addr0, 1000), (addr0, 3000)])
+        txid2, tx2 = make_tx([(txid1, 0, pk0)], [(addr0, 900)])
+        self.adb.get_utxos()  # build the index before adding txs
+        self.adb.add_unverified_tx(txid2, 101)
+        self.adb.add_transaction(txid2, tx2, allow_unrelated=True)
+        self.add_tx(txid1, tx1, 100)
+        coins = self.assert_utxos()
+        self.assertEqual({(txid1, 1), (txid2, 0)}, {(x['prevout_hash'], x['prevout_n']) for x in coins})
+
+    def test_height_changes(self):
+        addr0, pk0 = self.keys[0]
+        txid1, tx1 = make_tx([('11' * 32, 0, '02' + '33' * 32)], [(addr0, 1000)])
+        self.add_tx(txid1, tx1, TX_HEIGHT_UNCONFIRMED)
+        self.assert_all_utxos()
+        self.assertEqual([], self.adb.get_utxos(confirmed_only=True))
+        self.adb.add_unverified_tx(txid1, 500)
+        self.assert_all_utxos()
+        self.assertEqual(500, self.adb.get_utxos(confirmed_only=True)[0]['height'])
+        self.adb.remove_unverified_tx(txid1, 500)
+        self.assert_all_utxos()
+        self.assertEqual([], self.adb.get_utxos(nonlocal_only=True))
+        self.assertEqual(TX_HEIGHT_LOCAL, self.adb.get_utxos()[0]['height'])
+
+    def test_coinbase_maturity(self):
+        addr0, pk0 = self.keys[0]
+        txid1, tx1 = make_tx([], [(addr0, 5000)], coinbase=True)
+        self.add_tx(txid1, tx1, 1000 - COINBASE_MATURITY + 1)
+        self.assertEqual([], self.assert_utxos(mature_only=True))
+        self.assertEqual(1, len(self.assert_utxos()))
+        self.adb.storage.put('stored_height', 1001)
+        self.assertEqual(1, len(self.assert_utxos(mature_only=True)))
+
+    def test_matches_scanning_with_random_txs(self):
+        self.do_random_ops(60, self.assert_all_utxos)
+
+
+class TestHistory(AddressSynchronizerTestCase):
+
+    def assert_history(self):
+        history = self.adb.get_history()
+        self.assertTrue(history)
+        self.assertEqual(get_history_by_scanning(self.adb), history)
+        domain = [self.keys[0][0], self.keys[3][0]]
+        self.assertEqual(get_history_by_scanning(self.adb, domain), self.adb.get_history(domain))
+
+    def test_matches_scanning_with_random_txs(self):
+        self.do_random_ops(60, self.assert_history)
+
+    def test_range(self):
+        addr0, pk0 = self.keys[0]
+        txs = [make_tx([('%02x' % i * 32, 0, pk0)], [(addr0, 1000 * (i + 1))]) for i in range(10)]
+        for i, (txid, tx) in enumerate(txs):
+            self.add_tx(txid, tx, 100 - i)
+        history = self.adb.get_history()
+        self.assertEqual([txid for txid, tx in reversed(txs)], [x[0] for x in history])
+        self.assertEqual(55000, history[-1][3])
+        self.assertEqual(history[2:5], self.adb.get_history(start=2, stop=5))
+        self.assertEqual(history[8:], self.adb.get_history(start=8))
+        self.assertEqual(history[2:5], self.adb.get_history([addr0], start=2, stop=5))
+        # a tx getting mined at another height moves in the history
+        self.adb.add_unverified_tx(txs[0][0], 50)
+        history = self.adb.get_history()
+        self.assertEqual(txs[0][0], history[0][0])
+        self.assertEqual(1000, history[0][3])
+
+
+class TestTxHistory(SequentialTestCase):
+
+    def test_matches_sorted_list(self):
+        rng = random.Random(1)
+        TxHistory.BLOCK_SIZE, block_size = 4, TxHistory.BLOCK_SIZE
+        try:
+            h = TxHistory()
+            entries = {}
+            for i in range(500):
+                txid = '%02x' % rng.randrange(100)
+                if rng.random() < 0.3:
+                    h.remove(txid)
+                    entries.pop(txid, None)
+                else:
+                    txpos = (rng.randrange(20), rng.randrange(3))
+                    delta = rng.randrange(-1000, 1000)
+                    h.add(txid, txpos, delta)
+                    entries[txid] = (txpos, delta)
+                expected = []
+                balance = 0
+                for txid in sorted(entries, key=lambda txid: entries[txid][0] + (txid,)):
+                    balance += entries[txid][1]
+                    expected.append((txid, entries[txid][1], balance))
+                self.assertEqual(expected, h.get_range())
+                start, stop = rng.randrange(len(expected) + 1), rng.randrange(len(expected) + 1)
+                self.assertEqual(expected[start:stop], h.get_range(start, stop))
+                self.assertEqual(balance, h.get_balance())
+        finally:
+            TxHistory.BLOCK_SIZE = block_size
+
+
+class TestBalance(AddressSynchronizerTestCase):
+
+    def assert_balance(self):
+        self.assertEqual(get_balance_by_scanning(self.adb), self.adb.get_balance())
+        excluded_addresses = {self.keys[1][0]}
+        excluded_coins = {'%s:%d' % (x['prevout_hash'], x['prevout_n']) for x in self.adb.get_utxos()[::3]}
+        self.assertEqual(get_balance_by_scanning(self.adb, excluded_addresses, excluded_coins),
+                         self.adb.get_balance(excluded_addresses=excluded_addresses, excluded_coins=excluded_coins))
+
+    def test_matches_scanning_with_random_txs(self):
+        self.do_random_ops(60, self.assert_balance)
+
+    def test_new_block_only_invalidates_coinbase_addresses(self):
+        (addr0, pk0), (addr1, pk1) = self.keys[:2]
+        txid1, tx1 = make_tx([], [(addr0, 5000)], coinbase=True)
+        self.add_tx(txid1, tx1, 1000 - COINBASE_MATURITY + 2)
+        txid2, tx2 = make_tx([('11' * 32, 0, pk1)], [(addr1, 3000)])
+        self.add_tx(txid2, tx2, 900)
+        self.assertEqual((3000, 0, 5000), self.adb.get_balance())
+        for height in (1001, 1002):
+            self.adb.storage.put('stored_height', height)
+            self.adb.on_blockchain_updated('blockchain_updated')
+            self.assertIn(addr1, self.adb._get_addr_balance_cache)
+            self.assertEqual(height == 1002, addr0 not in self.adb._get_addr_balance_cache)
+            self.assertEqual(get_balance_by_scanning(self.adb), self.adb.get_balance())
+        self.assertEqual((8000, 0, 0), self.adb.get_balance())
+
+    def test_height_change_updates_balance(self):
+        addr0, pk0 = self.keys[0]
+        txid1, tx1 = make_tx([('11' * 32, 0, pk0)], [(addr0, 1000)])
+        self.add_tx(txid1, tx1, TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual((0, 1000, 0), self.adb.get_balance())
+        self.adb.add_unverified_tx(txid1, 900)
+        self.assertEqual((1000, 0, 0), self.adb.get_balance())
+        self.adb.remove_unverified_tx(txid1, 900)
+        self.assertEqual((0, 1000, 0), self.adb.get_balance())
@@ -1,5 +1,7 @@
 import base64
 import sys
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 
 from electrum_audax.bitcoin import (public_key_to_p2pkh, address_from_private_key,
                                    is_address, is_private_key,
@@ -8,7 +10,7 @@ from electrum_audax.bitcoin import (public_key_to_p2pkh, address_from_private_ke
                                    is_b58_address, address_to_scripthash, is_minikey,
                                    is_compressed_privkey, EncodeBase58Check, DecodeBase58Check,
                                    script_num_to_hex, push_script, add_number_to_script, int_to_hex,
-                                   op_codes, base_encode, base_decode, BitcoinException)
+                                   base_encode, base_decode, BitcoinException)
 from electrum_audax.bip32 import (BIP32Node, convert_bip32_intpath_to_strpath,
                                  xpub_from_xprv, xpub_type, is_xprv, is_bip32_derivation,
                                  is_xpub, convert_bip32_path_to_list_of_uint32,
@@ -182,6 +184,39 @@ class Test_bitcoin(SequentialTestCase):
         self.assertFalse(ecc.verify_message_with_address(addr1, b'wrong', msg1))
         self.assertFalse(ecc.verify_message_with_address(addr1, sig2, msg1))
 
+    @needs_test_with_all_ecc_implementations
+    @mock.patch.object(ecc, 'SIGNATURES_PER_JOB', 2)
+    @mock.patch.object(ecc, 'MIN_SIGNATURES_FOR_EXECUTOR', 3)
+    def test_verify_messages_with_addresses(self):
+        key = ecc.ECPrivkey(bfh('7e1255fddb52db1729fc3ceb21a46f95b8d9fe94cc83425e936a6c5223bb679d'))
+        addr = public_key_to_p2pkh(key.get_public_key_bytes())
+        msgs = [b'msg%d' % i for i in range(5)]
+        sigs = [key.sign_message(msg, True) for msg in msgs]
+        items = [(addr, sig, msg) for sig, msg in zip(sigs, msgs)]
+        items += [(addr, sigs[0], msgs[1]), (addr, b'wrong', msgs[0]),
+                  ('GaiL5FUg6v7CSYugqpDaasvL8MWedqXoCT', sigs[0], msgs[0])]
+        expected = [ecc.verify_message_with_address(*item) for item in items]
+        self.assertEqual(5 * [True] + 3 * [False], expected)
+        self.assertEqual(expected[:2], ecc.verify_messages_with_addresses(items[:2]))
+        self.assertEqual(expected, ecc.verify_messages_with_addresses(items))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(expected, ecc.verify_messages_with_addresses(items, executor=executor))
+        # libsecp256k1 or jacobian python-ecdsa recover the same pubkey as affine python-ecdsa
+        msg_hash = sha256d(ecc.msg_magic(msgs[0]))
+        self.assertEqual((key, True), ecc.ECPubkey.from_signature65(sigs[0], msg_hash))
+        with mock.patch.object(ecc_fast, 'is_using_fast_ecc_recovery', lambda: False), \
+                mock.patch.object(ecc, 'PointJacobi', None):
+            self.assertEqual((key, True), ecc.ECPubkey.from_signature65(sigs[0], msg_hash))
+            self.assertEqual(expected, [ecc.verify_message_with_address(*item) for item in items])
+
+    def test_pubkey_cache(self):
+        pubkey = bfh('02a6eeee0b2ec1bea855d555f8a5c78cb4854fb95d7034d1f0150d69965f8eb866')
+        hits = ecc._ser_to_python_ecdsa_pubkey.cache_info().hits
+        self.assertEqual(ecc.ECPubkey(pubkey), ecc.ECPubkey(bytearray(pubkey)))
+        self.assertGreater(ecc._ser_to_python_ecdsa_pubkey.cache_info().hits, hits)
+        with self.assertRaises(ecc.InvalidECPointException):
+            ecc.ECPubkey(b'\x02' + bytes(32))
+
     @needs_test_with_all_aes_implementations
     @needs_test_with_all_ecc_implementations
     def test_decrypt_message(self):
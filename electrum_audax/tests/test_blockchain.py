@@ -1,10 +1,12 @@
 import shutil
 import tempfile
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from electrum_audax import constants, blockchain
 from electrum_audax.simple_config import SimpleConfig
-from electrum_audax.blockchain import Blockchain, deserialize_header, hash_header
+from electrum_audax.blockchain import Blockchain, deserialize_header, hash_header, serialize_header
+from electrum_audax.crypto import sha256d
 from electrum_audax.util import bh2u, bfh, make_dir
 
 from . import SequentialTestCase
@@ -340,3 +342,396 @@ class TestBlockchain(SequentialTestCase):
 
         for b in (chain_u, chain_l, chain_z):
             self.assertTrue(all([b.can_connect(b.read_header(i), False) for i in range(b.height())]))
+
+    def test_hash_index_after_writes_and_swaps(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOPQR':
+            chain_u.save_header(self.HEADERS[name])
+        # warm up the index
+        for i in range(1, 10):
+            chain_u.get_hash(i)
+
+        # note: these test vectors do not link under sha256d, so fork manually
+        chain_l = Blockchain(config=self.config, forkpoint=6, parent=chain_u,
+                             forkpoint_hash=hash_header(self.HEADERS['G']),
+                             prev_hash=chain_u.get_hash(5))
+        open(chain_l.path(), 'w+').close()
+        blockchain.blockchains[chain_l.get_id()] = chain_l
+        for name in 'GHIJK':
+            chain_l.save_header(self.HEADERS[name])
+
+        # chains were swapped; the indexes must have followed the files
+        self.assertEqual(None, chain_l.parent)
+        for b in (chain_u, chain_l):
+            for height in range(1, b.height() + 1):
+                raw_header = b.read_raw_header(height)
+                self.assertEqual(hash_header(deserialize_header(raw_header, height)), b.get_hash(height))
+        self.assertEqual(hash_header(self.HEADERS['K']), chain_l.get_hash(10))
+        self.assertEqual(hash_header(self.HEADERS['R']), chain_u.get_hash(9))
+
+        # overwrite the tip of the best chain in place
+        chain_l.write(bfh(blockchain.serialize_header(self.HEADERS['S'])), 10 * 80)
+        self.assertEqual(hash_header(self.HEADERS['S']), chain_l.get_hash(10))
+        self.assertEqual(None, chain_l.read_raw_header(11))
+
+
+class TestVerifyChunk(SequentialTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        make_dir(os.path.join(self.data_dir, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.data_dir})
+        blockchain.blockchains = {}
+        self.chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        blockchain.blockchains[constants.net.GENESIS] = self.chain
+        # chunk 0 is written as-is; it would not verify against the regtest genesis
+        self.headers = self._make_linked_headers(3 * 2016)
+        with open(self.chain.path(), 'wb') as f:
+            f.write(b''.join(self.headers[:2016]))
+        self.chain.update_size()
+
+    def tearDown(self):
+        super().tearDown()
+        self.chain.invalidate_cached_headers()
+        shutil.rmtree(self.data_dir)
+
+    @staticmethod
+    def _make_linked_headers(num):
+        headers = []
+        prev_hash = bytes(32)
+        for height in range(num):
+            header = (4).to_bytes(4, 'little') + prev_hash + sha256d(str(height)) \
+                     + (1500000000 + height).to_bytes(4, 'little') \
+                     + (0x207fffff).to_bytes(4, 'little') + (height % 7).to_bytes(4, 'little')
+            headers.append(header)
+            prev_hash = sha256d(header)
+        return headers
+
+    def _chunk(self, index):
+        return b''.join(self.headers[index * 2016:(index + 1) * 2016])
+
+    def _verify_chunk_one_by_one(self, index, data):
+        # reference implementation: deserialize and hash each header
+        prev_hash = self.chain.get_hash(index * 2016 - 1)
+        for i in range(len(data) // 80):
+            header = deserialize_header(data[i * 80:(i + 1) * 80], index * 2016 + i)
+            Blockchain.verify_header(header, prev_hash, 0)
+            prev_hash = hash_header(header)
+
+    def test_hash_raw_headers(self):
+        data = self._chunk(1)
+        hashes = blockchain.hash_raw_headers(data)
+        self.assertEqual(2016 * 32, len(hashes))
+        for i in (0, 1, 1000, 2015):
+            header = deserialize_header(self.headers[2016 + i], 2016 + i)
+            self.assertEqual(hash_header(header), bh2u(hashes[i * 32:(i + 1) * 32][::-1]))
+
+    def test_verify_chunk_matches_per_header_path(self):
+        data = self._chunk(1)
+        self._verify_chunk_one_by_one(1, data)
+        self.chain.verify_chunk(1, data)
+        # partial chunk at the tip
+        self.chain.verify_chunk(1, data[:100 * 80])
+        # break the prev hash link of one header
+        bad = bytearray(data)
+        bad[500 * 80 + 4] ^= 1
+        bad = bytes(bad)
+        with self.assertRaises(Exception) as ctx1:
+            self._verify_chunk_one_by_one(1, bad)
+        with self.assertRaises(Exception) as ctx2:
+            self.chain.verify_chunk(1, bad)
+        self.assertEqual(str(ctx1.exception), str(ctx2.exception))
+        self.assertIn('prev hash mismatch', str(ctx2.exception))
+
+    def test_verify_chunk_against_existing_headers(self):
+        # headers we already have must not be replaced by different ones
+        self.assertTrue(self.chain.connect_chunk(1, bh2u(self._chunk(1))))
+        data = bytearray(self._chunk(1))
+        data[80 * 10 + 70] ^= 1
+        with self.assertRaises(Exception) as ctx:
+            self.chain.verify_chunk(1, bytes(data))
+        self.assertIn('hash mismatches with expected', str(ctx.exception))
+        self.assertIn(self.chain.get_hash(2016 + 10), str(ctx.exception))
+
+    def test_connect_chunks(self):
+        chunks = [(1, bh2u(self._chunk(1))), (2, bh2u(self._chunk(2)))]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(2, self.chain.connect_chunks(chunks, executor))
+        self.assertEqual(3 * 2016 - 1, self.chain.height())
+        self.assertEqual(bh2u(sha256d(self.headers[-1])[::-1]), self.chain.get_hash(3 * 2016 - 1))
+
+    def test_connect_chunks_stops_at_first_bad_chunk(self):
+        bad = bytearray(self._chunk(2))
+        bad[4] ^= 1
+        chunks = [(1, bh2u(self._chunk(1))), (2, bh2u(bad))]
+        self.assertEqual(1, self.chain.connect_chunks(chunks))
+        self.assertEqual(2 * 2016 - 1, self.chain.height())
+
+
+class TestHeadersSnapshot(SequentialTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.headers = TestVerifyChunk._make_linked_headers(2 * 2016 + 5)
+        # pretend the synthetic chain is the real one
+        hashes = [sha256d(header) for header in self.headers]
+        self._orig = constants.net.GENESIS, constants.net.CHECKPOINTS
+        constants.net.GENESIS = bh2u(hashes[0][::-1])
+        constants.net.CHECKPOINTS = [(bh2u(hashes[2015][::-1]), 0), (bh2u(hashes[4031][::-1]), 0)]
+        self.path = os.path.join(self.data_dir, 'snapshot')
+
+    def tearDown(self):
+        constants.net.GENESIS, constants.net.CHECKPOINTS = self._orig
+        shutil.rmtree(self.data_dir)
+        super().tearDown()
+
+    def test_roundtrip(self):
+        blockchain.write_headers_snapshot(self.path, b''.join(self.headers))
+        headers = blockchain.read_headers_snapshot(self.path)
+        # only whole chunks are kept
+        self.assertEqual(b''.join(self.headers[:2 * 2016]), headers)
+        self.assertLess(os.path.getsize(self.path), len(headers))
+
+    def test_must_match_checkpoints(self):
+        blockchain.write_headers_snapshot(self.path, b''.join(self.headers))
+        constants.net.CHECKPOINTS = [constants.net.CHECKPOINTS[0], ('00' * 32, 0)]
+        with self.assertRaises(blockchain.InvalidHeadersSnapshot) as ctx:
+            blockchain.read_headers_snapshot(self.path)
+        self.assertIn('checkpoint at height 4031', str(ctx.exception))
+
+    def test_must_not_go_beyond_checkpoints(self):
+        blockchain.write_headers_snapshot(self.path, b''.join(self.headers))
+        constants.net.CHECKPOINTS = constants.net.CHECKPOINTS[:1]
+        with self.assertRaises(blockchain.InvalidHeadersSnapshot):
+            blockchain.read_headers_snapshot(self.path)
+
+    def test_tampered_header(self):
+        headers = bytearray(b''.join(self.headers[:2016]))
+        headers[80 * 100 + 70] ^= 1
+        blockchain.write_headers_snapshot(self.path, bytes(headers))
+        with self.assertRaises(blockchain.InvalidHeadersSnapshot) as ctx:
+            blockchain.read_headers_snapshot(self.path)
+        self.assertIn('checkpoint at height 2015', str(ctx.exception))
+
+    def test_corrupted_file(self):
+        blockchain.write_headers_snapshot(self.path, b''.join(self.headers[:2016]))
+        with open(self.path, 'rb+') as f:
+            f.seek(-10, os.SEEK_END)
+            f.write(b'\x00' * 10)
+        with self.assertRaises(blockchain.InvalidHeadersSnapshot):
+            blockchain.read_headers_snapshot(self.path)
+
+    def test_truncated_file(self):
+        blockchain.write_headers_snapshot(self.path, b''.join(self.headers[:2016]))
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        for length in (len(blockchain.HEADERS_SNAPSHOT_MAGIC), 44):
+            with open(self.path, 'wb') as f:
+                f.write(data[:length])
+            with self.assertRaises(blockchain.InvalidHeadersSnapshot):
+                blockchain.read_headers_snapshot(self.path)
+
+
+class TestChainworkCache(SequentialTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        make_dir(os.path.join(self.data_dir, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.data_dir})
+        blockchain.blockchains = {}
+        # chainwork is only computed (and cached) on mainnet-like chains
+        self.main_headers = self._make_headers(bytes(32), 0, 3 * 2016 + 10, tag='main')
+        self._orig = constants.net.TESTNET, constants.net.GENESIS, constants.net.CHECKPOINTS
+        constants.net.TESTNET = False
+        constants.net.GENESIS = bh2u(sha256d(self.main_headers[0])[::-1])
+        constants.net.CHECKPOINTS = []
+        self._reset_chainwork_cache()
+        self.cache_path = os.path.join(self.data_dir, 'blockchain_chainwork')
+        blockchain.load_chainwork_cache(self.cache_path)
+        self.chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(self.chain.path(), 'wb').close()
+        self.chain.update_size()
+        blockchain.blockchains[constants.net.GENESIS] = self.chain
+
+    def tearDown(self):
+        for chain in blockchain.blockchains.values():
+            chain.invalidate_cached_headers()
+        self._reset_chainwork_cache()
+        constants.net.TESTNET, constants.net.GENESIS, constants.net.CHECKPOINTS = self._orig
+        shutil.rmtree(self.data_dir)
+        super().tearDown()
+
+    @staticmethod
+    def _reset_chainwork_cache():
+        blockchain._CHAINWORK_CACHE.clear()
+        blockchain._CHAINWORK_CACHE['00' * 32] = 0
+        blockchain._CHAINWORK_CACHE_HEIGHTS.clear()
+        blockchain._chainwork_cache_path = None
+        blockchain._chainwork_cache_dirty = False
+
+    @staticmethod
+    def _make_headers(prev_hash, start_height, num, tag):
+        headers = []
+        for height in range(start_height, start_height + num):
+            header = (4).to_bytes(4, 'little') + prev_hash + sha256d(f'{tag} {height}') \
+                     + (1500000000 + 60 * height).to_bytes(4, 'little') \
+                     + (0x1d00ffff).to_bytes(4, 'little') + (0).to_bytes(4, 'little')
+            headers.append(header)
+            prev_hash = sha256d(header)
+        return headers
+
+    def _save_chunks(self, chain, headers, first_index, last_index):
+        for index in range(first_index, last_index + 1):
+            chain.save_chunk(index, b''.join(headers[index * 2016:(index + 1) * 2016]))
+
+    def _fork(self, parent, headers, forkpoint):
+        header = deserialize_header(headers[forkpoint], forkpoint)
+        chain = parent.fork(header)
+        self._save_chunks(chain, headers, forkpoint // 2016, (len(headers) - 1) // 2016)
+        return chain
+
+    def _chainwork_from_scratch(self, chain):
+        saved = (dict(blockchain._CHAINWORK_CACHE), dict(blockchain._CHAINWORK_CACHE_HEIGHTS),
+                 blockchain._chainwork_cache_path)
+        self._reset_chainwork_cache()
+        try:
+            return chain.get_chainwork()
+        finally:
+            blockchain._CHAINWORK_CACHE.update(saved[0])
+            blockchain._CHAINWORK_CACHE_HEIGHTS.update(saved[1])
+            blockchain._chainwork_cache_path = saved[2]
+
+    def _read_cache_file(self):
+        with open(self.cache_path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(0, len(data) % blockchain.CHAINWORK_RECORD_SIZE)
+        records = {}
+        for i in range(0, len(data), blockchain.CHAINWORK_RECORD_SIZE):
+            record = data[i:i + blockchain.CHAINWORK_RECORD_SIZE]
+            records[bh2u(record[:32][::-1])] = (int.from_bytes(record[32:36], 'little'),
+                                                int.from_bytes(record[36:], 'big'))
+        return records
+
+    def _assert_cache_consistent(self):
+        in_memory = {block_hash: (height, blockchain._CHAINWORK_CACHE[block_hash])
+                     for block_hash, height in blockchain._CHAINWORK_CACHE_HEIGHTS.items()}
+        self.assertEqual(in_memory, self._read_cache_file())
+        for chain in blockchain.blockchains.values():
+            self.assertEqual(self._chainwork_from_scratch(chain), chain.get_chainwork())
+
+    def test_extended_as_chunks_are_saved(self):
+        self._save_chunks(self.chain, self.main_headers, 0, 1)
+        self.assertEqual({2015, 4031}, set(blockchain._CHAINWORK_CACHE_HEIGHTS.values()))
+        self._save_chunks(self.chain, self.main_headers, 2, 2)
+        self.assertEqual({2015, 4031, 6047}, set(blockchain._CHAINWORK_CACHE_HEIGHTS.values()))
+        self.assertEqual(3, len(self._read_cache_file()))
+        self._assert_cache_consistent()
+        # headers saved one by one extend it too
+        for height in range(3 * 2016, 3 * 2016 + 10):
+            self.chain.save_header(deserialize_header(self.main_headers[height], height))
+        self.assertEqual(3, len(self._read_cache_file()))
+        self._assert_cache_consistent()
+
+    def test_reload(self):
+        self._save_chunks(self.chain, self.main_headers, 0, 2)
+        chainwork = self.chain.get_chainwork()
+        records = self._read_cache_file()
+        self._reset_chainwork_cache()
+        # a partial record, as left by an interrupted append, is dropped
+        with open(self.cache_path, 'ab') as f:
+            f.write(bytes(10))
+        blockchain.load_chainwork_cache(self.cache_path)
+        self.assertEqual(records, self._read_cache_file())
+        self.assertEqual({2015, 4031, 6047}, set(blockchain._CHAINWORK_CACHE_HEIGHTS.values()))
+        # only the work in the last chunk is computed, the rest comes from the cache
+        heights = []
+        def chainwork_of_header_at_height(height):
+            heights.append(height)
+            return Blockchain.chainwork_of_header_at_height(self.chain, height)
+        self.chain.chainwork_of_header_at_height = chainwork_of_header_at_height
+        self.assertEqual(chainwork, self.chain.get_chainwork())
+        self.assertEqual([6047], heights)
+
+    def test_stale_entries_pruned_on_load(self):
+        self._save_chunks(self.chain, self.main_headers, 0, 2)
+        # the headers file got replaced by another chain, from height 4000
+        other_headers = self.main_headers[:4000] + self._make_headers(
+            sha256d(self.main_headers[3999]), 4000, 2 * 2016, tag='other')
+        self.chain.write(b''.join(other_headers[4000:]), 4000 * 80)
+        self._reset_chainwork_cache()
+        blockchain.read_blockchains(self.config)
+        self.assertEqual({2015}, set(blockchain._CHAINWORK_CACHE_HEIGHTS.values()))
+        self.assertEqual(1, len(self._read_cache_file()))
+        self.assertEqual(self._chainwork_from_scratch(blockchain.get_best_chain()),
+                         blockchain.get_best_chain().get_chainwork())
+
+    def test_fork_swaps(self):
+        self._save_chunks(self.chain, self.main_headers, 0, 1)
+        self.chain.save_chunk(2, b''.join(self.main_headers[2 * 2016:2 * 2016 + 100]))
+        # fork A becomes stronger than the main chain and they swap
+        headers_a = self.main_headers[:4100] + self._make_headers(
+            sha256d(self.main_headers[4099]), 4100, 2 * 2016, tag='a')
+        chain_a = self._fork(self.chain, headers_a, 4100)
+        self.assertEqual(constants.net.GENESIS, chain_a.get_id())
+        self.assertEqual(chain_a, blockchain.get_best_chain())
+        hash_a = bh2u(sha256d(headers_a[6047])[::-1])
+        self.assertEqual(6047, blockchain._CHAINWORK_CACHE_HEIGHTS[hash_a])
+        self._assert_cache_consistent()
+        # fork B forks off A and becomes even stronger
+        headers_b = headers_a[:5000] + self._make_headers(
+            sha256d(headers_a[4999]), 5000, 3 * 2016, tag='b')
+        chain_b = self._fork(chain_a, headers_b, 5000)
+        self.assertEqual(chain_b, blockchain.get_best_chain())
+        hash_b = bh2u(sha256d(headers_b[6047])[::-1])
+        # A's branch now lives in a fork file, so its entry is still valid
+        self.assertEqual(6047, blockchain._CHAINWORK_CACHE_HEIGHTS[hash_b])
+        self.assertEqual(6047, blockchain._CHAINWORK_CACHE_HEIGHTS[hash_a])
+        self._assert_cache_consistent()
+        # A's fork gets overwritten below its cached boundary (reorg within the fork)
+        self.assertTrue(chain_a.check_hash(6047, hash_a))
+        headers_c = headers_a[:5500] + self._make_headers(
+            sha256d(headers_a[5499]), 5500, 100, tag='c')
+        chain_a.save_chunk(2, b''.join(headers_c[2 * 2016:]))
+        self.assertFalse(chain_a.check_hash(6047, hash_a))
+        self.assertNotIn(hash_a, blockchain._CHAINWORK_CACHE)
+        self.assertNotIn(hash_a, self._read_cache_file())
+        self.assertIn(hash_b, blockchain._CHAINWORK_CACHE)
+        self._assert_cache_consistent()
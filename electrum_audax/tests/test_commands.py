@@ -1,9 +1,13 @@
+import asyncio
+import threading
 import unittest
 from unittest import mock
 from decimal import Decimal
 
 from electrum_audax.commands import Commands, eval_bool
-from electrum_audax import storage
+from electrum_audax import bitcoin, network, storage
+from electrum_audax.network import Network
+from electrum_audax.util import create_and_start_event_loop
 from electrum_audax.wallet import restore_wallet_from_text
 
 from . import TestCaseForTestnet
@@ -75,6 +79,104 @@ class TestCommands(unittest.TestCase):
         ciphertext = cmds.encrypt(pubkey, cleartext)
         self.assertEqual(cleartext, cmds.decrypt(pubkey, ciphertext))
 
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_wallet_commands_run_one_at_a_time(self, mock_write):
+        wallet = restore_wallet_from_text('p2wpkh:N9AVCYp19kCjeRF4TtBh36y73MvjraQAYLX8qWNzaxYvEJuKU78z',
+                                          path='if_this_exists_mocking_failed_648151893')['wallet']
+        cmds = Commands(config=None, wallet=wallet, network=None)
+        address = wallet.get_addresses()[0]
+        running = threading.Event()
+        done = threading.Event()
+
+        def other_command():
+            with wallet.command_lock:
+                running.set()
+                done.wait(5)
+        thread = threading.Thread(target=other_command)
+        thread.start()
+        running.wait(5)
+        results = []
+        waiting = threading.Thread(target=lambda: results.append(cmds.ismine(address)))
+        waiting.start()
+        waiting.join(0.1)
+        self.assertEqual([], results)
+        # commands without a wallet do not wait
+        self.assertTrue(cmds.validateaddress(address))
+        done.set()
+        waiting.join(5)
+        thread.join(5)
+        self.assertEqual([True], results)
+
+
+class MockNetwork:
+    """Answers every scripthash query for itself after a delay."""
+
+    for_scripthashes = Network.for_scripthashes
+
+    def __init__(self, loop):
+        self.asyncio_loop = loop
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.balances = {}
+
+    def run_from_another_thread(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop).result()
+
+    async def _request(self, result):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            return result
+        finally:
+            self.in_flight -= 1
+
+    async def get_balance_for_scripthash(self, sh):
+        # like coalesced requests, the same object for every caller
+        balance = self.balances.setdefault(sh, {'confirmed': 150000000, 'unconfirmed': -50000000})
+        return await self._request(balance)
+
+    async def get_history_for_scripthash(self, sh):
+        return await self._request([{'tx_hash': sh, 'height': 1}])
+
+    async def listunspent_for_scripthash(self, sh):
+        return await self._request([{'tx_hash': sh, 'tx_pos': 0, 'height': 1, 'value': 1}])
+
+
+class TestBulkAddressCommands(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop, self.stop_loop, self.loop_thread = create_and_start_event_loop()
+        self.network = MockNetwork(self.loop)
+        self.cmds = Commands(config=None, wallet=None, network=self.network)
+        self.addresses = [bitcoin.hash160_to_p2pkh(bytes([i]) * 20) for i in range(20)]
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.stop_loop.set_result, 1)
+        self.loop_thread.join(timeout=1)
+        super().tearDown()
+
+    @mock.patch.object(network, 'MAX_CONCURRENT_SCRIPTHASH_REQUESTS', 5)
+    def test_getaddressbalances(self):
+        balances = self.cmds.getaddressbalances(self.addresses + self.addresses[:3])
+        self.assertEqual(self.addresses, list(balances))
+        for addr in self.addresses:
+            self.assertEqual({'confirmed': '1.5', 'unconfirmed': '-0.5'}, balances[addr])
+            self.assertEqual(balances[addr], self.cmds.getaddressbalance(addr))
+        self.assertEqual(5, self.network.max_in_flight)
+
+    def test_getaddresshistories_and_unspents(self):
+        histories = self.cmds.getaddresshistories(self.addresses)
+        unspents = self.cmds.getaddressunspents(self.addresses)
+        for addr in self.addresses:
+            sh = bitcoin.address_to_scripthash(addr)
+            self.assertEqual([{'tx_hash': sh, 'height': 1}], histories[addr])
+            self.assertEqual(sh, unspents[addr][0]['tx_hash'])
+        self.assertEqual(len(self.addresses), self.network.max_in_flight)
+        with self.assertRaises(Exception):
+            self.cmds.getaddresshistories(self.addresses + ['not an address'])
+
 
 class TestCommandsTestnet(TestCaseForTestnet):
 
@@ -1,7 +1,7 @@
 import unittest
 import base64
 
-from electrum_audax.masternode import MasternodeAnnounce, MasternodePing, NetworkAddress
+from electrum_audax.masternode import MasternodeAnnounce, MasternodePing, NetworkAddress, verify_announces
 from electrum_audax.masternode_manager import parse_masternode_conf, MasternodeConfLine
 from electrum_audax import bitcoin
 from electrum_audax import ecc
@@ -81,6 +81,12 @@ class TestMasternode(unittest.TestCase):
         pk = bitcoin.public_key_to_p2pkh(bfh(announce.collateral_key))
         self.assertTrue(announce.verify())
 
+    def test_verify_announces(self):
+        announce = MasternodeAnnounce.deserialize(raw_announce)
+        bad_announce = MasternodeAnnounce.deserialize(raw_announce)
+        bad_announce.sig_time += 1
+        self.assertEqual([True, False, True], verify_announces([announce, bad_announce, announce]))
+
 class TestMasternodePing(unittest.TestCase):
     def test_serialize_for_sig(self):
         vin = {'prevout_hash': '27c7c43cfde0943d2397b9fd5106d0a1f6927074a5fa6dfcf7fe50a2cb6b8d10',
@@ -1,13 +1,19 @@
 import asyncio
+import os
+import shutil
 import tempfile
+import threading
 import unittest
 
+import aiorpcx
+
 from electrum_audax import constants
 from electrum_audax.simple_config import SimpleConfig
 from electrum_audax import blockchain
 from electrum_audax.interface import Interface
-from electrum_audax.crypto import sha256
-from electrum_audax.util import bh2u
+from electrum_audax.network import HeaderDownloader, RequestCache
+from electrum_audax.crypto import sha256, sha256d
+from electrum_audax.util import bh2u, make_dir
 
 
 class MockTaskGroup:
@@ -114,6 +120,242 @@ class TestNetwork(unittest.TestCase):
         self.assertEqual(self.interface.q.qsize(), 0)
 
 
+class MockElectrumXSession(aiorpcx.RPCSession):
+    """Serves blockchain.block.headers from a headers file."""
+
+    def __init__(self, headers_file, *args, corrupt=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.headers_file = headers_file
+        self.corrupt = corrupt
+        self.requested = []
+
+    async def handle_request(self, request):
+        assert request.method == 'blockchain.block.headers', request.method
+        start_height, count = request.args
+        self.requested.append(start_height // 2016)
+        with open(self.headers_file, 'rb') as f:
+            f.seek(start_height * 80)
+            data = bytearray(f.read(count * 80))
+        if self.corrupt:
+            data[4] ^= 1
+        return {'hex': bh2u(data), 'count': len(data) // 80, 'max': 2016}
+
+
+class MockHeadersInterface:
+
+    def __init__(self, server, session, tip):
+        self.server = server
+        self.session = session
+        self.tip = tip
+        self.ready = asyncio.Future()
+        self.ready.set_result(1)
+
+
+class MockDownloaderNetwork:
+
+    def __init__(self):
+        self.interfaces = {}
+        self.interfaces_lock = threading.Lock()
+
+
+class TestHeaderDownloader(unittest.TestCase):
+
+    NUM_CHUNKS = 6
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        make_dir(os.path.join(self.data_dir, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.data_dir})
+        blockchain.blockchains = {}
+        # fixture: a linked chain of headers, NUM_CHUNKS chunks and a bit
+        self.tip = self.NUM_CHUNKS * 2016 + 99
+        self.fixture = os.path.join(self.data_dir, 'fixture_headers')
+        prev_hash = bytes(32)
+        with open(self.fixture, 'wb') as f:
+            for height in range(self.tip + 1):
+                header = (4).to_bytes(4, 'little') + prev_hash + sha256d(str(height)) \
+                         + (1500000000 + height).to_bytes(4, 'little') \
+                         + (0x207fffff).to_bytes(4, 'little') + bytes(4)
+                f.write(header)
+                prev_hash = sha256d(header)
+        self.chain = blockchain.Blockchain(config=self.config, forkpoint=0, parent=None,
+                                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        blockchain.blockchains[constants.net.GENESIS] = self.chain
+        # chunk 0 is the local base; it would not verify against the regtest genesis
+        shutil.copyfile(self.fixture, self.chain.path())
+        with open(self.chain.path(), 'rb+') as f:
+            f.truncate(2016 * 80)
+        self.chain.update_size()
+
+    def tearDown(self):
+        self.chain.invalidate_cached_headers()
+        shutil.rmtree(self.data_dir)
+
+    def _run_download(self, corrupt_flags, cancelled_servers=()):
+        network = MockDownloaderNetwork()
+        downloader = HeaderDownloader(network, max_in_flight=4)
+        server_sessions = {}
+        request_chunk = downloader._request_chunk
+
+        async def cancellable_request_chunk(iface, index, size):
+            if iface.server in cancelled_servers:
+                # like aiorpcx cancelling the pending requests of a dropped server
+                raise asyncio.CancelledError()
+            return await request_chunk(iface, index, size)
+        downloader._request_chunk = cancellable_request_chunk
+
+        async def run():
+            servers = []
+            for i, corrupt in enumerate(corrupt_flags):
+                name = f'server{i}'
+                def factory(name=name, corrupt=corrupt):
+                    session = MockElectrumXSession(self.fixture, corrupt=corrupt)
+                    server_sessions[name] = session
+                    return session
+                server = aiorpcx.Server(factory, 'localhost', 0)
+                await server.listen()
+                servers.append((name, server))
+            connectors = []
+            try:
+                for name, server in servers:
+                    port = server.server.sockets[0].getsockname()[1]
+                    connector = aiorpcx.Connector(aiorpcx.RPCSession, 'localhost', port)
+                    session = await connector.__aenter__()
+                    connectors.append(connector)
+                    network.interfaces[name] = MockHeadersInterface(name, session, self.tip)
+                return await downloader.download(self.chain, 2016, self.tip)
+            finally:
+                for connector in connectors:
+                    await connector.__aexit__(None, None, None)
+                for name, server in servers:
+                    await server.close()
+
+        next_height = asyncio.get_event_loop().run_until_complete(run())
+        return next_height, downloader, server_sessions
+
+    def test_download_from_several_servers(self):
+        next_height, downloader, sessions = self._run_download([False, False, False])
+        self.assertEqual(self.tip + 1, next_height)
+        self.assertEqual(self.tip, self.chain.height())
+        self.assertEqual(bh2u(sha256d(self._read_fixture_header(self.tip))[::-1]),
+                         self.chain.get_hash(self.tip))
+        # every server got a share of the chunks
+        self.assertTrue(all(session.requested for session in sessions.values()))
+        stats = downloader.get_stats()
+        self.assertEqual(self.NUM_CHUNKS, stats['chunks_requested'])
+        self.assertEqual(0, stats['chunks_failed'])
+        self.assertEqual(self.tip + 1 - 2016, stats['headers_connected'])
+
+    def test_bad_chunks_are_retried_on_other_servers(self):
+        next_height, downloader, sessions = self._run_download([True, False])
+        self.assertEqual(self.tip + 1, next_height)
+        self.assertEqual(self.tip, self.chain.height())
+        self.assertTrue(sessions['server0'].requested)
+        stats = downloader.get_stats()
+        self.assertEqual(len(sessions['server0'].requested), stats['chunks_failed'])
+        self.assertEqual(self.NUM_CHUNKS + stats['chunks_failed'], stats['chunks_requested'])
+
+    def test_cancelled_chunks_are_retried_on_other_servers(self):
+        next_height, downloader, sessions = self._run_download([False, False], cancelled_servers=['server0'])
+        self.assertEqual(self.tip + 1, next_height)
+        self.assertEqual(self.tip, self.chain.height())
+        self.assertFalse(sessions['server0'].requested)
+        self.assertLess(0, downloader.get_stats()['chunks_failed'])
+
+    def test_gives_up_if_no_server_has_good_chunks(self):
+        next_height, downloader, sessions = self._run_download([True, True])
+        self.assertEqual(2016, next_height)
+        self.assertEqual(2015, self.chain.height())
+
+    def _read_fixture_header(self, height):
+        with open(self.fixture, 'rb') as f:
+            f.seek(height * 80)
+            return f.read(80)
+
+
+class TestRequestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = RequestCache(max_size=2)
+        self.num_requests = 0
+
+    async def _request(self, result, *, exc=None):
+        self.num_requests += 1
+        await asyncio.sleep(0.01)
+        if exc is not None:
+            raise exc
+        return result
+
+    def _run(self, coro):
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def test_concurrent_requests_are_coalesced(self):
+        async def run():
+            return await asyncio.gather(*[self.cache.get('key', lambda i=i: self._request(i)) for i in range(5)])
+        self.assertEqual(5 * [0], self._run(run()))
+        self.assertEqual(1, self.num_requests)
+        self.assertEqual({'hits': 0, 'misses': 1, 'coalesced': 4, 'in_flight': 0, 'cached': 0},
+                         self.cache.get_stats())
+        # not immutable, so it is requested again
+        self._run(self.cache.get('key', lambda: self._request(1)))
+        self.assertEqual(2, self.num_requests)
+
+    def test_immutable_results_are_cached(self):
+        is_immutable = lambda result: result != 'mutable'
+        for key in ('a', 'b', 'a', 'b', 'c', 'a'):
+            self._run(self.cache.get(key, lambda: self._request(key), is_immutable=is_immutable))
+        # 'a' was evicted by 'c'
+        self.assertEqual(4, self.num_requests)
+        self.assertEqual({'hits': 2, 'misses': 4, 'coalesced': 0, 'in_flight': 0, 'cached': 2},
+                         self.cache.get_stats())
+        self._run(self.cache.get('d', lambda: self._request('mutable'), is_immutable=is_immutable))
+        self.assertEqual(None, self.cache.get_cached('d'))
+
+    def test_errors_are_shared_but_not_cached(self):
+        async def run():
+            return await asyncio.gather(*[self.cache.get('key', lambda: self._request(1, exc=ValueError()),
+                                                         is_immutable=lambda result: True)
+                                          for i in range(2)], return_exceptions=True)
+        results = self._run(run())
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(1, self._run(self.cache.get('key', lambda: self._request(1))))
+        self.assertEqual(2, self.num_requests)
+
+    def test_futures_for_several_keys(self):
+        self.cache.put('a', 'cached')
+
+        async def run():
+            futs = [self.cache.get_future(key, lambda key=key: self._request(key)) for key in ('a', 'b', 'b')]
+            self.assertEqual({'hits': 1, 'misses': 1, 'coalesced': 1, 'in_flight': 1, 'cached': 1},
+                             self.cache.get_stats())
+            return await asyncio.gather(*futs)
+        self.assertEqual(['cached', 'b', 'b'], self._run(run()))
+        self.assertEqual(1, self.num_requests)
+        self.assertTrue(self.cache.discard('a'))
+        self.assertFalse(self.cache.discard('a'))
+        self.assertEqual(0, self.cache.get_stats()['cached'])
+
+    def test_cancelled_caller_does_not_cancel_request(self):
+        async def run():
+            fut1 = asyncio.ensure_future(self.cache.get('key', lambda: self._request(1)))
+            fut2 = asyncio.ensure_future(self.cache.get('key', lambda: self._request(2)))
+            await asyncio.sleep(0)
+            fut1.cancel()
+            return await fut2
+        self.assertEqual(1, self._run(run()))
+        self.assertEqual(1, self.num_requests)
+
+
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
@@ -0,0 +1,413 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+
+import aiorpcx
+from aiorpcx import TaskGroup
+
+from electrum_audax import bitcoin, keystore
+from electrum_audax.bip32 import BIP32Node
+from electrum_audax.interface import NotificationSession
+from electrum_audax.storage import WalletStorage
+from electrum_audax.synchronizer import (SynchronizerBase, Synchronizer, SubscriptionMultiplexer,
+                                        history_status)
+from electrum_audax.transaction import Transaction, TxOutput
+from electrum_audax.tx_store import TxStore
+from electrum_audax.wallet import Wallet
+
+from . import SequentialTestCase
+
+
+def status_of_scripthash(sh):
+    return hashlib.sha256(sh.encode('ascii')).hexdigest()
+
+
+class MockElectrumXSession(aiorpcx.RPCSession):
+    """Stand-in server; every scripthash has a status derived from it."""
+
+    async def handle_request(self, request):
+        if request.method == 'blockchain.scripthash.subscribe':
+            return status_of_scripthash(request.args[0])
+        if request.method == 'blockchain.scripthash.get_history':
+            if request.args[0] == '00' * 32:
+                raise aiorpcx.RPCError(1, 'bad scripthash')
+            return [{'tx_hash': request.args[0], 'height': 1}]
+        raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+
+
+class CountingSession(NotificationSession):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_requests = 0
+        self.batch_sizes = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def send_request(self, *args, **kwargs):
+        self.num_requests += 1
+        return await super().send_request(*args, **kwargs)
+
+    async def send_request_batch(self, requests, **kwargs):
+        self.batch_sizes.append(len(requests))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await super().send_request_batch(requests, **kwargs)
+        finally:
+            self.in_flight -= 1
+
+
+class MockInterface:
+
+    def __init__(self, session):
+        self.session = session
+        self.group = TaskGroup()
+
+
+class MockNetwork:
+
+    def __init__(self):
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.interface = None
+        self.tx_store = None
+        self.subscription_multiplexer = None
+        self.num_tx_requests = 0
+
+    def register_callback(self, callback, events):
+        pass
+
+    def trigger_callback(self, event, *args):
+        pass
+
+    def notify(self, key):
+        pass
+
+    def get_local_height(self):
+        return 1000
+
+    async def get_history_for_scripthashes(self, shs):
+        return await self.interface.session.send_request_batch(
+            [('blockchain.scripthash.get_history', [sh]) for sh in shs])
+
+    async def get_transaction(self, tx_hash):
+        self.num_tx_requests += 1
+        return await self.interface.session.send_request('blockchain.transaction.get', [tx_hash])
+
+
+class MockWalletServerSession(aiorpcx.RPCSession):
+    """Stand-in server that knows one confirmed tx for each of the
+    scripthashes in txs, a dict scripthash -> tx."""
+    txs = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cost_hard_limit = 0  # disable aiorpcx resource limits
+
+    async def handle_request(self, request):
+        if request.method == 'blockchain.scripthash.subscribe':
+            tx = self.txs.get(request.args[0])
+            return history_status([(tx.txid(), 1)]) if tx else None
+        if request.method == 'blockchain.scripthash.get_history':
+            tx = self.txs.get(request.args[0])
+            return [{'tx_hash': tx.txid(), 'height': 1}] if tx else []
+        if request.method == 'blockchain.transaction.get':
+            for tx in self.txs.values():
+                if tx.txid() == request.args[0]:
+                    return str(tx)
+        raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+
+
+class RecordingSynchronizer(SynchronizerBase):
+
+    batch_size = 50
+    max_batches_in_flight = 2
+
+    def _reset(self):
+        super()._reset()
+        self.statuses = {}
+
+    async def _on_address_status(self, addr, status):
+        self.statuses[addr] = status
+
+    async def main(self):
+        pass
+
+
+class MockWalletDB:
+
+    def get_history(self):
+        return []
+
+    def get_addr_history(self, addr):
+        return []
+
+
+class MockWallet:
+
+    restore_window = 0
+
+    def __init__(self, network, addresses):
+        self.network = network
+        self.db = MockWalletDB()
+        self.addresses = addresses
+        self.up_to_date = False
+        self.num_synchronize_calls = 0
+
+    def diagnostic_name(self):
+        return 'mock_wallet'
+
+    def get_addresses(self):
+        return self.addresses
+
+    def synchronize(self):
+        self.num_synchronize_calls += 1
+
+    def is_up_to_date(self):
+        return self.up_to_date
+
+    def set_up_to_date(self, up_to_date):
+        self.up_to_date = up_to_date
+
+
+class TestSynchronizerBase(SequentialTestCase):
+
+    NUM_ADDRESSES = 420
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.get_event_loop()
+        self.addresses = [bitcoin.hash160_to_p2pkh(os.urandom(20)) for i in range(self.NUM_ADDRESSES)]
+
+    def _run_with_session(self, coro_func):
+        async def run():
+            server = aiorpcx.Server(MockElectrumXSession, 'localhost', 0)
+            await server.listen()
+            port = server.server.sockets[0].getsockname()[1]
+            try:
+                async with aiorpcx.Connector(CountingSession, 'localhost', port) as session:
+                    return await coro_func(session)
+            finally:
+                await server.close()
+        return self.loop.run_until_complete(run())
+
+    def test_subscriptions_are_batched(self):
+        async def subscribe_all(session):
+            network = MockNetwork()
+            network.interface = MockInterface(session)
+            synchronizer = RecordingSynchronizer(network)
+            # it gets started on the network's interface from the event loop
+            while synchronizer.interface is None:
+                await asyncio.sleep(0.01)
+            for addr in self.addresses:
+                await synchronizer._add_address(addr)
+            while len(synchronizer.statuses) < self.NUM_ADDRESSES:
+                await asyncio.sleep(0.01)
+            self.assertFalse(synchronizer.requested_addrs)
+            stats = synchronizer.get_sync_stats()
+            await synchronizer.stop()
+            return synchronizer, stats
+
+        synchronizer, stats = self._run_with_session(subscribe_all)
+        session = synchronizer.session
+        for addr in self.addresses:
+            h = bitcoin.address_to_scripthash(addr)
+            self.assertEqual(status_of_scripthash(h), synchronizer.statuses[addr])
+        self.assertEqual(0, session.num_requests)
+        self.assertEqual(self.NUM_ADDRESSES, sum(session.batch_sizes))
+        self.assertLessEqual(max(session.batch_sizes), RecordingSynchronizer.batch_size)
+        self.assertEqual(9, len(session.batch_sizes))
+        self.assertLessEqual(session.max_in_flight, RecordingSynchronizer.max_batches_in_flight)
+        self.assertEqual(self.NUM_ADDRESSES, stats['subscriptions'])
+        self.assertGreater(stats['subscriptions_per_second'], 0)
+
+    def test_multiplexer_subscribes_once_for_all_wallets(self):
+        async def subscribe_all(session):
+            network = MockNetwork()
+            network.interface = MockInterface(session)
+            network.subscription_multiplexer = multiplexer = SubscriptionMultiplexer(network)
+            # three wallets; the first two have 100 addresses in common
+            addr_sets = [self.addresses[:300], self.addresses[200:], self.addresses[:10]]
+            synchronizers = [RecordingSynchronizer(network) for addrs in addr_sets]
+            while any(synchronizer.interface is None for synchronizer in synchronizers):
+                await asyncio.sleep(0.01)
+            for synchronizer, addrs in zip(synchronizers, addr_sets):
+                for addr in addrs:
+                    await synchronizer._add_address(addr)
+            while any(len(synchronizer.statuses) < len(addrs)
+                      for synchronizer, addrs in zip(synchronizers, addr_sets)):
+                await asyncio.sleep(0.01)
+            # a notification goes to every wallet watching the address
+            h = bitcoin.address_to_scripthash(self.addresses[250])
+            await multiplexer.status_queue.put([h, 'new status'])
+            while synchronizers[1].statuses[self.addresses[250]] != 'new status':
+                await asyncio.sleep(0.01)
+            await synchronizers[2].stop()
+            while len(multiplexer.owned) > 2:
+                await asyncio.sleep(0.01)
+            stats = multiplexer.get_stats()
+            for synchronizer in synchronizers[:2]:
+                await synchronizer.stop()
+            await multiplexer.stop()
+            return synchronizers, stats
+
+        synchronizers, stats = self._run_with_session(subscribe_all)
+        session = synchronizers[0].session
+        self.assertEqual(self.NUM_ADDRESSES, sum(session.batch_sizes))
+        self.assertEqual(self.NUM_ADDRESSES, stats['subscriptions'])
+        self.assertEqual(self.NUM_ADDRESSES, stats['scripthashes'])
+        self.assertEqual(2, stats['subscribers'])
+        self.assertEqual('new status', synchronizers[0].statuses[self.addresses[250]])
+        self.assertNotEqual('new status', synchronizers[0].statuses[self.addresses[199]])
+        for synchronizer in synchronizers:
+            for addr, status in synchronizer.statuses.items():
+                if addr != self.addresses[250]:
+                    self.assertEqual(status_of_scripthash(bitcoin.address_to_scripthash(addr)), status)
+
+    def test_subscribe_batch_uses_cache(self):
+        async def subscribe_twice(session):
+            queue = asyncio.Queue()
+            params_list = [[bitcoin.address_to_scripthash(addr)] for addr in self.addresses[:10]]
+            await session.subscribe_batch('blockchain.scripthash.subscribe', params_list, queue)
+            await session.subscribe_batch('blockchain.scripthash.subscribe', params_list[5:], queue)
+            items = []
+            while not queue.empty():
+                items.append(queue.get_nowait())
+            return items, session.batch_sizes
+
+        items, batch_sizes = self._run_with_session(subscribe_twice)
+        # the second time, everything was cached already
+        self.assertEqual([10], batch_sizes)
+        self.assertEqual(15, len(items))
+        for sh, status in items:
+            self.assertEqual(status_of_scripthash(sh), status)
+
+    def test_send_request_batch(self):
+        shs = [bitcoin.address_to_scripthash(addr) for addr in self.addresses[:20]]
+
+        async def get_histories(session):
+            results = await session.send_request_batch(
+                [('blockchain.scripthash.get_history', [sh]) for sh in shs])
+            with self.assertRaises(aiorpcx.RPCError):
+                await session.send_request_batch(
+                    [('blockchain.scripthash.get_history', [sh]) for sh in (shs[0], '00' * 32)])
+            return results
+
+        results = self._run_with_session(get_histories)
+        self.assertEqual([[{'tx_hash': sh, 'height': 1}] for sh in shs], results)
+
+    def test_synchronizer_does_not_poll_when_idle(self):
+        async def sync_and_idle(session):
+            network = MockNetwork()
+            network.interface = MockInterface(session)
+            wallet = MockWallet(network, self.addresses[:30])
+            synchronizer = Synchronizer(wallet)
+            while not wallet.is_up_to_date():
+                await asyncio.sleep(0.01)
+            num_calls = wallet.num_synchronize_calls
+            await asyncio.sleep(0.5)
+            self.assertEqual(num_calls, wallet.num_synchronize_calls)
+            # a new address wakes it up
+            await synchronizer._add_address(self.addresses[30])
+            while synchronizer.requested_addrs or not wallet.is_up_to_date():
+                await asyncio.sleep(0.01)
+            self.assertLess(num_calls, wallet.num_synchronize_calls)
+            await synchronizer.stop()
+
+        self._run_with_session(sync_and_idle)
+
+
+class TestSynchronizerRestore(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.get_event_loop()
+        self.user_dir = tempfile.mkdtemp()
+        self.wallet = self._make_wallet('wallet')
+        # every 15th receiving and every 5th change address has received a coin
+        txs = {}
+        for for_change, step, last in ((False, 15, 450), (True, 5, 50)):
+            addrs = self.wallet.derive_addresses(for_change, range(0, last + 1, step))
+            for addr in addrs:
+                inputs = [{'type': 'coinbase', 'prevout_hash': '00' * 32, 'prevout_n': 0xffffffff,
+                           'scriptSig': '0101', 'sequence': 0xffffffff}]
+                outputs = [TxOutput(bitcoin.TYPE_ADDRESS, addr, 100000)]
+                txs[bitcoin.address_to_scripthash(addr)] = Transaction(str(Transaction.from_io(inputs, outputs)))
+        MockWalletServerSession.txs = txs
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def _make_wallet(self, name):
+        xpub = BIP32Node.from_rootseed(b'\x07' * 32, xtype='standard').to_xpub()
+        storage = WalletStorage(os.path.join(self.user_dir, name))
+        storage.put('wallet_type', 'standard')
+        storage.put('keystore', keystore.from_xpub(xpub).dump())
+        return Wallet(storage)
+
+    def _synchronize(self, restore_window, tx_store=None):
+        self.wallet.restore_window = restore_window
+        self.wallet.db.share_transactions(tx_store)
+
+        async def run():
+            server = aiorpcx.Server(MockWalletServerSession, 'localhost', 0)
+            await server.listen()
+            port = server.server.sockets[0].getsockname()[1]
+            try:
+                async with aiorpcx.Connector(NotificationSession, 'localhost', port) as session:
+                    network = MockNetwork()
+                    network.interface = MockInterface(session)
+                    network.tx_store = tx_store
+                    self.wallet.network = network
+                    self.wallet.synchronizer = synchronizer = Synchronizer(self.wallet)
+                    while synchronizer._time_to_up_to_date is None:
+                        await asyncio.sleep(0.01)
+                    stats = synchronizer.get_sync_stats()
+                    stats['tx_requests'] = network.num_tx_requests
+                    await synchronizer.stop()
+                    return stats
+            finally:
+                await server.close()
+        return self.loop.run_until_complete(run())
+
+    def _check_wallet(self):
+        self.assertEqual(451 + 20, len(self.wallet.get_receiving_addresses()))
+        self.assertEqual(51 + 6, len(self.wallet.get_change_addresses()))
+        self.assertEqual(31 + 11, len(self.wallet.db.list_transactions()))
+        self.assertEqual(42 * 100000, sum(self.wallet.get_balance()))
+
+    def test_gap_by_gap(self):
+        stats = self._synchronize(0)
+        self._check_wallet()
+        self.assertEqual(0, stats['lookahead_subscriptions'])
+
+    def test_restore_window(self):
+        stats = self._synchronize(100)
+        self._check_wallet()
+        # a window of addresses after the end of each chain was looked up too,
+        # and every address was subscribed to once
+        self.assertEqual(471 + 100 + 57 + 100, stats['subscriptions'])
+        self.assertGreater(stats['lookahead_subscriptions'], 451 + 51)
+
+    def test_shared_tx_store(self):
+        path = os.path.join(self.user_dir, 'tx_store')
+        tx_store = TxStore(path)
+        stats = self._synchronize(100, tx_store)
+        self._check_wallet()
+        self.assertEqual(42, stats['tx_requests'])
+        self.assertEqual(42, tx_store.get_stats()['txs'])
+        # another wallet with the same txs gets them from the store, and references them
+        self.wallet = self._make_wallet('wallet2')
+        stats = self._synchronize(100, tx_store)
+        self._check_wallet()
+        self.assertEqual(0, stats['tx_requests'])
+        for tx_hash in self.wallet.db.list_transactions():
+            self.assertIs(tx_store.get(tx_hash), self.wallet.db.transactions[tx_hash])
+        tx_store.close()
+        # the txs are read back from the file
+        tx_store = TxStore(path)
+        self.assertEqual(42, tx_store.get_stats()['txs'])
+        tx_store.close()
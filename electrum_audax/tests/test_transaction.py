@@ -1,6 +1,7 @@
 from electrum_audax import transaction
 from electrum_audax.transaction import TxOutputForUI, tx_from_str
-from electrum_audax.bitcoin import TYPE_ADDRESS
+from electrum_audax import bitcoin
+from electrum_audax.bitcoin import TYPE_ADDRESS, TYPE_SCRIPT
 from electrum_audax.keystore import xpubkey_to_address
 from electrum_audax.util import bh2u, bfh
 
@@ -228,6 +229,88 @@ class TestTransaction(SequentialTestCase):
         self.assertEqual((SCRIPT, '200289e14468d94537493c62e2168318b568912dec0fb95609afd56f2527c2751cac'), addr_from_script('200289e14468d94537493c62e2168318b568912dec0fb95609afd56f2527c2751cac'))
         self.assertEqual((SCRIPT, '210589e14468d94537493c62e2168318b568912dec0fb95609afd56f2527c2751c8bac'), addr_from_script('210589e14468d94537493c62e2168318b568912dec0fb95609afd56f2527c2751c8bac'))
 
+    def test_deserialize_bytes(self):
+        for blob in (unsigned_blob, signed_blob):
+            self.assertEqual(transaction.deserialize(blob), transaction.deserialize(bfh(blob)))
+
+    def test_deserialize_truncated(self):
+        for i in range(0, len(signed_blob) - 2, 10):
+            with self.assertRaises(transaction.SerializationError):
+                transaction.deserialize(signed_blob[:i])
+        with self.assertRaises(transaction.SerializationError):
+            transaction.deserialize(signed_blob + '00')
+
+    def test_get_tx_hashes_from_raw(self):
+        raw_tx = '0100000000010197e6bf4a70bc118e3a8d9842ed80422e335679dfc29b5ba0f9123f6a5863b8470000000000fdffffff02402bca7f130000001600146f579c953d9e7e7719f2baa20bde22eb5f24119200e87648170000001976a9140cd8fa5fd81c3acf33f93efd179b388de8dd693388ac0247304402204ff33b3ea8fb270f62409bfc257457ca5eb1fec5e4d3a7c11aa487207e131d4d022032726b998e338e5245746716e5cd0b40d32b69d1535c3d841f049d98a5d819b1012102dc3ce3220363aff579eb2c45c973e8b186a829c987c3caea77c61975666e7d1bc8010000'
+        txid, wtxid = transaction.get_tx_hashes_from_raw(bfh(raw_tx))
+        self.assertEqual('c721ed35767a3a209b688e68e3bb136a72d2b631fe81c56be8bdbb948c343dbc', bh2u(txid[::-1]))
+        tx = transaction.Transaction(raw_tx)
+        self.assertEqual(bh2u(wtxid[::-1]), tx.wtxid())
+        # same as hashing the re-serialized tx
+        tx.deserialize()
+        tx.raw = None
+        self.assertEqual(bh2u(txid[::-1]), tx.txid())
+        self.assertEqual(bh2u(wtxid[::-1]), tx.wtxid())
+
+        txid, wtxid = transaction.get_tx_hashes_from_raw(bfh(signed_blob))
+        self.assertEqual(txid, wtxid)
+        self.assertEqual(bh2u(txid[::-1]), transaction.Transaction(signed_blob).txid())
+
+    def test_txid_after_set_rbf(self):
+        tx = transaction.Transaction(signed_blob)
+        txid = tx.txid()
+        tx.set_rbf(False)
+        self.assertNotEqual(txid, tx.txid())
+        self.assertEqual(tx.txid(), transaction.Transaction(tx.serialize()).txid())
+
+    def test_serialize_preimage_shared_txdigest_fields(self):
+        pubkey = '02d336fc49545fc06bafe326634a6359fb9a0e10d52ec0cefb380c8a0c02a4ffa9'
+        inputs = [{'type': txin_type, 'prevout_hash': '%064x' % i, 'prevout_n': i, 'num_sig': 1,
+                   'signatures': [None], 'pubkeys': [pubkey], 'x_pubkeys': [pubkey],
+                   'address': bitcoin.public_key_to_p2pkh(bfh(pubkey)), 'value': 1000 * i}
+                  for i, txin_type in enumerate(('p2pkh', 'p2wpkh', 'p2pkh', 'p2wpkh-p2sh'))]
+        outputs = [transaction.TxOutput(TYPE_ADDRESS, bitcoin.hash160_to_p2pkh(bytes(20)), 3000)]
+        tx = transaction.Transaction.from_io(inputs, outputs, locktime=1000)
+        fields = tx.calc_shared_txdigest_fields()
+        self.assertEqual(bitcoin.sha256d(b''.join(fields.outpoints)), fields.hashPrevouts)
+        for i, txin in enumerate(tx.inputs()):
+            preimage = tx.serialize_preimage(i)
+            self.assertEqual(preimage, tx.serialize_preimage(i, fields))
+            if tx.is_segwit_input(txin):
+                self.assertEqual(bh2u(fields.hashPrevouts), preimage[8:72])
+                self.assertEqual(bh2u(fields.hashOutputs), preimage[-80:-16])
+            else:
+                # legacy: a single input script
+                self.assertEqual(preimage.count(tx.get_preimage_script(txin)), 1)
+
+    @needs_test_with_all_ecc_implementations
+    def test_sign_bip143_native_p2wpkh_vector(self):
+        # the native P2WPKH example of BIP143; prevout hashes are given in serialization order there
+        pubkey0 = '03c9f4836b9a4f77fc0d81f7bcb01b7f1b35916864b9476c241ce9fc198bd25432'
+        pubkey1 = '025476c2e83188368da1ff3e292e7acafcdb3566bb0ad253f62fc70f07aeee6357'
+        inputs = [{'type': 'p2pk', 'prevout_n': 0, 'sequence': 0xffffffee, 'value': 625000000,
+                   'prevout_hash': bh2u(bfh('fff7f7881a8099afa6940d42d1e7f6362bec38171ea3edf433541db4e4ad969f')[::-1]),
+                   'num_sig': 1, 'signatures': [None], 'pubkeys': [pubkey0], 'x_pubkeys': [pubkey0], 'address': None},
+                  {'type': 'p2wpkh', 'prevout_n': 1, 'sequence': 0xffffffff, 'value': 600000000,
+                   'prevout_hash': bh2u(bfh('ef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a')[::-1]),
+                   'num_sig': 1, 'signatures': [None], 'pubkeys': [pubkey1], 'x_pubkeys': [pubkey1],
+                   'address': bitcoin.pubkey_to_address('p2wpkh', pubkey1)}]
+        outputs = [transaction.TxOutput(TYPE_SCRIPT, '76a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac', 112340000),
+                   transaction.TxOutput(TYPE_SCRIPT, '76a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa815988ac', 223450000)]
+        tx = transaction.Transaction.from_io(list(inputs), outputs, locktime=0x11, version=1)
+        tx._inputs = inputs  # keep the order of the vector instead of BIP69
+        preimage = ('0100000096b827c8483d4e9b96712b6713a7b68d6e8003a781feba36c31143470b4efd3752b0a642eea2fb7ae638c36f6'
+                    '252b6750293dbe574a806984b8e4d8548339a3bef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b'
+                    '90ec68a010000001976a9141d0f172a0ecb48aee1be1f2687d2963ae33f71a188ac0046c32300000000ffffffff863ef3'
+                    'e1a92afbfdb97f31ad0fc7683ee943e9abcf2501590ff8f6551f47e5e51100000001000000')
+        self.assertEqual(preimage, tx.serialize_preimage(1))
+        self.assertEqual(preimage, tx.serialize_preimage(1, tx.calc_shared_txdigest_fields()))
+        self.assertEqual('c37af31116d1b27caf68aae9e3ac82f1477929014d5b917657d0eb49478cb670',
+                         bh2u(bitcoin.sha256d(bfh(preimage))))
+        tx.sign({pubkey1: (bfh('619c335025c7f4012e556c2a58b2506e30b8511b53ade95ea316fd8c3286feb9'), True)})
+        self.assertEqual(['304402203609e17b84f6a7d30c80bfa610b5b4542f32a8a0d5447a12fb1366d7f01cc44a0220573a954c'
+                          '4518331561406f90300e8f3358f51928d43c212a8caed02de67eebee01'], tx.inputs()[1]['signatures'])
+
 
 #####
 
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+
+from electrum_audax import bitcoin
+from electrum_audax.transaction import Transaction, TxOutput
+from electrum_audax.tx_store import TxStore
+from electrum_audax.util import bfh
+
+from . import SequentialTestCase
+
+
+def make_raw_tx(value):
+    inputs = [{'type': 'coinbase', 'prevout_hash': '00' * 32, 'prevout_n': 0xffffffff,
+               'scriptSig': '0101', 'sequence': 0xffffffff}]
+    outputs = [TxOutput(bitcoin.TYPE_ADDRESS, bitcoin.hash160_to_p2pkh(bytes(20)), value)]
+    tx = Transaction(str(Transaction.from_io(inputs, outputs)))
+    return tx.txid(), bfh(str(tx))
+
+
+class TestTxStore(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.user_dir, 'tx_store')
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def test_add_and_get(self):
+        tx_store = TxStore()
+        txid1, raw1 = make_raw_tx(1000)
+        txid2, raw2 = make_raw_tx(2000)
+        self.assertIs(raw1, tx_store.add(txid1, raw1))
+        # a copy of raw1 gets the stored object
+        self.assertIs(raw1, tx_store.add(txid1, bytes(bytearray(raw1))))
+        # content must match the txid
+        self.assertIsNone(tx_store.add(txid1, raw2))
+        self.assertIsNone(tx_store.add(txid2, raw1))
+        self.assertIsNone(tx_store.add(txid2, b'garbage'))
+        self.assertIs(raw1, tx_store.get(txid1))
+        self.assertIsNone(tx_store.get(txid2))
+        self.assertEqual({'txs': 1, 'bytes': len(raw1), 'hits': 1, 'misses': 1}, tx_store.get_stats())
+
+    def test_persisted(self):
+        tx_store = TxStore(self.path)
+        txs = [make_raw_tx(1000 * i) for i in range(1, 4)]
+        for txid, raw in txs:
+            tx_store.add(txid, raw)
+        tx_store.close()
+        # an interrupted write at the end is dropped
+        with open(self.path, 'ab') as f:
+            f.write(b'\x01' * 40)
+        tx_store = TxStore(self.path)
+        for txid, raw in txs:
+            self.assertEqual(raw, tx_store.get(txid))
+        txid, raw = make_raw_tx(5000)
+        tx_store.add(txid, raw)
+        tx_store.close()
+        tx_store = TxStore(self.path)
+        self.assertEqual(4, tx_store.get_stats()['txs'])
+        self.assertEqual(raw, tx_store.get(txid))
+        tx_store.close()
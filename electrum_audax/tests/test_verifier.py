@@ -0,0 +1,357 @@
+import asyncio
+import os
+
+from aiorpcx import TaskGroup
+
+from electrum_audax import verifier
+from electrum_audax.bitcoin import hash_encode, hash_decode
+from electrum_audax.crypto import sha256d
+from electrum_audax.interface import GracefulDisconnect
+from electrum_audax.network import Network, RequestCache, UntrustedServerReturnedError
+from electrum_audax.synchronizer import SubscriptionMultiplexer
+from electrum_audax.verifier import SPV, verify_tx_is_in_block, MerkleVerificationFailure
+
+from . import SequentialTestCase
+
+
+def make_merkle_tree(tx_hashes):
+    """Returns the levels of the merkle tree of tx_hashes, leaves first."""
+    level = [hash_decode(tx_hash) for tx_hash in tx_hashes]
+    levels = [level]
+    while len(level) > 1:
+        if len(level) % 2:
+            level = level + [level[-1]]
+        level = [sha256d(level[i] + level[i+1]) for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+
+def get_merkle_branch(levels, pos):
+    branch = []
+    for level in levels[:-1]:
+        sibling = pos ^ 1
+        branch.append(hash_encode(level[min(sibling, len(level) - 1)]))
+        pos >>= 1
+    return branch
+
+
+def make_header(height, merkle_root):
+    return {'version': 1, 'prev_block_hash': '00' * 32, 'merkle_root': merkle_root,
+            'timestamp': 1500000000 + height, 'bits': 0x1d00ffff, 'nonce': height,
+            'block_height': height}
+
+
+class MockBlockchain:
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.local_height = max(headers)
+
+    def height(self):
+        return self.local_height
+
+    def read_header(self, height):
+        if height > self.local_height:
+            return None
+        return self.headers.get(height)
+
+
+class MockInterface:
+
+    def __init__(self):
+        self.session = MockSession()
+        self.group = TaskGroup()
+
+
+class MockSession:
+
+    def unsubscribe(self, queue):
+        pass
+
+
+class MockNetwork:
+    """Serves merkle branches for the txs of the given blocks."""
+
+    get_merkle_for_transactions = Network.get_merkle_for_transactions
+    cache_verified_merkle = Network.cache_verified_merkle
+    uncache_merkle = Network.uncache_merkle
+    _merkle_cache_key = Network._merkle_cache_key
+
+    def __init__(self, blocks, local_height):
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.interface = MockInterface()
+        self.bhi_lock = asyncio.Lock()
+        self.config = {}
+        self.callbacks = []
+        self.batches = []
+        self.merkle = {}
+        self.subscription_multiplexer = None
+        self.request_cache = RequestCache()
+        self._blockchain = MockBlockchain({height: None for height in blocks})
+        for height, tx_hashes in blocks.items():
+            self.set_block(height, tx_hashes)
+        self._blockchain.local_height = local_height
+
+    def set_block(self, height, tx_hashes):
+        levels = make_merkle_tree(tx_hashes)
+        self._blockchain.headers[height] = make_header(height, hash_encode(levels[-1][0]))
+        for pos, tx_hash in enumerate(tx_hashes):
+            self.merkle[tx_hash] = {'block_height': height, 'pos': pos,
+                                    'merkle': get_merkle_branch(levels, pos)}
+
+    def register_callback(self, callback, events):
+        if 'blockchain_updated' in events:
+            self.callbacks.append(callback)
+
+    def unregister_callback(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def blockchain(self):
+        return self._blockchain
+
+    def set_local_height(self, height):
+        self._blockchain.local_height = height
+        for callback in self.callbacks:
+            callback('blockchain_updated')
+
+    def get_local_height(self):
+        return self._blockchain.height()
+
+    async def _get_merkle_for_transactions(self, txs):
+        self.batches.append(list(txs))
+        results = []
+        for tx_hash, tx_height in txs:
+            merkle = self.merkle.get(tx_hash)
+            if merkle is None or merkle['block_height'] != tx_height:
+                results.append(UntrustedServerReturnedError(
+                    original_exception=verifier.aiorpcx.jsonrpc.RPCError(1, 'tx not in block')))
+            else:
+                results.append(merkle)
+        return results
+
+
+class MockWallet:
+
+    def __init__(self, unverified_tx):
+        self.unverified_tx = dict(unverified_tx)
+        self.verified_tx = {}
+
+    def diagnostic_name(self):
+        return 'mock_wallet'
+
+    def get_unverified_txs(self):
+        return dict(self.unverified_tx)
+
+    def get_unverified_tx_height(self, tx_hash):
+        return self.unverified_tx.get(tx_hash)
+
+    def remove_unverified_tx(self, tx_hash, tx_height):
+        if self.unverified_tx.get(tx_hash) == tx_height:
+            self.unverified_tx.pop(tx_hash)
+
+    def add_verified_tx(self, tx_hash, info):
+        self.unverified_tx.pop(tx_hash, None)
+        self.verified_tx[tx_hash] = info
+
+
+class RecordingSPV(SPV):
+
+    batch_size = 10
+
+    def _reset(self):
+        super()._reset()
+        self.num_hashes = 0
+
+    def _raise_if_valid_tx(self, raw_tx):
+        # called once for every inner node hashed
+        self.num_hashes += 1
+
+
+def random_tx_hashes(n):
+    return [os.urandom(32).hex() for i in range(n)]
+
+
+class TestSPV(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.get_event_loop()
+        self.blocks = {100 + i: random_tx_hashes(8) for i in range(4)}
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def _wait_until(self, condition):
+        for i in range(500):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('timed out')
+
+    async def _stop(self, spv):
+        await spv.stop()
+        await spv.network.interface.group.cancel_remaining()
+
+    def test_verifies_in_batches_as_headers_arrive(self):
+        network = MockNetwork(self.blocks, local_height=101)
+        unverified = {tx_hash: height for height, tx_hashes in self.blocks.items()
+                      for tx_hash in tx_hashes}
+        wallet = MockWallet(unverified)
+
+        async def run():
+            spv = RecordingSPV(network, wallet)
+            await self._wait_until(lambda: len(wallet.verified_tx) == 16)
+            # nothing above the local height is requested
+            self.assertEqual(16, sum(len(batch) for batch in network.batches))
+            self.assertEqual([10, 6], [len(batch) for batch in network.batches])
+            # the lowest heights come first
+            self.assertEqual(sorted(self.blocks[100]), [tx_hash for tx_hash, height in network.batches[0][:8]])
+            # new headers wake it up
+            network.set_local_height(103)
+            await self._wait_until(lambda: len(wallet.verified_tx) == 32)
+            self.assertEqual(32, sum(len(batch) for batch in network.batches))
+            await self._stop(spv)
+            return spv
+
+        spv = self._run(run())
+        self.assertFalse(wallet.unverified_tx)
+        self.assertFalse(spv.requested_merkle)
+        for tx_hash, info in wallet.verified_tx.items():
+            merkle = network.merkle[tx_hash]
+            self.assertEqual(merkle['block_height'], info.height)
+            self.assertEqual(merkle['pos'], info.txpos)
+
+    def test_reuses_verified_branches(self):
+        tx_hashes = self.blocks[100]
+        network = MockNetwork({100: tx_hashes}, local_height=100)
+        wallet = MockWallet({tx_hash: 100 for tx_hash in tx_hashes})
+
+        async def run():
+            spv = RecordingSPV(network, wallet)
+            await self._wait_until(lambda: len(wallet.verified_tx) == 8)
+            await self._stop(spv)
+            return spv
+
+        spv = self._run(run())
+        # 3 hashes for the first tx, 7 inner nodes of the tree for all 8
+        self.assertEqual(7, spv.num_hashes)
+
+    def test_tx_added_later_and_wrong_height(self):
+        tx_hashes = self.blocks[100]
+        network = MockNetwork({100: tx_hashes, 101: self.blocks[101]}, local_height=101)
+        wallet = MockWallet({tx_hashes[0]: 100})
+
+        async def run():
+            spv = RecordingSPV(network, wallet)
+            await self._wait_until(lambda: len(wallet.verified_tx) == 1)
+            # the server does not know about it at this height
+            wallet.unverified_tx[tx_hashes[1]] = 101
+            spv.add_unverified_tx(tx_hashes[1], 101)
+            await self._wait_until(lambda: not wallet.unverified_tx)
+            self.assertNotIn(tx_hashes[1], wallet.verified_tx)
+            wallet.unverified_tx[tx_hashes[2]] = 100
+            spv.add_unverified_tx(tx_hashes[2], 100)
+            await self._wait_until(lambda: len(wallet.verified_tx) == 2)
+            await self._stop(spv)
+
+        self._run(run())
+        self.assertEqual({tx_hashes[0], tx_hashes[2]}, set(wallet.verified_tx))
+
+    def test_wallets_share_merkle_requests(self):
+        network = MockNetwork(self.blocks, local_height=103)
+        network.subscription_multiplexer = multiplexer = SubscriptionMultiplexer(network)
+        tx_hashes = [(tx_hash, height) for height, tx_hashes in self.blocks.items()
+                     for tx_hash in tx_hashes]
+        # the wallets have 8 txs in common
+        wallets = [MockWallet(tx_hashes[:20]), MockWallet(tx_hashes[12:])]
+
+        async def run():
+            spvs = [RecordingSPV(network, wallet) for wallet in wallets]
+            await self._wait_until(lambda: not any(wallet.unverified_tx for wallet in wallets))
+            for spv in spvs:
+                await self._stop(spv)
+            await multiplexer.stop()
+
+        self._run(run())
+        self.assertEqual(20, len(wallets[0].verified_tx))
+        self.assertEqual(20, len(wallets[1].verified_tx))
+        # batches of both wallets were merged, and the common txs requested once
+        requested = [item for batch in network.batches for item in batch]
+        self.assertEqual(32, len(requested))
+        self.assertEqual(set(tx_hashes), set(requested))
+        self.assertLess(len(network.batches), 4)
+        stats = multiplexer.get_stats()
+        self.assertEqual(32, stats['merkle_requests'])
+        self.assertEqual(8, stats['coalesced_merkle_requests'])
+        self.assertFalse(multiplexer.requested_merkle)
+
+    def test_branch_reuse_does_not_accept_bad_branches(self):
+        tx_hashes = self.blocks[100]
+        levels = make_merkle_tree(tx_hashes)
+        header = make_header(100, hash_encode(levels[-1][0]))
+
+        async def run():
+            spv = RecordingSPV(MockNetwork({100: tx_hashes}, local_height=100), MockWallet({}))
+            await self._wait_until(lambda: spv.interface is not None)
+            await self._stop(spv)
+            return spv
+
+        spv = self._run(run())
+        spv._verify_tx_is_in_block(tx_hashes[0], get_merkle_branch(levels, 0), 0, header, 100)
+        # a tx that is not in the block, with a branch joining the verified one
+        branch = get_merkle_branch(levels, 1)
+        other_tx_hash = random_tx_hashes(1)[0]
+        with self.assertRaises(MerkleVerificationFailure):
+            spv._verify_tx_is_in_block(other_tx_hash, branch, 1, header, 100)
+        with self.assertRaises(MerkleVerificationFailure):
+            spv._verify_tx_is_in_block(tx_hashes[1], branch, 2, header, 100)
+        with self.assertRaises(MerkleVerificationFailure):
+            verify_tx_is_in_block(tx_hashes[1], branch, 2, header, 100)
+        spv._verify_tx_is_in_block(tx_hashes[1], branch, 1, header, 100)
+        verify_tx_is_in_block(tx_hashes[1], branch, 1, header, 100)
+
+    def test_only_verified_deep_branches_are_cached(self):
+        tx_hashes = self.blocks[100]
+        network = MockNetwork({100: tx_hashes}, local_height=110)
+        wallets = [MockWallet({tx_hash: 100 for tx_hash in tx_hashes[:2]}) for i in range(2)]
+
+        async def verify(wallet):
+            spv = RecordingSPV(network, wallet)
+            await self._wait_until(lambda: spv.interface is not None and not wallet.unverified_tx)
+            await self._stop(spv)
+            return spv
+
+        self._run(verify(wallets[0]))
+        self.assertEqual(1, len(network.batches))
+        self.assertEqual(2, network.request_cache.get_stats()['cached'])
+        # verified before, so they are not requested again
+        self._run(verify(wallets[1]))
+        self.assertEqual(1, len(network.batches))
+        self.assertEqual({'hits': 2, 'misses': 2, 'coalesced': 0, 'in_flight': 0, 'cached': 2},
+                         network.request_cache.get_stats())
+        # a bad branch is not cached
+        spv = self._run(verify(MockWallet({})))
+        merkle = dict(network.merkle[tx_hashes[2]], pos=3)
+        with self.assertRaises(GracefulDisconnect):
+            spv._verify_proof(tx_hashes[2], 100, merkle, network.blockchain().read_header(100))
+        self.assertEqual(2, network.request_cache.get_stats()['cached'])
+
+    def test_stale_cached_branch_is_requested_again(self):
+        tx_hashes = self.blocks[100]
+        network = MockNetwork({100: tx_hashes}, local_height=110)
+
+        async def verify(wallet):
+            spv = RecordingSPV(network, wallet)
+            await self._wait_until(lambda: not wallet.unverified_tx)
+            await self._stop(spv)
+
+        self._run(verify(MockWallet({tx_hashes[0]: 100})))
+        # a reorg deeper than the cached branch
+        network.set_block(100, [tx_hashes[0]] + random_tx_hashes(3))
+        wallet = MockWallet({tx_hashes[0]: 100})
+        self._run(verify(wallet))
+        self.assertIn(tx_hashes[0], wallet.verified_tx)
+        self.assertEqual([[(tx_hashes[0], 100)]] * 2, network.batches)
+        self.assertEqual(network.merkle[tx_hashes[0]],
+                         network.request_cache.get_cached(network._merkle_cache_key(tx_hashes[0], 100)))
@@ -5,16 +5,28 @@ import os
 import json
 from decimal import Decimal
 import time
+import csv
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 from io import StringIO
-from electrum_audax.storage import WalletStorage
+from electrum_audax import storage as storage_module
+from electrum_audax.storage import WalletStorage, WALLET_LOG_MAGIC, STO_EV_USER_PW
 from electrum_audax.json_db import FINAL_SEED_VERSION
-from electrum_audax.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet,
-                             restore_wallet_from_text)
+from electrum_audax.wallet import (Abstract_Wallet, Standard_Wallet, Multisig_Wallet, Wallet,
+                             create_new_wallet, restore_wallet_from_text, HISTORY_CSV_FIELDS)
+from electrum_audax import keystore
+from electrum_audax.bip32 import BIP32Node
 from electrum_audax.exchange_rate import ExchangeBase, FxThread
+from electrum_audax import util
 from electrum_audax.util import TxMinedInfo
-from electrum_audax.bitcoin import COIN
+from electrum_audax.bitcoin import COIN, hash160_to_p2pkh
+from electrum_audax import bitcoin
 from electrum_audax.json_db import JsonDB
+from electrum_audax import json_db
+from electrum_audax import transaction
+from electrum_audax.transaction import Transaction, TxOutput
 
 from . import SequentialTestCase
 
@@ -73,11 +85,162 @@ class TestWalletStorage(WalletTestCase):
             storage.put(key, value)
         storage.write()
 
-        with open(self.wallet_path, "r") as f:
-            contents = f.read()
-        d = json.loads(contents)
+        with open(self.wallet_path, "rb") as f:
+            self.assertTrue(f.read().startswith(WALLET_LOG_MAGIC))
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
         for key, value in some_dict.items():
-            self.assertEqual(d[key], value)
+            self.assertEqual(storage.get(key), value)
+
+    def _new_storage(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('labels', {'a': 'label'})
+        storage.put('big', [os.urandom(32).hex() for i in range(1000)])
+        storage.write()
+        return storage
+
+    def test_writes_are_appended(self):
+        storage = self._new_storage()
+        size = os.path.getsize(self.wallet_path)
+        labels = storage.get('labels')
+        for i in range(10):
+            labels[str(i)] = str(i)
+            storage.put('labels', labels)
+            storage.write()
+        # no changes, nothing written
+        storage.write()
+        storage.db.add_verified_tx('00' * 32, TxMinedInfo(height=1, timestamp=2, txpos=3, header_hash='ff' * 32))
+        storage.put('big', None)
+        storage.write()
+        # every write appended a record smaller than the file
+        self.assertLess(os.path.getsize(self.wallet_path), size * 2)
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(labels, storage.get('labels'))
+        self.assertIsNone(storage.get('big'))
+        self.assertEqual(1, storage.db.get_verified_tx('00' * 32).height)
+
+    def test_log_is_compacted(self):
+        storage = self._new_storage()
+        size = os.path.getsize(self.wallet_path)
+        saved = storage_module.MAX_CHANGE_RECORDS
+        storage_module.MAX_CHANGE_RECORDS = 5
+        try:
+            for i in range(5):
+                storage.put('counter', i)
+                storage.write()
+                self.assertLess(size, os.path.getsize(self.wallet_path))
+            size = os.path.getsize(self.wallet_path)
+            storage.put('counter', 5)
+            storage.write()
+        finally:
+            storage_module.MAX_CHANGE_RECORDS = saved
+        self.assertGreater(size, os.path.getsize(self.wallet_path))
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(5, storage.get('counter'))
+
+    def test_incomplete_record_is_ignored(self):
+        storage = self._new_storage()
+        storage.put('a', 1)
+        storage.write()
+        size = os.path.getsize(self.wallet_path)
+        storage.put('a', 2)
+        storage.write()
+        # as if the last write was interrupted
+        with open(self.wallet_path, "r+b") as f:
+            f.truncate(os.path.getsize(self.wallet_path) - 1)
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(1, storage.get('a'))
+        storage.put('a', 3)
+        storage.write()
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(3, storage.get('a'))
+        self.assertGreater(size, os.path.getsize(self.wallet_path))
+
+    def test_json_wallet_is_converted(self):
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps({"a": "b", "seed_version": FINAL_SEED_VERSION}))
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        storage.put('c', 'd')
+        storage.write()
+        with open(self.wallet_path, "rb") as f:
+            self.assertTrue(f.read().startswith(WALLET_LOG_MAGIC))
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual("b", storage.get("a"))
+        self.assertEqual("d", storage.get("c"))
+
+    def test_encrypted_records(self):
+        storage = self._new_storage()
+        storage.set_password('secret', enc_version=STO_EV_USER_PW)
+        storage.write()
+        storage.put('a', 'b')
+        storage.write()
+        with open(self.wallet_path, "rb") as f:
+            contents = f.read()
+        self.assertNotIn(b'label', contents)
+        self.assertNotIn(b'"a"', contents)
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(storage.is_encrypted_with_user_pw())
+        self.assertFalse(storage.is_past_initial_decryption())
+        storage.decrypt('secret')
+        storage.check_password('secret')
+        self.assertEqual('b', storage.get('a'))
+        self.assertEqual({'a': 'label'}, storage.get('labels'))
+
+class TestJsonDBTransactions(SequentialTestCase):
+
+    raw_txs = [
+        '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff25033ca0030400001256124d696e656420627920425443204775696c640800000d41000007daffffffff01c00d1298000000001976a91427a1f12771de5cc3b73941664b2537c15316be4388ac00000000',
+        '010000000118231a31d2df84f884ced6af11dc24306319577d4d7c340124a7e2dd9c314077000000004847304402200b6c45891aed48937241907bc3e3868ee4c792819821fcde33311e5a3da4789a02205021b59692b652a01f5f009bd481acac2f647a7d9c076d71d85869763337882e01fdffffff016c95052a010000001976a9149c4891e7791da9e622532c97f43863768264faaf88ac00000000',
+    ]
+
+    def _reload(self, db):
+        return JsonDB(db.dump(), manual_upgrades=True)
+
+    def test_transactions_are_parsed_on_access(self):
+        db = JsonDB('', manual_upgrades=True)
+        txids = []
+        for i, raw_tx in enumerate(self.raw_txs):
+            tx = Transaction(raw_tx)
+            txids.append(tx.txid())
+            db.add_transaction(tx.txid(), tx)
+            db.add_txo_addr(tx.txid(), 'addr', 0, 1000 + i, False)
+        db = self._reload(db)
+        self.assertEqual(set(txids), set(db.list_transactions()))
+        self.assertEqual(bytes.fromhex(self.raw_txs[0]), db.transactions[txids[0]])
+        self.assertFalse(db._tx_cache)
+        for txid, raw_tx in zip(txids, self.raw_txs):
+            tx = db.get_transaction(txid)
+            self.assertEqual(raw_tx, str(tx))
+            self.assertEqual(txid, tx.txid())
+            # the same object, while it is cached
+            self.assertIs(tx, db.get_transaction(txid))
+        self.assertTrue(db.has_transaction(txids[1]))
+        self.assertIsNone(db.get_transaction('00' * 32))
+        # txo entries become sets of tuples on access
+        self.assertIsInstance(db.txo[txids[0]]['addr'], list)
+        self.assertEqual({(0, 1000, False)}, db.get_txo_addr(txids[0], 'addr'))
+        db.add_txo_addr(txids[1], 'addr', 1, 5, False)
+        self.assertEqual({(0, 1001, False), (1, 5, False)}, db.get_txo_addr(txids[1], 'addr'))
+        self.assertEqual(str(db.remove_transaction(txids[0])), self.raw_txs[0])
+        self.assertEqual([txids[1]], self._reload(db).list_transactions())
+
+    def test_cache_size_is_bounded(self):
+        saved = json_db.TX_CACHE_SIZE
+        json_db.TX_CACHE_SIZE = 1
+        try:
+            db = JsonDB('', manual_upgrades=True)
+            txs = [Transaction(raw_tx) for raw_tx in self.raw_txs]
+            for tx in txs:
+                db.add_transaction(tx.txid(), tx)
+            self.assertEqual([txs[1].txid()], list(db._tx_cache))
+            tx = db.get_transaction(txs[0].txid())
+            self.assertIsNot(txs[0], tx)
+            self.assertEqual(txs[0].txid(), tx.txid())
+            self.assertEqual([txs[0].txid()], list(db._tx_cache))
+        finally:
+            json_db.TX_CACHE_SIZE = saved
+
 
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
@@ -210,3 +373,204 @@ class TestCreateRestoreWallet(WalletTestCase):
         self.assertEqual('p2wpkh:L4jkdiXszG26SUYvwwJhzGwg37H2nLhrbip7u6crmgNeJysv5FHL',
                          wallet.export_private_key(addr0, password=None)[0])
         self.assertEqual(2, len(wallet.get_receiving_addresses()))
+
+
+class TestWalletHistory(WalletTestCase):
+
+    num_txs = 3000
+
+    def setUp(self):
+        super().setUp()
+        storage = WalletStorage(self.wallet_path)
+        storage.put('wallet_type', 'imported')
+        storage.put('stored_height', self.num_txs + 1)
+        addrs = [hash160_to_p2pkh(bytes([i]) * 20) for i in range(10)]
+        storage.put('addresses', {addr: {} for addr in addrs})
+        hist = {addr: [] for addr in addrs}
+        for i in range(self.num_txs):
+            txid = '%064x' % i
+            if i % 3 == 0 and i >= 10:
+                # spend the output received by the same address 10 txs before
+                storage.db.add_txi_addr(txid, addrs[i % 10], '%064x:0' % (i - 10), 1000 + i - 10)
+                storage.db.add_txo_addr(txid, addrs[i % 10], 0, 500, False)
+            else:
+                storage.db.add_txo_addr(txid, addrs[i % 10], 0, 1000 + i, False)
+            storage.db.add_verified_tx(txid, TxMinedInfo(height=i + 1, timestamp=1500000000 + i,
+                                                         txpos=0, header_hash='00' * 32))
+            hist[addrs[i % 10]].append((txid, i + 1))
+        for addr in addrs:
+            storage.db.set_addr_history(addr, hist[addr])
+        storage.write()
+        self.wallet = Wallet(WalletStorage(self.wallet_path))
+
+    def test_pages(self):
+        full = self.wallet.get_full_history()
+        self.assertEqual(self.num_txs, len(full['transactions']))
+        txs = []
+        cursor = 0
+        while cursor is not None:
+            page = self.wallet.get_full_history(cursor=cursor, limit=700)
+            self.assertLessEqual(len(page['transactions']), 700)
+            txs += page['transactions']
+            cursor = page['next_cursor']
+        self.assertEqual(full['transactions'], txs)
+        # filters apply to the rows after the cursor
+        page = self.wallet.get_full_history(from_height=1001, to_height=2001, cursor=1200, limit=10)
+        self.assertEqual(['%064x' % i for i in range(1200, 1210)], [x['txid'] for x in page['transactions']])
+        self.assertEqual(1210, page['next_cursor'])
+
+    def test_summary(self):
+        summary = self.wallet.get_full_history(from_height=1001, to_height=2001)['summary']
+        txs = self.wallet.get_full_history()['transactions'][1000:2000]
+        self.assertEqual(txs[0]['balance'].value - txs[0]['value'].value, summary['start_balance'].value)
+        self.assertEqual(txs[-1]['balance'].value, summary['end_balance'].value)
+        self.assertEqual(sum(x['value'].value for x in txs if x['value'].value > 0), summary['incoming'].value)
+        self.assertLess(0, summary['outgoing'].value)
+        self.assertEqual(-sum(x['value'].value for x in txs if x['value'].value < 0), summary['outgoing'].value)
+        self.assertEqual({}, self.wallet.get_full_history(from_height=10**6)['summary'])
+
+    def test_export_formats(self):
+        txs = json.loads(json.dumps(self.wallet.get_full_history()['transactions'], cls=util.MyEncoder))
+        f = StringIO()
+        summary = self.wallet.export_history(f, fmt='json')
+        self.assertEqual(txs, json.loads(f.getvalue()))
+        self.assertEqual(self.num_txs, summary.num_items)
+        f = StringIO()
+        self.wallet.export_history(f, fmt='jsonl')
+        self.assertEqual(txs, [json.loads(line) for line in f.getvalue().splitlines()])
+        f = StringIO()
+        self.wallet.export_history(f, fmt='csv')
+        rows = list(csv.reader(StringIO(f.getvalue())))
+        self.assertEqual(HISTORY_CSV_FIELDS, rows[0])
+        self.assertEqual([x['txid'] for x in txs], [row[0] for row in rows[1:]])
+        f = StringIO()
+        self.wallet.export_history(f, fmt='json', from_height=10**6)
+        self.assertEqual([], json.loads(f.getvalue()))
+
+    def test_export_peak_memory(self):
+        self.wallet.get_history()  # build the history index
+        def peak_memory(f):
+            tracemalloc.start()
+            try:
+                f()
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        with open(os.devnull, 'w') as f:
+            full = peak_memory(lambda: f.write(util.json_encode(self.wallet.get_full_history()['transactions'])))
+            for fmt in ('csv', 'json', 'jsonl'):
+                peak = peak_memory(lambda: self.wallet.export_history(f, fmt=fmt))
+                self.assertLess(peak, full / 5, fmt)
+
+
+class TestDeriveAddresses(WalletTestCase):
+
+    def _make_xpub(self, seed, xtype='standard'):
+        return BIP32Node.from_rootseed(seed, xtype=xtype).to_xpub()
+
+    def _make_wallet(self, xpubs):
+        storage = WalletStorage(self.wallet_path)
+        if len(xpubs) == 1:
+            storage.put('wallet_type', 'standard')
+            storage.put('keystore', keystore.from_xpub(xpubs[0]).dump())
+        else:
+            storage.put('wallet_type', '%dof%d' % (len(xpubs), len(xpubs)))
+            for i, xpub in enumerate(xpubs):
+                storage.put('x%d/' % (i + 1), keystore.from_xpub(xpub).dump())
+        storage.put('stored_height', 1000)
+        return Wallet(storage)
+
+    @mock.patch.object(keystore, 'PUBKEYS_PER_JOB', 7)
+    @mock.patch.object(keystore, 'MIN_PUBKEYS_FOR_EXECUTOR', 20)
+    def test_derive_pubkeys(self):
+        xpub = self._make_xpub(b'\x01' * 32)
+        ks = keystore.from_xpub(xpub)
+        for for_change in (0, 1):
+            expected = [keystore.Xpub.get_pubkey_from_xpub(xpub, (for_change, i)) for i in range(30)]
+            self.assertEqual(expected, ks.derive_pubkeys(for_change, range(30)))
+            self.assertEqual(expected[5], ks.derive_pubkey(for_change, 5))
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                self.assertEqual(expected, ks.derive_pubkeys(for_change, range(30), executor))
+                self.assertEqual(expected[3:13], ks.derive_pubkeys(for_change, range(3, 13), executor))
+
+    def test_standard_wallet_addresses(self):
+        xpub = self._make_xpub(b'\x02' * 32, 'p2wpkh')
+        wallet = self._make_wallet([xpub])  # type: Standard_Wallet
+        self.assertEqual(20, len(wallet.get_receiving_addresses()))
+        self.assertEqual(6, len(wallet.get_change_addresses()))
+        for for_change, addresses in ((0, wallet.get_receiving_addresses()),
+                                      (1, wallet.get_change_addresses())):
+            expected = [bitcoin.pubkey_to_address('p2wpkh', keystore.Xpub.get_pubkey_from_xpub(xpub, (for_change, i)))
+                        for i in range(len(addresses))]
+            self.assertEqual(expected, addresses)
+
+    def test_multisig_wallet_addresses(self):
+        xpubs = [self._make_xpub(bytes([i]) * 32) for i in (3, 4)]
+        wallet = self._make_wallet(xpubs)  # type: Multisig_Wallet
+        self.assertEqual('p2sh', wallet.txin_type)
+        addresses = wallet.get_receiving_addresses()
+        self.assertEqual(20, len(addresses))
+        for i, addr in enumerate(addresses):
+            pubkeys = [keystore.Xpub.get_pubkey_from_xpub(xpub, (0, i)) for xpub in xpubs]
+            self.assertEqual(wallet.pubkeys_to_address(pubkeys), addr)
+
+    def test_synchronize_extends_gap(self):
+        wallet = self._make_wallet([self._make_xpub(b'\x05' * 32)])
+        addresses = wallet.get_receiving_addresses()
+        wallet.db.set_addr_history(addresses[15], [('00' * 32, 900)])
+        wallet.synchronize()
+        addresses = wallet.get_receiving_addresses()
+        self.assertEqual(36, len(addresses))
+        # unconfirmed history does not count as old
+        wallet.db.set_addr_history(addresses[35], [('11' * 32, 0)])
+        wallet.synchronize()
+        self.assertEqual(36, len(wallet.get_receiving_addresses()))
+        wallet.db.set_addr_history(addresses[35], [('11' * 32, 990)])
+        wallet.synchronize()
+        self.assertEqual(56, len(wallet.get_receiving_addresses()))
+        for i, addr in enumerate(wallet.get_receiving_addresses()):
+            self.assertEqual(wallet.derive_address(False, i), addr)
+
+
+class TestSignTransaction(SequentialTestCase):
+
+    def _make_tx(self, ks, sequences):
+        inputs = []
+        for i, (for_change, n) in enumerate(sequences):
+            pubkey = ks.derive_pubkey(for_change, n)
+            inputs.append({'type': 'p2wpkh', 'prevout_hash': '%064x' % i, 'prevout_n': 0,
+                           'x_pubkeys': [ks.get_xpubkey(for_change, n)], 'pubkeys': [pubkey],
+                           'signatures': [None], 'num_sig': 1, 'value': 10000,
+                           'address': bitcoin.pubkey_to_address('p2wpkh', pubkey)})
+        outputs = [TxOutput(bitcoin.TYPE_ADDRESS, hash160_to_p2pkh(bytes(20)), 10000 * len(inputs) - 1000)]
+        return Transaction.from_io(inputs, outputs)
+
+    def test_get_keypairs_bip32(self):
+        ks = keystore.from_xprv(BIP32Node.from_rootseed(b'\x06' * 32, xtype='standard').to_xprv())
+        derivations = {ks.get_xpubkey(c, n): [c, n] for c, n in ((0, 0), (0, 7), (1, 3), (0, 7))}
+        expected = {x_pubkey: ks.get_private_key(sequence, None) for x_pubkey, sequence in derivations.items()}
+        self.assertEqual(expected, ks.get_keypairs(derivations, None))
+
+    def test_get_keypairs_old(self):
+        ks = keystore.Old_KeyStore({})
+        ks.add_seed('7c2a8fb9d5ed1c5bf2d9f3e7cb3b0a06')
+        derivations = {ks.get_xpubkey(c, n): [c, n] for c, n in ((0, 1), (1, 2))}
+        expected = {x_pubkey: ks.get_private_key(sequence, None) for x_pubkey, sequence in derivations.items()}
+        self.assertEqual(expected, ks.get_keypairs(derivations, None))
+
+    @mock.patch.object(transaction, 'SIGNATURES_PER_JOB', 3)
+    @mock.patch.object(transaction, 'MIN_SIGNATURES_FOR_EXECUTOR', 5)
+    def test_sign_transaction(self):
+        ks = keystore.from_xprv(BIP32Node.from_rootseed(b'\x07' * 32, xtype='p2wpkh').to_xprv())
+        sequences = [(0, n) for n in range(8)] + [(1, 0), (0, 3)]
+        # one input at a time, as Transaction.sign used to
+        tx = self._make_tx(ks, sequences)
+        expected = [tx.sign_txin(i, ks.get_private_key(sequence, None)[0])
+                    for i, sequence in enumerate(sequences)]
+        for executor in (None, ThreadPoolExecutor(max_workers=2)):
+            tx = self._make_tx(ks, sequences)
+            ks.sign_transaction(tx, None, executor=executor)
+            self.assertTrue(tx.is_complete())
+            self.assertEqual(expected, [txin['signatures'][0] for txin in tx.inputs()])
+            if executor:
+                executor.shutdown()
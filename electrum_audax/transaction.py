@@ -30,6 +30,7 @@
 import struct
 import traceback
 import sys
+from concurrent.futures import Executor
 from typing import (Sequence, Union, NamedTuple, Tuple, Optional, Iterable,
                     Callable, List, Dict)
 
@@ -50,6 +51,12 @@ _logger = get_logger(__name__)
 
 NO_SIGNATURE = 'ff'
 PARTIAL_TXN_HEADER_MAGIC = b'EPTF\xff'
+PARTIAL_TXN_HEADER_MAGIC_HEX = PARTIAL_TXN_HEADER_MAGIC.hex()
+
+# only farm out signing to an executor if there are at least this many signatures to make
+MIN_SIGNATURES_FOR_EXECUTOR = 50
+# number of signatures made per executor job
+SIGNATURES_PER_JOB = 25
 
 
 class SerializationError(Exception):
@@ -79,6 +86,16 @@ class TxOutputForUI(NamedTuple):
     value: int
 
 
+class SharedTxDigestFields(NamedTuple):
+    # the parts of the sighash preimages that are the same for every input
+    outpoints: List[bytes]
+    sequences: List[bytes]
+    txouts: bytes
+    hashPrevouts: bytes  # BIP143
+    hashSequence: bytes  # BIP143
+    hashOutputs: bytes  # BIP143
+
+
 class TxOutputHwInfo(NamedTuple):
     address_index: Tuple
     sorted_xpubs: Iterable[str]
@@ -390,6 +407,12 @@ def parse_redeemScript_multisig(redeem_script: bytes):
 
 
 def get_address_from_output_script(_bytes: bytes, *, net=None) -> Tuple[int, str]:
+    # p2pkh and p2sh, matched on the bytes as they are by far the most common
+    if len(_bytes) == 25 and _bytes[:3] == b'\x76\xa9\x14' and _bytes[23:] == b'\x88\xac':
+        return TYPE_ADDRESS, hash160_to_p2pkh(_bytes[3:23], net=net)
+    if len(_bytes) == 23 and _bytes[:2] == b'\xa9\x14' and _bytes[22] == opcodes.OP_EQUAL:
+        return TYPE_ADDRESS, hash160_to_p2sh(_bytes[2:22], net=net)
+
     try:
         decoded = [x for x in script_GetOp(_bytes)]
     except MalformedBitcoinScript:
@@ -434,18 +457,23 @@ def parse_outpoint(vds):
 
 
 def parse_input(vds, full_parse: bool):
-    d = {}
     prevout_hash = hash_encode(vds.read_bytes(32))
     prevout_n = vds.read_uint32()
     scriptSig = vds.read_bytes(vds.read_compact_size())
     sequence = vds.read_uint32()
-    d['prevout_hash'] = prevout_hash
-    d['prevout_n'] = prevout_n
-    d['scriptSig'] = bh2u(scriptSig)
-    d['sequence'] = sequence
-    d['type'] = 'unknown' if prevout_hash != '00'*32 else 'coinbase'
-    d['address'] = None
-    d['num_sig'] = 0
+    return make_txin(prevout_hash, prevout_n, scriptSig, sequence, full_parse)
+
+
+def make_txin(prevout_hash: str, prevout_n: int, scriptSig: bytes, sequence: int, full_parse: bool) -> dict:
+    d = {
+        'prevout_hash': prevout_hash,
+        'prevout_n': prevout_n,
+        'scriptSig': bh2u(scriptSig),
+        'sequence': sequence,
+        'type': 'unknown' if prevout_hash != '00'*32 else 'coinbase',
+        'address': None,
+        'num_sig': 0,
+    }
     if not full_parse:
         return d
     d['x_pubkeys'] = []
@@ -471,21 +499,44 @@ def construct_witness(items: Sequence[Union[str, int, bytes]]) -> str:
     return witness
 
 
-def parse_witness(vds, txin, full_parse: bool):
-    n = vds.read_compact_size()
+def read_compact_size(data: bytes, pos: int) -> Tuple[int, int]:
+    """Returns the compact size at pos of data, and the position after it."""
+    size = data[pos]
+    if size < 253:
+        return size, pos + 1
+    if size == 253:
+        return struct.unpack_from('<H', data, pos + 1)[0], pos + 3
+    if size == 254:
+        return struct.unpack_from('<I', data, pos + 1)[0], pos + 5
+    return struct.unpack_from('<Q', data, pos + 1)[0], pos + 9
+
+
+def read_bytes(data: bytes, pos: int, length: int) -> Tuple[bytes, int]:
+    end = pos + length
+    if end > len(data):
+        raise SerializationError("attempt to read past end of buffer")
+    return data[pos:end], end
+
+
+def parse_witness(data: bytes, pos: int, txin: dict, full_parse: bool) -> int:
+    """Parses the witness of txin at pos of data, and returns the
+    position after it."""
+    n, pos = read_compact_size(data, pos)
     if n == 0:
         txin['witness'] = '00'
-        return
+        return pos
     if n == 0xffffffff:
-        txin['value'] = vds.read_uint64()
-        txin['witness_version'] = vds.read_uint16()
-        n = vds.read_compact_size()
+        txin['value'], txin['witness_version'] = struct.unpack_from('<QH', data, pos)
+        n, pos = read_compact_size(data, pos + 10)
     # now 'n' is the number of items in the witness
-    w = list(bh2u(vds.read_bytes(vds.read_compact_size())) for i in range(n))
+    w = []
+    for i in range(n):
+        length, pos = read_compact_size(data, pos)
+        item, pos = read_bytes(data, pos, length)
+        w.append(bh2u(item))
     txin['witness'] = construct_witness(w)
     if not full_parse:
-        return
-
+        return pos
     try:
         if txin.get('witness_version', 0) != 0:
             raise UnknownTxinType()
@@ -522,59 +573,125 @@ def parse_witness(vds, txin, full_parse: bool):
     except BaseException:
         txin['type'] = 'unknown'
         _logger.exception(f"failed to parse witness {txin.get('witness')}")
+    return pos
 
 
 def parse_output(vds, i):
-    d = {}
-    d['value'] = vds.read_int64()
-    if d['value'] > TOTAL_COIN_SUPPLY_LIMIT_IN_BTC * COIN:
-        raise SerializationError('invalid output amount (too large)')
-    if d['value'] < 0:
-        raise SerializationError('invalid output amount (negative)')
+    value = vds.read_int64()
     scriptPubKey = vds.read_bytes(vds.read_compact_size())
-    d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
-    d['scriptPubKey'] = bh2u(scriptPubKey)
-    d['prevout_n'] = i
-    return d
+    return make_txout(value, scriptPubKey, i)
 
 
-def deserialize(raw: str, force_full_parse=False) -> dict:
-    raw_bytes = bfh(raw)
+def make_txout(value: int, scriptPubKey: bytes, i: int) -> dict:
+    if value > TOTAL_COIN_SUPPLY_LIMIT_IN_BTC * COIN:
+        raise SerializationError('invalid output amount (too large)')
+    if value < 0:
+        raise SerializationError('invalid output amount (negative)')
+    _type, address = get_address_from_output_script(scriptPubKey)
+    return {
+        'value': value,
+        'type': _type,
+        'address': address,
+        'scriptPubKey': bh2u(scriptPubKey),
+        'prevout_n': i,
+    }
+
+
+def deserialize(raw: Union[str, bytes], force_full_parse=False) -> dict:
+    """Parses a serialized tx, given as hex or bytes.
+    Fields are read from the bytes at their offsets, without going
+    through a BCDataStream.
+    """
+    raw_bytes = bfh(raw) if isinstance(raw, str) else bytes(raw)
     d = {}
+    pos = 0
     if raw_bytes[:5] == PARTIAL_TXN_HEADER_MAGIC:
         d['partial'] = is_partial = True
         partial_format_version = raw_bytes[5]
         if partial_format_version != 0:
             raise SerializationError('unknown tx partial serialization format version: {}'
                                      .format(partial_format_version))
-        raw_bytes = raw_bytes[6:]
+        pos = 6
     else:
         d['partial'] = is_partial = False
     full_parse = force_full_parse or is_partial
-    vds = BCDataStream()
-    vds.write(raw_bytes)
-    d['version'] = vds.read_int32()
-    n_vin = vds.read_compact_size()
-    is_segwit = (n_vin == 0)
-    if is_segwit:
-        marker = vds.read_bytes(1)
-        if marker != b'\x01':
-            raise ValueError('invalid txn marker byte: {}'.format(marker))
-        n_vin = vds.read_compact_size()
-    d['segwit_ser'] = is_segwit
-    d['inputs'] = [parse_input(vds, full_parse=full_parse) for i in range(n_vin)]
-    n_vout = vds.read_compact_size()
-    d['outputs'] = [parse_output(vds, i) for i in range(n_vout)]
-    if is_segwit:
+    unpack_from = struct.unpack_from
+    try:
+        d['version'], = unpack_from('<i', raw_bytes, pos)
+        n_vin, pos = read_compact_size(raw_bytes, pos + 4)
+        is_segwit = (n_vin == 0)
+        if is_segwit:
+            marker = raw_bytes[pos:pos + 1]
+            if marker != b'\x01':
+                raise ValueError('invalid txn marker byte: {}'.format(marker))
+            n_vin, pos = read_compact_size(raw_bytes, pos + 1)
+        d['segwit_ser'] = is_segwit
+        inputs = []
         for i in range(n_vin):
-            txin = d['inputs'][i]
-            parse_witness(vds, txin, full_parse=full_parse)
-    d['lockTime'] = vds.read_uint32()
-    if vds.can_read_more():
+            prevout_hash, pos = read_bytes(raw_bytes, pos, 32)
+            prevout_n, = unpack_from('<I', raw_bytes, pos)
+            length, pos = read_compact_size(raw_bytes, pos + 4)
+            scriptSig, pos = read_bytes(raw_bytes, pos, length)
+            sequence, = unpack_from('<I', raw_bytes, pos)
+            pos += 4
+            inputs.append(make_txin(hash_encode(prevout_hash), prevout_n, scriptSig, sequence, full_parse))
+        d['inputs'] = inputs
+        n_vout, pos = read_compact_size(raw_bytes, pos)
+        outputs = []
+        for i in range(n_vout):
+            value, = unpack_from('<q', raw_bytes, pos)
+            length, pos = read_compact_size(raw_bytes, pos + 8)
+            scriptPubKey, pos = read_bytes(raw_bytes, pos, length)
+            outputs.append(make_txout(value, scriptPubKey, i))
+        d['outputs'] = outputs
+        if is_segwit:
+            for txin in inputs:
+                pos = parse_witness(raw_bytes, pos, txin, full_parse=full_parse)
+        d['lockTime'], = unpack_from('<I', raw_bytes, pos)
+    except (IndexError, struct.error) as e:
+        raise SerializationError("attempt to read past end of buffer") from e
+    if pos + 4 < len(raw_bytes):
         raise SerializationError('extra junk at the end')
     return d
 
 
+def get_tx_hashes_from_raw(raw_bytes: bytes) -> Tuple[bytes, bytes]:
+    """Returns the txid and wtxid of a network serialized tx, hashed from
+    the spans of raw_bytes; no deserialization or re-serialization."""
+    wtxid = sha256d(raw_bytes)
+    if raw_bytes[4:6] != b'\x00\x01':
+        return wtxid, wtxid
+    # segwit: the txid leaves out the marker, flag and witnesses
+    try:
+        n_vin, pos = read_compact_size(raw_bytes, 6)
+        for i in range(n_vin):
+            length, pos = read_compact_size(raw_bytes, pos + 36)
+            pos += length + 4
+        n_vout, pos = read_compact_size(raw_bytes, pos)
+        for i in range(n_vout):
+            length, pos = read_compact_size(raw_bytes, pos + 8)
+            pos += length
+    except IndexError as e:
+        raise SerializationError("attempt to read past end of buffer") from e
+    txid = sha256d(raw_bytes[:4] + raw_bytes[6:pos] + raw_bytes[-4:])
+    return txid, wtxid
+
+
+def sign_sighashes(jobs: Sequence[Tuple[bytes, bytes]]) -> List[str]:
+    """Returns the signature, in hex and with SIGHASH_ALL appended, for
+    each (privkey, sighash) in jobs.
+    Module-level so that it can be sent to a process pool.
+    """
+    keys = {}
+    sigs = []
+    for privkey, pre_hash in jobs:
+        key = keys.get(privkey)
+        if key is None:
+            key = keys[privkey] = ecc.ECPrivkey(privkey)
+        sigs.append(bh2u(key.sign_transaction(pre_hash)) + '01')
+    return sigs
+
+
 # pay & redeem scripts
 
 def multisig_script(public_keys: Sequence[str], m: int) -> str:
@@ -613,6 +730,7 @@ class Transaction:
         self.is_partial_originally = True
         self._segwit_ser = None  # None means "don't know"
         self.output_info = None  # type: Optional[Dict[str, TxOutputHwInfo]]
+        self._raw_hashes = None  # type: Optional[Tuple[str, str, str]]  # raw, txid, wtxid
 
     def update(self, raw):
         self.raw = raw
@@ -654,12 +772,15 @@ class Transaction:
             return
         if len(self.inputs()) != len(signatures):
             raise Exception('expected {} signatures; got {}'.format(len(self.inputs()), len(signatures)))
+        shared_txdigest_fields = None
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
             sig = signatures[i]
             if sig in txin.get('signatures'):
                 continue
-            pre_hash = sha256d(bfh(self.serialize_preimage(i)))
+            if shared_txdigest_fields is None:
+                shared_txdigest_fields = self.calc_shared_txdigest_fields()
+            pre_hash = sha256d(self.serialize_preimage_bytes(i, shared_txdigest_fields))
             sig_string = ecc.sig_string_from_der_sig(bfh(sig[:-2]))
             for recid in range(4):
                 try:
@@ -949,6 +1070,7 @@ class Transaction:
         nSequence = 0xffffffff - (2 if rbf else 1)
         for txin in self.inputs():
             txin['sequence'] = nSequence
+        self.raw = None
 
     def BIP69_sort(self, inputs=True, outputs=True):
         if inputs:
@@ -964,29 +1086,51 @@ class Transaction:
         s += script
         return s
 
-    def serialize_preimage(self, i):
-        nVersion = int_to_hex(self.version, 4)
-        nHashType = int_to_hex(1, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+    def calc_shared_txdigest_fields(self) -> SharedTxDigestFields:
+        """Serializes and hashes the parts of the sighash preimages that
+        are shared by all inputs, so that they are computed once per tx
+        rather than once per input. Compute them again after changing
+        the inputs or outputs."""
         inputs = self.inputs()
         outputs = self.outputs()
+        outpoints = [bfh(self.serialize_outpoint(txin)) for txin in inputs]
+        sequences = [struct.pack('<I', txin.get('sequence', 0xffffffff - 1)) for txin in inputs]
+        txouts = bfh(''.join(self.serialize_output(o) for o in outputs))
+        return SharedTxDigestFields(
+            outpoints=outpoints,
+            sequences=sequences,
+            txouts=bfh(var_int(len(outputs))) + txouts,
+            hashPrevouts=sha256d(b''.join(outpoints)),
+            hashSequence=sha256d(b''.join(sequences)),
+            hashOutputs=sha256d(txouts),
+        )
+
+    def serialize_preimage(self, i, shared_txdigest_fields: SharedTxDigestFields = None) -> str:
+        return bh2u(self.serialize_preimage_bytes(i, shared_txdigest_fields))
+
+    def serialize_preimage_bytes(self, i, shared_txdigest_fields: SharedTxDigestFields = None) -> bytes:
+        if shared_txdigest_fields is None:
+            shared_txdigest_fields = self.calc_shared_txdigest_fields()
+        f = shared_txdigest_fields
+        nVersion = bfh(int_to_hex(self.version, 4))
+        nHashType = bfh(int_to_hex(1, 4))
+        nLocktime = bfh(int_to_hex(self.locktime, 4))
+        inputs = self.inputs()
         txin = inputs[i]
-        # TODO: py3 hex
+        preimage_script = bfh(self.get_preimage_script(txin))
+        scriptCode = bfh(var_int(len(preimage_script))) + preimage_script
         if self.is_segwit_input(txin):
-            hashPrevouts = bh2u(sha256d(bfh(''.join(self.serialize_outpoint(txin) for txin in inputs))))
-            hashSequence = bh2u(sha256d(bfh(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs))))
-            hashOutputs = bh2u(sha256d(bfh(''.join(self.serialize_output(o) for o in outputs))))
-            outpoint = self.serialize_outpoint(txin)
-            preimage_script = self.get_preimage_script(txin)
-            scriptCode = var_int(len(preimage_script) // 2) + preimage_script
-            amount = int_to_hex(txin['value'], 8)
-            nSequence = int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-            preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
-        else:
-            txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.get_preimage_script(txin) if i==k else '') for k, txin in enumerate(inputs))
-            txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
-        return preimage
+            amount = bfh(int_to_hex(txin['value'], 8))
+            return b''.join((nVersion, f.hashPrevouts, f.hashSequence, f.outpoints[i], scriptCode,
+                             amount, f.sequences[i], f.hashOutputs, nLocktime, nHashType))
+        # legacy: every input with an empty script, except the one being signed
+        parts = [nVersion, bfh(var_int(len(inputs)))]
+        for k in range(len(inputs)):
+            parts.append(f.outpoints[k])
+            parts.append(scriptCode if k == i else b'\x00')
+            parts.append(f.sequences[k])
+        parts += [f.txouts, nLocktime, nHashType]
+        return b''.join(parts)
 
     def is_segwit(self, guess_for_address=False):
         if not self.is_partial_originally:
@@ -1023,7 +1167,23 @@ class Transaction:
         else:
             return nVersion + txins + txouts + nLocktime
 
+    def _get_hashes_from_raw(self) -> Optional[Tuple[str, str]]:
+        """Returns the txid and wtxid hashed from self.raw, or None if
+        self.raw is not a complete network serialized tx."""
+        raw = self.raw
+        if not raw or raw[:10].lower() == PARTIAL_TXN_HEADER_MAGIC_HEX:
+            return None
+        if self._raw_hashes is None or self._raw_hashes[0] is not raw:
+            if self._inputs is not None and not self.is_complete():
+                return None
+            txid, wtxid = get_tx_hashes_from_raw(bfh(raw))
+            self._raw_hashes = raw, bh2u(txid[::-1]), bh2u(wtxid[::-1])
+        return self._raw_hashes[1:]
+
     def txid(self):
+        hashes = self._get_hashes_from_raw()
+        if hashes:
+            return hashes[0]
         self.deserialize()
         all_segwit = all(self.is_segwit_input(x) for x in self.inputs())
         if not all_segwit and not self.is_complete():
@@ -1032,6 +1192,9 @@ class Transaction:
         return bh2u(sha256d(bfh(ser))[::-1])
 
     def wtxid(self):
+        hashes = self._get_hashes_from_raw()
+        if hashes:
+            return hashes[1]
         self.deserialize()
         if not self.is_complete():
             return None
@@ -1133,12 +1296,18 @@ class Transaction:
         s, r = self.signature_count()
         return r == s
 
-    def sign(self, keypairs) -> None:
+    def sign(self, keypairs, *, executor: Executor = None) -> None:
         # keypairs:  (x_)pubkey -> secret_bytes
+        # signing is spread over executor (e.g. a process pool) if there
+        # are at least MIN_SIGNATURES_FOR_EXECUTOR signatures to make
+        to_sign = []  # (txin_index, signing_pos, secret_bytes)
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
+            if self.is_txin_complete(txin):
+                continue
+            signed = {j for j, sig in enumerate(txin['signatures']) if sig}
             for j, (pubkey, x_pubkey) in enumerate(zip(pubkeys, x_pubkeys)):
-                if self.is_txin_complete(txin):
+                if len(signed) == txin.get('num_sig', 1):
                     break
                 if pubkey in keypairs:
                     _pubkey = pubkey
@@ -1148,18 +1317,27 @@ class Transaction:
                     continue
                 _logger.info(f"adding signature for {_pubkey}")
                 sec, compressed = keypairs.get(_pubkey)
-                sig = self.sign_txin(i, sec)
+                to_sign.append((i, j, sec))
+                signed.add(j)
+        if to_sign:
+            shared_txdigest_fields = self.calc_shared_txdigest_fields()
+            jobs = [(sec, sha256d(self.serialize_preimage_bytes(i, shared_txdigest_fields)))
+                    for i, j, sec in to_sign]
+            if executor is None or len(jobs) < MIN_SIGNATURES_FOR_EXECUTOR:
+                sigs = sign_sighashes(jobs)
+            else:
+                chunks = [jobs[k:k + SIGNATURES_PER_JOB] for k in range(0, len(jobs), SIGNATURES_PER_JOB)]
+                sigs = [sig for result in executor.map(sign_sighashes, chunks) for sig in result]
+            for (i, j, sec), sig in zip(to_sign, sigs):
                 self.add_signature_to_txin(i, j, sig)
 
         _logger.info(f"is_complete {self.is_complete()}")
         self.raw = self.serialize()
 
-    def sign_txin(self, txin_index, privkey_bytes) -> str:
-        pre_hash = sha256d(bfh(self.serialize_preimage(txin_index)))
-        privkey = ecc.ECPrivkey(privkey_bytes)
-        sig = privkey.sign_transaction(pre_hash)
-        sig = bh2u(sig) + '01'
-        return sig
+    def sign_txin(self, txin_index, privkey_bytes, *,
+                  shared_txdigest_fields: SharedTxDigestFields = None) -> str:
+        pre_hash = sha256d(self.serialize_preimage_bytes(txin_index, shared_txdigest_fields))
+        return sign_sighashes([(privkey_bytes, pre_hash)])[0]
 
     def get_outputs_for_UI(self) -> Sequence[TxOutputForUI]:
         outputs = []
@@ -0,0 +1,119 @@
+# Electrum - Lightweight Bitcoin Client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import threading
+from typing import Optional, Dict
+
+from .transaction import get_tx_hashes_from_raw
+from .util import bh2u, bfh
+from .logging import Logger
+
+
+# record header in the store file: txid (32 bytes) and length of the raw tx (4 bytes)
+RECORD_HEADER_SIZE = 36
+
+
+class TxStore(Logger):
+    """Raw txs keyed by txid, shared by all wallets loaded in a daemon.
+
+    Every raw tx is held once; wallets keep references to the same bytes
+    objects instead of copies (see JsonDB.share_transactions), and the
+    synchronizer of a wallet looks here before asking the server. A tx
+    is only accepted if it hashes to its txid. If path is given, txs are
+    appended to that file and read back on the next start.
+    """
+
+    def __init__(self, path: str = None):
+        Logger.__init__(self)
+        self.path = path
+        self.lock = threading.Lock()
+        self._txs = {}  # type: Dict[str, bytes]
+        self._file = None
+        self.num_hits = 0
+        self.num_misses = 0
+        if path is not None:
+            self._load()
+            self._file = open(path, 'ab')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos + RECORD_HEADER_SIZE <= len(data):
+            txid = bh2u(data[pos:pos+32][::-1])
+            length = int.from_bytes(data[pos+32:pos+36], 'little')
+            if pos + RECORD_HEADER_SIZE + length > len(data):
+                break
+            self._txs[txid] = data[pos+RECORD_HEADER_SIZE:pos+RECORD_HEADER_SIZE+length]
+            pos += RECORD_HEADER_SIZE + length
+        if pos != len(data):
+            # a write was interrupted; drop the incomplete record
+            self.logger.info(f'truncating {self.path} at incomplete record')
+            with open(self.path, 'rb+') as f:
+                f.truncate(pos)
+        self.logger.info(f'loaded {len(self._txs)} txs from {self.path}')
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                'txs': len(self._txs),
+                'bytes': sum(len(raw) for raw in self._txs.values()),
+                'hits': self.num_hits,
+                'misses': self.num_misses,
+            }
+
+    def get(self, txid: str) -> Optional[bytes]:
+        with self.lock:
+            raw = self._txs.get(txid)
+            if raw is None:
+                self.num_misses += 1
+            else:
+                self.num_hits += 1
+            return raw
+
+    def add(self, txid: str, raw: bytes) -> Optional[bytes]:
+        """Returns the bytes object kept for txid, which callers should
+        reference instead of raw, or None if raw is not the tx txid.
+        """
+        with self.lock:
+            stored = self._txs.get(txid)
+            if stored is not None:
+                return stored if stored == raw else None
+        try:
+            if bh2u(get_tx_hashes_from_raw(raw)[0][::-1]) != txid:
+                return None
+        except Exception:
+            return None
+        with self.lock:
+            stored = self._txs.setdefault(txid, raw)
+            if stored is raw and self._file is not None:
+                self._file.write(bfh(txid)[::-1] + len(raw).to_bytes(4, 'little') + raw)
+                self._file.flush()
+            return stored
@@ -22,7 +22,9 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING
+import heapq
+from collections import OrderedDict
+from typing import Sequence, Optional, TYPE_CHECKING, List, Tuple
 
 import aiorpcx
 
@@ -40,6 +42,10 @@ if TYPE_CHECKING:
     from .address_synchronizer import AddressSynchronizer
 
 
+# number of blocks for which the inner nodes of verified merkle branches are kept
+MAX_CACHED_MERKLE_TREES = 100
+
+
 class MerkleVerificationFailure(Exception): pass
 class MissingBlockHeader(MerkleVerificationFailure): pass
 class MerkleRootMismatch(MerkleVerificationFailure): pass
@@ -49,6 +55,11 @@ class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 class SPV(NetworkJobOnDefaultServer):
     """ Simple Payment Verification """
 
+    # merkle branches are requested in JSON-RPC batches of up to batch_size,
+    # with at most max_batches_in_flight batches awaiting a response
+    batch_size = 100
+    max_batches_in_flight = 4
+
     def __init__(self, network: 'Network', wallet: 'AddressSynchronizer'):
         self.wallet = wallet
         NetworkJobOnDefaultServer.__init__(self, network)
@@ -57,53 +68,129 @@ class SPV(NetworkJobOnDefaultServer):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        # unverified txs to request proofs for, as a heap of (tx_height, txid),
+        # plus the same items as a set to avoid duplicates
+        self._queue = []  # type: List[Tuple[int, str]]
+        self._queued = set()
+        self._requested_chunks = set()
+        self._batch_slots = asyncio.Semaphore(self.max_batches_in_flight)
+        # merkle root -> {(depth, index): node} of the nodes of verified
+        # merkle branches, and of their siblings
+        self._merkle_nodes = OrderedDict()
+        # set when there might be new proofs to request
+        self._wakeup = asyncio.Event()
 
     async def _start_tasks(self):
-        async with self.group as group:
-            await group.spawn(self.main)
+        self.network.register_callback(self._on_blockchain_updated, ['blockchain_updated'])
+        try:
+            async with self.group as group:
+                await group.spawn(self.main)
+        finally:
+            # we are being cancelled now
+            self.network.unregister_callback(self._on_blockchain_updated)
+
+    def _on_blockchain_updated(self, event, *args):
+        self._wakeup.set()
+
+    def add_unverified_tx(self, tx_hash: str, tx_height: int) -> None:
+        """Queues a tx for verification. Can be called from any thread."""
+        self.network.asyncio_loop.call_soon_threadsafe(self._queue_tx, tx_hash, tx_height)
+
+    def _queue_tx(self, tx_hash: str, tx_height: int) -> None:
+        # tx will be verified only if height > 0
+        if tx_height <= 0 or (tx_height, tx_hash) in self._queued:
+            return
+        heapq.heappush(self._queue, (tx_height, tx_hash))
+        self._queued.add((tx_height, tx_hash))
+        self._wakeup.set()
+
+    def _queue_unverified_txs(self) -> None:
+        for tx_hash, tx_height in self.wallet.get_unverified_txs().items():
+            self._queue_tx(tx_hash, tx_height)
 
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
 
     async def main(self):
         self.blockchain = self.network.blockchain()
+        self._queue_unverified_txs()
         while True:
+            self._wakeup.clear()
             await self._maybe_undo_verifications()
             await self._request_proofs()
-            await asyncio.sleep(0.1)
+            await self._wakeup.wait()
 
     async def _request_proofs(self):
         local_height = self.blockchain.height()
-        unverified = self.wallet.get_unverified_txs()
-
-        for tx_hash, tx_height in unverified.items():
+        to_request = []
+        missing_header = []
+        # only txs at heights we have headers for are taken off the queue
+        while self._queue and self._queue[0][0] <= local_height:
+            tx_height, tx_hash = heapq.heappop(self._queue)
+            self._queued.discard((tx_height, tx_hash))
+            # skip txs that are gone or moved since they were queued
+            if self.wallet.get_unverified_tx_height(tx_hash) != tx_height:
+                continue
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
                 continue
-            # or before headers are available
-            if tx_height <= 0 or tx_height > local_height:
-                continue
             # if it's in the checkpoint region, we still might not have the header
             header = self.blockchain.read_header(tx_height)
             if header is None:
-                if tx_height < constants.net.max_checkpoint():
-                    await self.group.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
+                missing_header.append((tx_height, tx_hash))
+                index = tx_height // 2016
+                if tx_height < constants.net.max_checkpoint() and index not in self._requested_chunks:
+                    self._requested_chunks.add(index)
+                    await self.group.spawn(self._request_chunk(tx_height))
                 continue
             # request now
             self.logger.info(f'requested merkle {tx_hash}')
             self.requested_merkle.add(tx_hash)
-            await self.group.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+            to_request.append((tx_hash, tx_height))
+        # retried when headers arrive; they must not wake us up until then
+        for item in missing_header:
+            heapq.heappush(self._queue, item)
+            self._queued.add(item)
+        for i in range(0, len(to_request), self.batch_size):
+            await self._batch_slots.acquire()
+            await self.group.spawn(self._request_and_verify_proofs, to_request[i:i+self.batch_size])
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
+    async def _request_chunk(self, tx_height):
         try:
-            merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
-        except UntrustedServerReturnedError as e:
-            if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
-                raise
-            self.logger.info(f'tx {tx_hash} not at height {tx_height}')
-            self.wallet.remove_unverified_tx(tx_hash, tx_height)
-            self.requested_merkle.discard(tx_hash)
-            return
+            await self.network.request_chunk(tx_height, None, can_return_early=True)
+        finally:
+            self._requested_chunks.discard(tx_height // 2016)
+        self._wakeup.set()
+
+    async def _request_and_verify_proofs(self, txs: Sequence[Tuple[str, int]]):
+        multiplexer = self.network.subscription_multiplexer
+        try:
+            if multiplexer is not None:
+                results = await multiplexer.get_merkle_for_transactions(txs)
+            else:
+                results = await self.network.get_merkle_for_transactions(txs)
+        finally:
+            self._batch_slots.release()
+        # we need to wait if header sync/reorg is still ongoing, hence lock:
+        async with self.network.bhi_lock:
+            blockchain = self.network.blockchain()
+            heights = set(merkle.get('block_height') for merkle in results if isinstance(merkle, dict))
+            headers = {height: blockchain.read_header(height) for height in heights}
+        for (tx_hash, tx_height), merkle in zip(txs, results):
+            if isinstance(merkle, UntrustedServerReturnedError):
+                if not isinstance(merkle.original_exception, aiorpcx.jsonrpc.RPCError):
+                    raise merkle
+                self.logger.info(f'tx {tx_hash} not at height {tx_height}')
+                self.wallet.remove_unverified_tx(tx_hash, tx_height)
+                self.requested_merkle.discard(tx_hash)
+                # it might have been queued again at another height meanwhile
+                new_height = self.wallet.get_unverified_tx_height(tx_hash)
+                if new_height is not None:
+                    self._queue_tx(tx_hash, new_height)
+                continue
+            self._verify_proof(tx_hash, tx_height, merkle, headers.get(merkle.get('block_height')))
+
+    def _verify_proof(self, tx_hash: str, tx_height: int, merkle: dict, header: Optional[dict]):
         # Verify the hash of the server-provided merkle branch to a
         # transaction matches the merkle root of its block
         if tx_height != merkle.get('block_height'):
@@ -112,17 +199,22 @@ class SPV(NetworkJobOnDefaultServer):
         tx_height = merkle.get('block_height')
         pos = merkle.get('pos')
         merkle_branch = merkle.get('merkle')
-        # we need to wait if header sync/reorg is still ongoing, hence lock:
-        async with self.network.bhi_lock:
-            header = self.network.blockchain().read_header(tx_height)
         try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
+            self._verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
         except MerkleVerificationFailure as e:
+            if self.network.uncache_merkle(tx_hash, tx_height):
+                # it was verified and cached before a reorg; not the server's fault
+                self.logger.info(f'cached merkle branch of {tx_hash} is stale, requesting it again')
+                self.requested_merkle.discard(tx_hash)
+                self._queue_tx(tx_hash, tx_height)
+                return
             if self.network.config.get("skipmerklecheck"):
                 self.logger.info(f"skipping merkle proof check {tx_hash}")
             else:
                 self.logger.info(str(e))
                 raise GracefulDisconnect(e)
+        else:
+            self.network.cache_verified_merkle(tx_hash, merkle)
         # we passed all the tests
         self.merkle_roots[tx_hash] = header.get('merkle_root')
         self.requested_merkle.discard(tx_hash)
@@ -136,6 +228,43 @@ class SPV(NetworkJobOnDefaultServer):
         #if self.is_up_to_date() and self.wallet.is_up_to_date():
         #    self.wallet.save_verified_tx(write=True)
 
+    def _verify_tx_is_in_block(self, tx_hash: str, merkle_branch: Sequence[str],
+                               leaf_pos_in_tree: int, block_header: Optional[dict],
+                               block_height: int) -> None:
+        """Like verify_tx_is_in_block, but only hashes the merkle branch up to
+        where it joins a branch verified before in the same block.
+        """
+        if not block_header:
+            raise MissingBlockHeader("merkle verification failed for {} (missing header {})"
+                                     .format(tx_hash, block_height))
+        merkle_root = block_header.get('merkle_root')
+        try:
+            h = hash_decode(tx_hash)
+            merkle_branch_bytes = [hash_decode(item) for item in merkle_branch]
+            leaf_pos_in_tree = int(leaf_pos_in_tree)
+        except Exception as e:
+            raise MerkleVerificationFailure(e)
+        verified_nodes = self._merkle_nodes.get(merkle_root, {})
+        new_nodes = {}
+        for i, item in enumerate(merkle_branch_bytes):
+            node_id = (i, leaf_pos_in_tree >> i)
+            if verified_nodes.get(node_id) == h:
+                break
+            new_nodes[node_id] = h
+            new_nodes[(i, node_id[1] ^ 1)] = item
+            h = sha256d(item + h) if ((leaf_pos_in_tree >> i) & 1) else sha256d(h + item)
+            self._raise_if_valid_tx(bh2u(h))
+        else:
+            calc_merkle_root = hash_encode(h)
+            if merkle_root != calc_merkle_root:
+                raise MerkleRootMismatch("merkle verification failed for {} ({} != {})".format(
+                    tx_hash, merkle_root, calc_merkle_root))
+        verified_nodes.update(new_nodes)
+        self._merkle_nodes[merkle_root] = verified_nodes
+        self._merkle_nodes.move_to_end(merkle_root)
+        while len(self._merkle_nodes) > MAX_CACHED_MERKLE_TREES:
+            self._merkle_nodes.popitem(last=False)
+
     @classmethod
     def hash_merkle_root(cls, merkle_branch: Sequence[str], tx_hash: str, leaf_pos_in_tree: int):
         """Return calculated merkle root."""
@@ -176,6 +305,9 @@ class SPV(NetworkJobOnDefaultServer):
             for tx_hash in tx_hashes:
                 self.logger.info(f"redoing {tx_hash}")
                 self.remove_spv_proof_for_tx(tx_hash)
+            if tx_hashes:
+                # they are back among the wallet's unverified txs
+                self._queue_unverified_txs()
 
     def remove_spv_proof_for_tx(self, tx_hash):
         self.merkle_roots.pop(tx_hash, None)
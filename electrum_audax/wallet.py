@@ -31,26 +31,28 @@ import os
 import sys
 import random
 import time
+import csv
 import json
 import copy
 import errno
+import threading
 import traceback
 from functools import partial
 from numbers import Number
 from decimal import Decimal
-from typing import TYPE_CHECKING, List, Optional, Tuple, Union, NamedTuple
+from typing import TYPE_CHECKING, Iterator, List, Optional, Tuple, Union, NamedTuple, IO
 
 from .i18n import _
 from .util import (NotEnoughFunds, UserCancelled, profiler,
                    format_satoshis, format_fee_satoshis, NoDynamicFeeEstimates,
                    WalletFileException, BitcoinException,
                    InvalidPassword, format_time, timestamp_to_datetime, Satoshis,
-                   Fiat, bfh, bh2u, TxMinedInfo, AlreadyHaveAddress)
+                   Fiat, bfh, bh2u, TxMinedInfo, AlreadyHaveAddress, MyEncoder)
 from .bitcoin import (COIN, TYPE_ADDRESS, is_address, address_to_script,
                       is_minikey, relayfee, dust_threshold)
 from .crypto import sha256d
 from . import keystore
-from .keystore import load_keystore, Hardware_KeyStore
+from .keystore import load_keystore, Hardware_KeyStore, Software_KeyStore
 from .util import multisig_type
 from .storage import STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW, WalletStorage
 from . import transaction, bitcoin, coinchooser, paymentrequest, ecc, bip32
@@ -195,6 +197,48 @@ class TxWalletDetails(NamedTuple):
     mempool_depth_bytes: Optional[int]
 
 
+# number of history rows read at once when iterating over the history
+HISTORY_PAGE_SIZE = 1000
+
+HISTORY_CSV_FIELDS = ["transaction_hash", "label", "confirmations", "value",
+                      "fiat_value", "fee", "fiat_fee", "timestamp"]
+
+
+class HistorySummary:
+    """Totals of the items of a wallet history, updated item by item."""
+
+    def __init__(self):
+        self.num_items = 0
+        self.start_balance = None
+        self.end_balance = None
+        self.income = 0
+        self.expenditures = 0
+        self.capital_gains = Decimal(0)
+        self.fiat_income = Decimal(0)
+        self.fiat_expenditures = Decimal(0)
+        # history position after the last item, if there are more items
+        self.next_cursor = None  # type: Optional[int]
+
+    def add(self, item: dict) -> None:
+        value, balance = item['value'].value, item['balance'].value
+        if self.num_items == 0:
+            self.start_balance = None if balance is None or value is None else balance - value
+        self.end_balance = balance
+        self.num_items += 1
+        # fixme: use in and out values
+        if value < 0:
+            self.expenditures += -value
+        else:
+            self.income += value
+        if 'fiat_value' in item:
+            fiat_value = item['fiat_value'].value
+            if value < 0:
+                self.capital_gains += item['capital_gain'].value
+                self.fiat_expenditures += -fiat_value
+            else:
+                self.fiat_income += fiat_value
+
+
 class Abstract_Wallet(AddressSynchronizer):
     """
     Wallet classes are created to handle various address generation methods.
@@ -214,6 +258,13 @@ class Abstract_Wallet(AddressSynchronizer):
 
         AddressSynchronizer.__init__(self, storage)
 
+        # optional concurrent.futures.Executor to derive keys and sign in,
+        # see Xpub.derive_pubkeys and Transaction.sign
+        self.executor = None
+        # held while a command runs on the wallet, as the daemon runs
+        # commands concurrently, see commands.command
+        self.command_lock = threading.RLock()
+
         # saved fields
         self.use_change            = storage.get('use_change', True)
         self.multiple_change       = storage.get('multiple_change', False)
@@ -290,7 +341,7 @@ class Abstract_Wallet(AddressSynchronizer):
         return changed
 
     def set_fiat_value(self, txid, ccy, text, fx, value_sat):
-        if not self.db.get_transaction(txid):
+        if not self.db.has_transaction(txid):
             return
         # since fx is inserting the thousands separator,
         # and not util, also have fx remove it
@@ -368,7 +419,7 @@ class Abstract_Wallet(AddressSynchronizer):
         tx_hash = tx.txid()
         tx_mined_status = self.get_tx_height(tx_hash)
         if tx.is_complete():
-            if self.db.get_transaction(tx_hash):
+            if self.db.has_transaction(tx_hash):
                 label = self.get_label(tx_hash)
                 if tx_mined_status.height > 0:
                     if tx_mined_status.conf:
@@ -450,19 +501,42 @@ class Abstract_Wallet(AddressSynchronizer):
     @profiler
     def get_full_history(self, domain=None, from_timestamp=None, to_timestamp=None,
                          fx=None, show_addresses=False, show_fees=False,
-                         from_height=None, to_height=None):
+                         from_height=None, to_height=None, *, cursor=None, limit=None):
+        """Returns the history items and their summary. cursor and limit
+        select a page of items; 'next_cursor' is then the cursor of the
+        next page, or None if there are no more items.
+        """
+        summary = HistorySummary()
+        out = list(self.iter_full_history(domain, from_timestamp, to_timestamp, fx,
+                                          show_addresses, show_fees, from_height, to_height,
+                                          cursor=cursor, limit=limit, summary=summary))
+        ret = {
+            'transactions': out,
+            'summary': self.get_history_summary(summary, domain, fx, from_timestamp, to_timestamp,
+                                                from_height, to_height),
+        }
+        if limit is not None:
+            ret['next_cursor'] = summary.next_cursor
+        return ret
+
+    def iter_full_history(self, domain=None, from_timestamp=None, to_timestamp=None,
+                          fx=None, show_addresses=False, show_fees=False,
+                          from_height=None, to_height=None, *, cursor=None, limit=None,
+                          summary: HistorySummary = None) -> Iterator[dict]:
+        """Yields the items of get_full_history one by one, reading the
+        history one page at a time. Items are added to summary, if given.
+        """
         if (from_timestamp is not None or to_timestamp is not None) \
                 and (from_height is not None or to_height is not None):
             raise Exception('timestamp and block height based filtering cannot be used together')
-        out = []
-        income = 0
-        expenditures = 0
-        capital_gains = Decimal(0)
-        fiat_income = Decimal(0)
-        fiat_expenditures = Decimal(0)
-        h = self.get_history(domain)
+        if summary is None:
+            summary = HistorySummary()
         now = time.time()
-        for tx_hash, tx_mined_status, value, balance in h:
+        num_items = 0
+        for pos, (tx_hash, tx_mined_status, value, balance) in self._iter_history(domain, cursor or 0):
+            if limit is not None and num_items >= limit:
+                summary.next_cursor = pos
+                return
             timestamp = tx_mined_status.timestamp
             if from_timestamp and (timestamp or now) < from_timestamp:
                 continue
@@ -473,7 +547,9 @@ class Abstract_Wallet(AddressSynchronizer):
                 continue
             if to_height is not None and height >= to_height:
                 continue
-            tx = self.db.get_transaction(tx_hash)
+            # value may be None if wallet is not fully synchronized
+            if value is None:
+                continue
             item = {
                 'txid': tx_hash,
                 'height': height,
@@ -487,6 +563,8 @@ class Abstract_Wallet(AddressSynchronizer):
                 'txpos_in_block': tx_mined_status.txpos,
             }
             tx_fee = None
+            if show_fees or show_addresses:
+                tx = self.db.get_transaction(tx_hash)
             if show_fees:
                 tx_fee = self.get_tx_fee(tx)
                 item['fee'] = Satoshis(tx_fee) if tx_fee is not None else None
@@ -494,63 +572,90 @@ class Abstract_Wallet(AddressSynchronizer):
                 item['inputs'] = list(map(lambda x: dict((k, x[k]) for k in ('prevout_hash', 'prevout_n')), tx.inputs()))
                 item['outputs'] = list(map(lambda x:{'address':x.address, 'value':Satoshis(x.value)},
                                            tx.get_outputs_for_UI()))
-            # value may be None if wallet is not fully synchronized
-            if value is None:
-                continue
-            # fixme: use in and out values
-            if value < 0:
-                expenditures += -value
-            else:
-                income += value
             # fiat computations
             if fx and fx.is_enabled() and fx.get_history_config():
-                fiat_fields = self.get_tx_item_fiat(tx_hash, value, fx, tx_fee)
-                fiat_value = fiat_fields['fiat_value'].value
-                item.update(fiat_fields)
-                if value < 0:
-                    capital_gains += fiat_fields['capital_gain'].value
-                    fiat_expenditures += -fiat_value
-                else:
-                    fiat_income += fiat_value
-            out.append(item)
-        # add summary
-        if out:
-            b, v = out[0]['balance'].value, out[0]['value'].value
-            start_balance = None if b is None or v is None else b - v
-            end_balance = out[-1]['balance'].value
-            if from_timestamp is not None and to_timestamp is not None:
-                start_date = timestamp_to_datetime(from_timestamp)
-                end_date = timestamp_to_datetime(to_timestamp)
-            else:
-                start_date = None
-                end_date = None
-            summary = {
-                'start_date': start_date,
-                'end_date': end_date,
-                'from_height': from_height,
-                'to_height': to_height,
-                'start_balance': Satoshis(start_balance),
-                'end_balance': Satoshis(end_balance),
-                'incoming': Satoshis(income),
-                'outgoing': Satoshis(expenditures)
-            }
-            if fx and fx.is_enabled() and fx.get_history_config():
-                unrealized = self.unrealized_gains(domain, fx.timestamp_rate, fx.ccy)
-                summary['fiat_currency'] = fx.ccy
-                summary['fiat_capital_gains'] = Fiat(capital_gains, fx.ccy)
-                summary['fiat_incoming'] = Fiat(fiat_income, fx.ccy)
-                summary['fiat_outgoing'] = Fiat(fiat_expenditures, fx.ccy)
-                summary['fiat_unrealized_gains'] = Fiat(unrealized, fx.ccy)
-                summary['fiat_start_balance'] = Fiat(fx.historical_value(start_balance, start_date), fx.ccy)
-                summary['fiat_end_balance'] = Fiat(fx.historical_value(end_balance, end_date), fx.ccy)
-                summary['fiat_start_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
-                summary['fiat_end_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
+                item.update(self.get_tx_item_fiat(tx_hash, value, fx, tx_fee))
+            summary.add(item)
+            num_items += 1
+            yield item
+
+    def _iter_history(self, domain, start) -> Iterator[Tuple[int, tuple]]:
+        """Yields (position, history row) from position start on."""
+        if domain is not None:
+            yield from enumerate(self.get_history(domain, start=start), start)
+            return
+        while True:
+            rows = self.get_history(start=start, stop=start + HISTORY_PAGE_SIZE)
+            yield from enumerate(rows, start)
+            if len(rows) < HISTORY_PAGE_SIZE:
+                return
+            start += HISTORY_PAGE_SIZE
+
+    def get_history_summary(self, summary: HistorySummary, domain=None, fx=None,
+                            from_timestamp=None, to_timestamp=None,
+                            from_height=None, to_height=None) -> dict:
+        if not summary.num_items:
+            return {}
+        if from_timestamp is not None and to_timestamp is not None:
+            start_date = timestamp_to_datetime(from_timestamp)
+            end_date = timestamp_to_datetime(to_timestamp)
         else:
-            summary = {}
-        return {
-            'transactions': out,
-            'summary': summary
+            start_date = None
+            end_date = None
+        ret = {
+            'start_date': start_date,
+            'end_date': end_date,
+            'from_height': from_height,
+            'to_height': to_height,
+            'start_balance': Satoshis(summary.start_balance),
+            'end_balance': Satoshis(summary.end_balance),
+            'incoming': Satoshis(summary.income),
+            'outgoing': Satoshis(summary.expenditures)
         }
+        if fx and fx.is_enabled() and fx.get_history_config():
+            unrealized = self.unrealized_gains(domain, fx.timestamp_rate, fx.ccy)
+            ret['fiat_currency'] = fx.ccy
+            ret['fiat_capital_gains'] = Fiat(summary.capital_gains, fx.ccy)
+            ret['fiat_incoming'] = Fiat(summary.fiat_income, fx.ccy)
+            ret['fiat_outgoing'] = Fiat(summary.fiat_expenditures, fx.ccy)
+            ret['fiat_unrealized_gains'] = Fiat(unrealized, fx.ccy)
+            ret['fiat_start_balance'] = Fiat(fx.historical_value(summary.start_balance, start_date), fx.ccy)
+            ret['fiat_end_balance'] = Fiat(fx.historical_value(summary.end_balance, end_date), fx.ccy)
+            ret['fiat_start_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
+            ret['fiat_end_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
+        return ret
+
+    def export_history(self, f: IO[str], *, fmt='csv', **kwargs) -> HistorySummary:
+        """Writes the items of iter_full_history to f, one at a time.
+        fmt is 'csv', 'json' (a list of items) or 'jsonl' (an item per line).
+        """
+        summary = HistorySummary()
+        items = self.iter_full_history(summary=summary, **kwargs)
+        if fmt == 'csv':
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(HISTORY_CSV_FIELDS)
+            for item in items:
+                writer.writerow([item['txid'],
+                                 item.get('label', ''),
+                                 item['confirmations'],
+                                 item['value'],
+                                 item.get('fiat_value', ''),
+                                 item.get('fee', ''),
+                                 item.get('fiat_fee', ''),
+                                 item['date']])
+        elif fmt == 'json':
+            f.write('[')
+            for i, item in enumerate(items):
+                f.write(',\n' if i else '\n')
+                f.write(json.dumps(item, sort_keys=True, indent=4, cls=MyEncoder))
+            f.write('\n]' if summary.num_items else ']')
+        elif fmt == 'jsonl':
+            for item in items:
+                f.write(json.dumps(item, sort_keys=True, cls=MyEncoder))
+                f.write('\n')
+        else:
+            raise Exception(f'unknown history export format: {fmt}')
+        return summary
 
     def default_fiat_value(self, tx_hash, fx, value_sat):
         return value_sat / Decimal(COIN) * self.price_at_timestamp(tx_hash, fx.timestamp_rate)
@@ -919,9 +1024,9 @@ class Abstract_Wallet(AddressSynchronizer):
             txin['type'] = self.get_txin_type(address)
             # segwit needs value to sign
             if txin.get('value') is None:
-                received, spent = self.get_addr_io(address)
-                item = received.get(txin['prevout_hash']+':%d'%txin['prevout_n'])
-                if item:
+                with self.lock, self.transaction_lock:
+                    item = self._get_utxo_index().get((txin['prevout_hash'], txin['prevout_n']))
+                if item and item[0] == address:
                     txin['value'] = item[1]
             self.add_input_sig_info(txin, address)
 
@@ -983,7 +1088,11 @@ class Abstract_Wallet(AddressSynchronizer):
         # sign. start with ready keystores.
         for k in sorted(self.get_keystores(), key=lambda ks: ks.ready_to_sign(), reverse=True):
             try:
-                if k.can_sign(tx):
+                if not k.can_sign(tx):
+                    continue
+                if isinstance(k, Software_KeyStore):
+                    k.sign_transaction(tx, password, executor=self.executor)
+                else:
                     k.sign_transaction(tx, password)
             except UserCancelled:
                 continue
@@ -1477,6 +1586,8 @@ class Imported_Wallet(Simple_Wallet):
         self.set_frozen_state_of_addresses([address], False)
         pubkey = self.get_public_key(address)
         self.db.remove_imported_address(address)
+        # the indexes are rebuilt without the txs of the address
+        self._reset_tx_indexes()
         if pubkey:
             # delete key iff no other address uses it (e.g. p2pkh and p2wpkh for same key)
             for txin_type in bitcoin.WIF_SCRIPT_TYPES.keys():
@@ -1561,6 +1672,8 @@ class Imported_Wallet(Simple_Wallet):
 
 class Deterministic_Wallet(Abstract_Wallet):
 
+    restore_window = 200
+
     def __init__(self, storage):
         Abstract_Wallet.__init__(self, storage)
         self.gap_limit = storage.get('gap_limit', 20)
@@ -1646,29 +1759,46 @@ class Deterministic_Wallet(Abstract_Wallet):
         x = self.derive_pubkeys(for_change, n)
         return self.pubkeys_to_address(x)
 
+    def derive_addresses(self, for_change, indexes):
+        return [self.derive_address(for_change, n) for n in indexes]
+
     def create_new_address(self, for_change=False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count):
         assert type(for_change) is bool
         with self.lock:
             n = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
-            address = self.derive_address(for_change, n)
-            self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
-            self.add_address(address)
-            if for_change:
-                # note: if it's actually used, it will get filtered later
-                self._unused_change_addresses.append(address)
-            return address
+            addresses = self.derive_addresses(for_change, range(n, n + count))
+            return self.add_derived_addresses(for_change, n, addresses)
+
+    def add_derived_addresses(self, for_change, start, addresses):
+        """Adds the addresses derived at indexes start, start + 1, ... of the
+        chain, skipping the ones that the chain has already."""
+        assert type(for_change) is bool
+        with self.lock:
+            n = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
+            assert start <= n, (start, n)
+            addresses = addresses[n - start:]
+            for address in addresses:
+                self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
+                self.add_address(address)
+                if for_change:
+                    # note: if it's actually used, it will get filtered later
+                    self._unused_change_addresses.append(address)
+            return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
-        while True:
-            addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
-            if len(addresses) < limit:
-                self.create_new_address(for_change)
-                continue
-            if any(map(self.address_is_old, addresses[-limit:])):
-                self.create_new_address(for_change)
-            else:
+        addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
+        # new addresses are never old, so derive all the missing ones at once
+        num_unused = 0
+        for addr in reversed(addresses[-limit:]):
+            if self.address_is_old(addr):
                 break
+            num_unused += 1
+        if num_unused < limit:
+            self.create_new_addresses(for_change, limit - num_unused)
 
     def synchronize(self):
         with self.lock:
@@ -1736,6 +1866,10 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def derive_addresses(self, for_change, indexes):
+        pubkeys = self.keystore.derive_pubkeys(for_change, indexes, self.executor)
+        return [self.pubkeys_to_address(x) for x in pubkeys]
+
 
 
 
@@ -1779,6 +1913,10 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def derive_addresses(self, for_change, indexes):
+        pubkeys = [k.derive_pubkeys(for_change, indexes, self.executor) for k in self.get_keystores()]
+        return [self.pubkeys_to_address(list(x)) for x in zip(*pubkeys)]
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
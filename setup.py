@@ -79,7 +79,7 @@ setup(
         'electrum_audax': 'electrum_audax'
     },
     package_data={
-        '': ['*.txt', '*.json', '*.ttf', '*.otf'],
+        '': ['*.txt', '*.json', '*.ttf', '*.otf', '*.bin'],
         'electrum_audax': [
             'wordlist/*.txt',
             'locale/*/LC_MESSAGES/electrum.mo',